@@ -0,0 +1,217 @@
+import logging
+import os
+import shutil
+import time
+
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Optional
+
+from recording_storage import (
+    DATA_DIR,
+    BitrateHistory,
+    config_int,
+    locked_json,
+    output_root,
+)
+
+RESERVATIONS_PATH = DATA_DIR / "reservations.json"
+
+# Space always left free on a filesystem holding recordings.
+DEFAULT_MIN_FREE_MB = 1024
+
+# Reservations are forgotten this long after the end of their programme,
+# even if the recorder never released them (crash, reboot...).
+EXPIRY_GRACE = 15 * 60
+
+# Order in which roles give their space up, the last ones first.
+ROLE_RANKS = {"original": 0, "backup": 1, "backup_2": 2}
+
+
+def existing_ancestor(path: Path) -> Path:
+    """Return `path` or its closest parent that exists."""
+    path = Path(path)
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+class DiskAdmission:
+    """
+    Decide whether a recording may be scheduled, by reserving its expected
+    size against the free space of the filesystem it will be written to.
+
+    Reservations are kept in a JSON file shared by launch_record.py and every
+    record_iptv.py, keyed on the title, the role and the scheduled start.
+    When space is short, a role takes back the reservations of lower roles
+    of other programmes not started yet, backup_2 first then backup, before
+    being refused; their recorders are then refused at their start, when
+    they confirm their reservation.
+    """
+
+    def __init__(self, constants: ConfigParser, path: Path = RESERVATIONS_PATH):
+        self.constants = constants
+        self.path = path
+        self.bitrates = BitrateHistory(constants)
+        self.min_free = config_int(constants, "STORAGE", "min_free_mb", DEFAULT_MIN_FREE_MB) * 1024 * 1024
+
+    @staticmethod
+    def remaining(entry: dict, now: float) -> int:
+        """
+        Return the bytes a reservation still has to write. A recording in
+        progress has already consumed part of its space, which the free space
+        of the filesystem accounts for.
+        """
+        start, end = entry["start"], entry["end"]
+        if now <= start or end <= start:
+            return entry["bytes"]
+        if now >= end:
+            return 0
+        return int(entry["bytes"] * (end - now) / (end - start))
+
+    @staticmethod
+    def device(root) -> Optional[int]:
+        try:
+            return os.stat(existing_ancestor(Path(root))).st_dev
+        except OSError:
+            return None
+
+    def available(self, root: Path, reservations: list, now: float) -> int:
+        """Return the space of the filesystem of `root` not yet promised to anyone."""
+        anchor = existing_ancestor(root)
+        try:
+            free = shutil.disk_usage(anchor).free
+            device = os.stat(anchor).st_dev
+        except OSError as e:
+            logging.warning("Cannot read free space of %s: %s", root, e)
+            return 0
+
+        reserved = 0
+        for entry in reservations:
+            if self.device(entry["root"]) != device:
+                continue
+            reserved += self.remaining(entry, now)
+        return free - reserved - self.min_free
+
+    def evictable(self, title: str, save: str, root: Path, reservations: list, missing: int, now: float) -> list:
+        """
+        Return the reservations of lower roles of other programmes, not
+        started yet, whose space makes up for `missing` bytes on the
+        filesystem of `root`: backup_2 ones first, the latest first. Return
+        [] when all of them would not be enough.
+        """
+        device = self.device(root)
+        rank = ROLE_RANKS.get(save, 0)
+        candidates = sorted(
+            (
+                entry for entry in reservations
+                if entry["title"] != title
+                and ROLE_RANKS.get(entry["save"], 0) > rank
+                and entry["start"] > now
+                and self.device(entry["root"]) == device
+            ),
+            key=lambda entry: (ROLE_RANKS.get(entry["save"], 0), entry["start"]),
+            reverse=True,
+        )
+        chosen = []
+        for entry in candidates:
+            if missing <= 0:
+                break
+            chosen.append(entry)
+            missing -= self.remaining(entry, now)
+        return chosen if missing <= 0 else []
+
+    def admit(
+        self,
+        title: str,
+        save: str,
+        provider: str,
+        channel: str,
+        start: float,
+        duration: int,
+        scheduled: Optional[str] = None,
+    ) -> bool:
+        """
+        Reserve the space needed to record `title` for the role `save` and
+        return True, or return False when its filesystem is too full.
+        `scheduled`, the start of its at job, keys the reservation, so that
+        scheduling it again replaces it; `start` is used instead without it.
+        """
+        root = output_root(self.constants, provider, save)
+        needed = self.bitrates.estimate_bytes(provider, channel, duration)
+        now = time.time()
+
+        try:
+            with locked_json(self.path, []) as reservations:
+                key = scheduled if scheduled is not None else start
+                # Drop expired reservations and the one of a rescheduled programme.
+                reservations[:] = [
+                    entry for entry in reservations
+                    if entry["end"] + EXPIRY_GRACE > now
+                    and (entry["title"], entry["save"], entry.get("scheduled", entry["start"])) != (title, save, key)
+                ]
+                available = self.available(root, reservations, now)
+                if needed > available:
+                    evicted = self.evictable(title, save, root, reservations, needed - available, now)
+                    if not evicted:
+                        logging.warning(
+                            "Espace disque insuffisant dans %s pour l'enregistrement %s de %s: "
+                            "%d Mo nécessaires, %d Mo disponibles.",
+                            root, save, title, needed // 2**20, max(available, 0) // 2**20,
+                        )
+                        return False
+                    for entry in evicted:
+                        logging.warning(
+                            "L'enregistrement %s de %s perd son espace disque au profit de l'enregistrement %s de %s.",
+                            entry["save"], entry["title"], save, title,
+                        )
+                        reservations.remove(entry)
+                    available = self.available(root, reservations, now)
+                reservations.append({
+                    "title": title,
+                    "save": save,
+                    "root": str(root),
+                    "bytes": needed,
+                    "start": start,
+                    "end": start + duration,
+                    "scheduled": key,
+                })
+        except Exception:
+            # Never lose a recording because the bookkeeping failed.
+            logging.exception("Disk admission failed for %s %s; admitting it", title, save)
+            return True
+
+        logging.info(
+            "Enregistrement %s de %s admis: %d Mo réservés dans %s (%d Mo restants).",
+            save, title, needed // 2**20, root, (available - needed) // 2**20,
+        )
+        return True
+
+    def release(self, title: str, save: str) -> dict:
+        """
+        Drop the reservation of `title` for the role `save` whose start is the
+        closest to now, and return it (empty dict when there was none).
+        """
+        now = time.time()
+        try:
+            with locked_json(self.path, []) as reservations:
+                matches = [
+                    entry for entry in reservations
+                    if entry["title"] == title and entry["save"] == save
+                ]
+                if not matches:
+                    return {}
+                entry = min(matches, key=lambda e: abs(e["start"] - now))
+                reservations.remove(entry)
+                return entry
+        except Exception:
+            logging.exception("Failed to release reservation of %s %s", title, save)
+            return {}
+
+    def confirm(self, title: str, save: str, provider: str, channel: str, duration: int) -> bool:
+        """
+        Check again, when the recording starts, that the space reserved at
+        scheduling time is still available for the remaining `duration`.
+        """
+        entry = self.release(title, save)
+        return self.admit(title, save, provider, channel, time.time(), duration, entry.get("scheduled"))
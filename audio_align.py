@@ -0,0 +1,109 @@
+import logging
+import subprocess
+
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+# Mono 8 kHz is plenty to match speech and music, to the 1/8 ms.
+SAMPLE_RATE = 8000
+DEFAULT_WINDOW_SECONDS = 8
+DEFAULT_MAX_LAG_SECONDS = 30
+DEFAULT_MIN_SCORE = 0.5
+FFMPEG_TIMEOUT = 30
+
+
+def decode_pair(ref_path: Path, ref_start: float, ref_duration: float,
+                probe_path: Path, probe_start: float, probe_duration: float) -> Optional[tuple]:
+    """
+    Decode, in a single ffmpeg call, the first audio stream of two files
+    from their timestamps `ref_start` and `probe_start`, as mono PCM at
+    SAMPLE_RATE. Both are merged into the two channels of one raw output,
+    the probe padded with silence to the length of the reference. Return
+    the (reference, probe) samples, or None when ffmpeg fails.
+    """
+    resample = f"aresample={SAMPLE_RATE},aformat=sample_fmts=s16:channel_layouts=mono"
+    cmd = [
+        "ffmpeg", "-v", "error", "-nostdin",
+        "-seek_timestamp", "1", "-ss", f"{ref_start:.3f}", "-t", f"{ref_duration:.3f}",
+        "-i", str(ref_path),
+        "-seek_timestamp", "1", "-ss", f"{probe_start:.3f}", "-t", f"{probe_duration:.3f}",
+        "-i", str(probe_path),
+        "-filter_complex",
+        f"[0:a:0]{resample}[ref];[1:a:0]{resample},apad[probe];[ref][probe]amerge=inputs=2[out]",
+        "-map", "[out]", "-f", "s16le", "-ac", "2", "pipe:1",
+    ]
+    try:
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=FFMPEG_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        logging.exception("Failed to decode audio from %s and %s", ref_path, probe_path)
+        return None
+    if process.returncode != 0:
+        logging.warning("ffmpeg failed to decode audio: %s", process.stderr.decode("utf-8", errors="ignore"))
+        return None
+    samples = np.frombuffer(process.stdout, dtype="<i2")
+    samples = samples[:len(samples) // 2 * 2].reshape(-1, 2)
+    probe_length = round(probe_duration * SAMPLE_RATE)
+    return samples[:, 0], samples[:probe_length, 1]
+
+
+def best_lag(ref: np.ndarray, probe: np.ndarray) -> Optional[tuple]:
+    """
+    Return (lag, score) of the position of `probe` inside `ref`, in
+    samples, where their normalised cross-correlation, computed by FFT, is
+    highest. The score goes from -1 to 1. Return None when `probe` does not
+    fit in `ref` or is silent.
+    """
+    if len(probe) == 0 or len(ref) < len(probe):
+        return None
+    ref = ref.astype(np.float64)
+    probe = probe.astype(np.float64)
+    probe -= probe.mean()
+    probe_norm = np.sqrt(np.dot(probe, probe))
+    if probe_norm == 0:
+        return None
+
+    size = 1 << (len(ref) + len(probe) - 1).bit_length()
+    correlation = np.fft.irfft(np.fft.rfft(ref, size) * np.conj(np.fft.rfft(probe, size)), size)
+    lags = len(ref) - len(probe) + 1
+    correlation = correlation[:lags]
+
+    # Energy of each reference window the probe is compared with.
+    squares = np.concatenate(([0.0], np.cumsum(ref * ref)))
+    sums = np.concatenate(([0.0], np.cumsum(ref)))
+    energy = squares[len(probe):] - squares[:lags]
+    energy -= (sums[len(probe):] - sums[:lags]) ** 2 / len(probe)
+    scores = correlation / (probe_norm * np.sqrt(np.maximum(energy, 1e-9)))
+    lag = int(np.argmax(scores))
+    return lag, float(scores[lag])
+
+
+def audio_offset(ref_path: Path, ref_time: float, ref_first: float,
+                 probe_path: Path, probe_time: float,
+                 window: float = DEFAULT_WINDOW_SECONDS,
+                 max_lag: float = DEFAULT_MAX_LAG_SECONDS,
+                 min_score: float = DEFAULT_MIN_SCORE) -> Optional[float]:
+    """
+    Return how many seconds after `ref_time` the audio heard in `probe_path`
+    at `probe_time` is found in `ref_path`, both times being timestamps of
+    their own file, or None when no match scores at least `min_score`.
+    `window` seconds of the probe are searched within `max_lag` seconds on
+    either side of `ref_time`, not before `ref_first`, the first timestamp
+    of the reference.
+    """
+    ref_start = max(ref_time - max_lag, ref_first)
+    ref_duration = ref_time + max_lag + window - ref_start
+    decoded = decode_pair(ref_path, ref_start, ref_duration, probe_path, probe_time, window)
+    if decoded is None:
+        return None
+    found = best_lag(*decoded)
+    if found is None:
+        return None
+    lag, score = found
+    if score < min_score:
+        logging.info(
+            "No audio match for %s at %.3f in %s (score %.2f)", probe_path, probe_time, ref_path, score
+        )
+        return None
+    return round(ref_start + lag / SAMPLE_RATE - ref_time, 4)
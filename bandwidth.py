@@ -0,0 +1,163 @@
+import logging
+import os
+import re
+import time
+import urllib.request
+
+from configparser import ConfigParser
+from pathlib import Path
+from urllib.parse import urljoin
+
+import psutil
+
+from recording_storage import DATA_DIR, config_int, locked_json
+
+ACTIVE_PATH = DATA_DIR / "bandwidth.json"
+
+# Originals are served first, then backups, then second backups.
+ROLE_RANK = {"original": 0, "backup": 1, "backup_2": 2}
+
+PLAYLIST_TIMEOUT = 10
+
+ATTRIBUTE = re.compile(r'([A-Za-z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_attributes(line: str) -> dict:
+    """Parse the attribute list of an #EXT-X tag (commas may appear in quotes)."""
+    _, _, body = line.partition(":")
+    return {
+        key.upper(): value.strip('"')
+        for key, value in ATTRIBUTE.findall(body)
+    }
+
+
+def parse_master_playlist(text: str, base_url: str) -> list:
+    """
+    Return the variants of an HLS master playlist as (bandwidth in bit/s,
+    absolute URL) tuples sorted by bandwidth. A media playlist has none.
+    """
+    variants = []
+    pending = None
+    for raw in text.splitlines():
+        line = raw.strip()
+        if line.startswith("#EXT-X-STREAM-INF"):
+            attributes = parse_attributes(line)
+            try:
+                pending = int(attributes.get("BANDWIDTH", "0"))
+            except ValueError:
+                pending = None
+        elif line and not line.startswith("#") and pending is not None:
+            variants.append((pending, urljoin(base_url, line)))
+            pending = None
+    return sorted(set(variants))
+
+
+def fetch_variants(url: str) -> list:
+    """Download `url` and return its HLS variants (empty for other streams)."""
+    if not url.startswith(("http://", "https://")):
+        return []
+    try:
+        request = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
+        with urllib.request.urlopen(request, timeout=PLAYLIST_TIMEOUT) as response:
+            head = response.read(512 * 1024)
+            final_url = response.geturl()
+    except Exception as e:
+        logging.info("Could not read HLS variants of %s: %s", url, e)
+        return []
+    if not head.lstrip().startswith(b"#EXTM3U"):
+        return []
+    return parse_master_playlist(head.decode("utf-8", errors="replace"), final_url)
+
+
+def allocate(entries: dict, budget: int) -> dict:
+    """
+    Share `budget` (bit/s) between the active recordings.
+
+    Recordings without variants count for their expected bitrate. Every HLS
+    recording first gets its lowest variant, then, in priority order, is
+    upgraded to the highest variant that still fits in the budget.
+    Return the bandwidth chosen for each HLS recording.
+    """
+    order = sorted(
+        entries.items(),
+        key=lambda item: (ROLE_RANK.get(item[1]["save"], len(ROLE_RANK)), item[1]["started"]),
+    )
+    used = sum(entry["rate"] for entry in entries.values() if not entry["variants"])
+    chosen = {}
+    for key, entry in order:
+        if entry["variants"]:
+            chosen[key] = entry["variants"][0]
+            used += chosen[key]
+    for key, entry in order:
+        for bandwidth in reversed(entry["variants"]):
+            if bandwidth <= chosen[key]:
+                break
+            if used - chosen[key] + bandwidth <= budget:
+                used += bandwidth - chosen[key]
+                chosen[key] = bandwidth
+                break
+    return chosen
+
+
+class BandwidthBudget:
+    """
+    Box-wide download budget shared by every record_iptv.py.
+
+    Each recorder registers its role and the HLS variants it may use in a
+    JSON file; all of them run the same deterministic allocation so that
+    the total expected bitrate of the active recordings stays under
+    [BANDWIDTH] budget_kbps. The share of each recording changes whenever
+    a recording starts or ends.
+    """
+
+    def __init__(self, constants: ConfigParser, save: str, path: Path = ACTIVE_PATH):
+        self.path = path
+        self.save = save
+        self.key = str(os.getpid())
+        self.budget = config_int(constants, "BANDWIDTH", "budget_kbps", 0) * 1000
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def register(self, variants: list, rate: int):
+        """
+        Declare this recording, its variant bandwidths and expected bitrate
+        (bit/s). Registering again keeps its place in the allocation order.
+        """
+        try:
+            with locked_json(self.path, {}) as entries:
+                entries[self.key] = {
+                    "save": self.save,
+                    "started": entries.get(self.key, {}).get("started", time.time()),
+                    "variants": sorted(variants),
+                    "rate": int(rate),
+                }
+        except Exception:
+            logging.exception("Failed to register in bandwidth budget %s", self.path)
+
+    def choose(self):
+        """
+        Return the variant bandwidth this recording may use now, or None when
+        it has no variants or the budget could not be computed.
+        """
+        try:
+            with locked_json(self.path, {}) as entries:
+                for key in list(entries):
+                    if not psutil.pid_exists(int(key)):
+                        del entries[key]
+                if self.key not in entries:
+                    return None
+                chosen = allocate(entries, self.budget)
+        except Exception:
+            logging.exception("Failed to compute bandwidth budget %s", self.path)
+            return None
+        return chosen.get(self.key)
+
+    def unregister(self):
+        """Remove this recording from the budget."""
+        try:
+            with locked_json(self.path, {}) as entries:
+                entries.pop(self.key, None)
+        except Exception:
+            logging.exception("Failed to unregister from bandwidth budget %s", self.path)
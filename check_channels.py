@@ -11,6 +11,10 @@ import re
 from datetime import datetime
 from pathlib import Path
 
+from priorities import apply_priority
+from recording_storage import load_constants
+from stream_select import stream_selection
+
 user = os.environ.get("USER")
 if not user or "/" in user or "\\" in user:
     logging.error("Invalid or undefined USER environment variable.")
@@ -26,6 +30,9 @@ logging.basicConfig(
     filemode="a",
 )
 
+constants = load_constants()
+apply_priority(constants, "check")
+
 # ---------------- Argument Parsing ----------------
 parser = argparse.ArgumentParser()
 parser.add_argument("iptv_provider")
@@ -182,7 +189,7 @@ for line in lines_to_check:
             if provider_recorder == 1:
                 cmd = [
                     "ffmpeg", "-y", "-i", split[1],
-                    "-map", "0:v", "-map", "0:a", "-map", "0:s?",
+                    *stream_selection(constants, split[0], split[1]).ffmpeg_maps(),
                     "-c:v", "copy", "-c:a", "copy", "-c:s", "copy",
                     "-t", "60",
                     "-f", "mpegts",
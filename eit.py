@@ -0,0 +1,396 @@
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from pathlib import Path
+from typing import Optional
+
+from recording_storage import DATA_DIR, locked_json, read_json
+from ts_packets import (
+    SYNC_BYTE,
+    TS_PACKET_SIZE,
+    SectionAssembler,
+    packet_offset,
+    packet_pid,
+)
+
+PROGRAMMES_PATH = DATA_DIR / "programmes.json"
+
+PAT_PID = 0x00
+EIT_PID = 0x12
+TABLE_PAT = 0x00
+# Event information, present/following of the actual transport stream.
+TABLE_EIT_PF = 0x4E
+SHORT_EVENT_DESCRIPTOR = 0x4D
+
+# Modified Julian Date of 1970-01-01.
+MJD_UNIX_EPOCH = 40587
+
+# ffmpeg (4.4 and later) exposes the EIT as a data stream; these options
+# keep it in the recorded file.
+FFMPEG_ARGS = ["-map", "0:d?", "-c:d", "copy"]
+
+DEFAULT_MARGIN_MINUTES = 2
+DEFAULT_MAX_EXTEND_MINUTES = 30
+DEFAULT_MAX_TRIM_MINUTES = 15
+
+POLL_INTERVAL = 1
+READ_SIZE = TS_PACKET_SIZE * 5572
+
+
+def _crc_table() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc32_mpeg(data: bytes) -> int:
+    """CRC-32/MPEG-2 of PSI sections; a section with its CRC appended gives 0."""
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def bcd(byte: int) -> int:
+    return (byte >> 4) * 10 + (byte & 0x0F)
+
+
+def decode_start(raw) -> Optional[float]:
+    """Return the epoch of a 40-bit MJD + BCD UTC time, or None when undefined."""
+    if all(b == 0xFF for b in raw):
+        return None
+    mjd = raw[0] << 8 | raw[1]
+    return (mjd - MJD_UNIX_EPOCH) * 86400 + bcd(raw[2]) * 3600 + bcd(raw[3]) * 60 + bcd(raw[4])
+
+
+def decode_duration(raw) -> int:
+    """Return the seconds of a 24-bit BCD duration."""
+    return bcd(raw[0]) * 3600 + bcd(raw[1]) * 60 + bcd(raw[2])
+
+
+# ISO/IEC 6937, the default DVB character table, puts diacritics before the letter.
+ISO6937_DIACRITICS = {
+    0xC1: "\u0300", 0xC2: "\u0301", 0xC3: "\u0302", 0xC4: "\u0303", 0xC5: "\u0304",
+    0xC6: "\u0306", 0xC7: "\u0307", 0xC8: "\u0308", 0xCA: "\u030A", 0xCB: "\u0327",
+    0xCD: "\u030B", 0xCE: "\u0328", 0xCF: "\u030C",
+}
+
+
+def decode_iso6937(raw: bytes) -> str:
+    chars = []
+    diacritic = None
+    for byte in raw:
+        if byte in ISO6937_DIACRITICS:
+            diacritic = ISO6937_DIACRITICS[byte]
+            continue
+        if byte < 0x20 or 0x80 <= byte < 0xA0:
+            # Control and emphasis codes.
+            char = " " if byte == 0x8A else ""
+        else:
+            char = bytes([byte]).decode("latin-1")
+        if diacritic and char:
+            char = unicodedata.normalize("NFC", char + diacritic)
+        diacritic = None
+        chars.append(char)
+    return "".join(chars)
+
+
+def decode_text(raw: bytes) -> str:
+    """Decode a DVB string (EN 300 468 annex A), whose first byte may select its character table."""
+    if not raw:
+        return ""
+    first = raw[0]
+    try:
+        if first >= 0x20:
+            text = decode_iso6937(raw)
+        elif 0x01 <= first <= 0x0B:
+            text = raw[1:].decode(f"iso8859-{first + 4}", errors="replace")
+        elif first == 0x10 and len(raw) >= 3:
+            text = raw[3:].decode(f"iso8859-{raw[2]}", errors="replace")
+        elif first == 0x11:
+            text = raw[1:].decode("utf-16-be", errors="replace")
+        elif first == 0x15:
+            text = raw[1:].decode("utf-8", errors="replace")
+        else:
+            text = raw[1:].decode("latin-1")
+    except LookupError:
+        text = raw[1:].decode("latin-1")
+    return "".join(ch for ch in text if ch.isprintable()).strip()
+
+
+def parse_events(section: bytes) -> list:
+    """Return the events of an EIT section as dicts: event_id, start, duration, running, name."""
+    events = []
+    position = 14
+    end = len(section) - 4
+    while position + 12 <= end:
+        event_id = section[position] << 8 | section[position + 1]
+        start = decode_start(section[position + 2:position + 7])
+        duration = decode_duration(section[position + 7:position + 10])
+        running = section[position + 10] >> 5
+        loop_length = (section[position + 10] & 0x0F) << 8 | section[position + 11]
+        position += 12
+        name = ""
+        loop_end = min(position + loop_length, end)
+        while position + 2 <= loop_end:
+            tag, length = section[position], section[position + 1]
+            body = section[position + 2:position + 2 + length]
+            if tag == SHORT_EVENT_DESCRIPTOR and len(body) >= 4 and not name:
+                name = decode_text(body[4:4 + body[3]])
+            position += 2 + length
+        position = loop_end
+        events.append({
+            "event_id": event_id, "start": start, "duration": duration,
+            "running": running, "name": name,
+        })
+    return events
+
+
+class EitParser:
+    """
+    Follow the DVB EIT present/following table of the programme carried by
+    MPEG-TS data fed in arbitrary chunks.
+
+    Only sections of one service are kept: the programme of the PAT, or
+    the first service met when the PAT does not name it (ffmpeg rewrites
+    the PAT with its own service id but copies the EIT as is).
+    """
+
+    def __init__(self):
+        self.pending = b""
+        self.synced = False
+        self.assemblers = {PAT_PID: SectionAssembler(), EIT_PID: SectionAssembler()}
+        self.programs = set()
+        self.service_id = None
+        self.confirmed = False
+        self.versions = {}
+        # Section 0 holds the present event, section 1 the following one.
+        self.present = None
+        self.following = None
+
+    def feed(self, data: bytes) -> bool:
+        """Return True when the present or following event changed."""
+        buffer = self.pending + data
+        view = memoryview(buffer)
+        changed = False
+        position = 0
+        while len(buffer) - position >= TS_PACKET_SIZE:
+            if not self.synced or buffer[position] != SYNC_BYTE:
+                found = packet_offset(view[position:position + TS_PACKET_SIZE * 5])
+                if found < 0:
+                    if len(buffer) - position < TS_PACKET_SIZE * 5:
+                        break
+                    position += TS_PACKET_SIZE
+                    continue
+                position += found
+                self.synced = True
+                continue
+            packet = view[position:position + TS_PACKET_SIZE]
+            position += TS_PACKET_SIZE
+            assembler = self.assemblers.get(packet_pid(packet))
+            if assembler is None:
+                continue
+            for section in assembler.feed(packet):
+                changed |= self.handle(section)
+        self.pending = bytes(view[position:])
+        return changed
+
+    def handle(self, section: bytes) -> bool:
+        table_id = section[0]
+        if table_id not in (TABLE_PAT, TABLE_EIT_PF) or len(section) < 12:
+            return False
+        if crc32_mpeg(section) != 0:
+            return False
+        if table_id == TABLE_PAT:
+            self.programs = {
+                section[i] << 8 | section[i + 1]
+                for i in range(8, len(section) - 4, 4)
+                if section[i] << 8 | section[i + 1]
+            }
+            return False
+
+        service_id = section[3] << 8 | section[4]
+        if not self.confirmed and service_id in self.programs:
+            self.service_id, self.confirmed = service_id, True
+        elif self.service_id is None:
+            self.service_id = service_id
+        if service_id != self.service_id or section[6] > 1:
+            return False
+        version = (section[5] >> 1) & 0x1F
+        if self.versions.get(section[6]) == version:
+            return False
+        self.versions[section[6]] = version
+        events = parse_events(section)
+        event = events[0] if events else None
+        if section[6] == 0:
+            self.present = event
+        else:
+            self.following = event
+        return True
+
+
+def title_key(title: str) -> str:
+    """Return a title folded for comparison: no accents, case or punctuation."""
+    text = unicodedata.normalize("NFKD", title.replace("_", " "))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+    return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+
+def same_programme(name: str, title: str) -> bool:
+    name, title = title_key(name), title_key(title)
+    if not name or not title:
+        return False
+    shorter, longer = sorted((name, title), key=len)
+    return shorter == longer or (len(shorter) >= 4 and shorter in longer)
+
+
+class ProgrammeTracker:
+    """
+    Find the broadcast of a programme in the present/following events and
+    its real boundaries. The switch of the present event is the moment the
+    broadcaster starts or ends the programme; until it ends, its end is the
+    one announced, updated with each new version of the table.
+    """
+
+    def __init__(self, title: str):
+        self.title = title
+        self.event_id = None
+        self.name = ""
+        self.start = None
+        self.end = None
+        self.ended = False
+        self.announced = False
+
+    def update(self, present: Optional[dict], following: Optional[dict], now: float) -> bool:
+        """Return True when the boundaries changed."""
+        before = (self.start, self.end)
+        if self.event_id is None:
+            for event in (present, following):
+                if event and same_programme(event["name"], self.title):
+                    self.event_id, self.name = event["event_id"], event["name"]
+                    break
+            else:
+                return False
+
+        if present and present["event_id"] == self.event_id:
+            if self.start is None:
+                # Seen becoming present: now is its real start.
+                self.start = now if self.announced or present["start"] is None else present["start"]
+            if present["start"] is not None and present["duration"]:
+                self.end = present["start"] + present["duration"]
+        elif self.start is not None:
+            # Another event is present: the programme is over.
+            if present is not None and not self.ended:
+                self.end, self.ended = now, True
+        elif following and following["event_id"] == self.event_id:
+            self.announced = True
+            if following["start"] is not None and following["duration"]:
+                self.end = following["start"] + following["duration"]
+        return (self.start, self.end) != before
+
+    def boundaries(self) -> Optional[dict]:
+        if self.event_id is None:
+            return None
+        return {
+            "name": self.name, "event_id": self.event_id,
+            "start": self.start, "end": self.end, "final": self.ended,
+        }
+
+
+class EitWatcher(threading.Thread):
+    """
+    Parse the EIT of the segments of a recording as its recorder writes
+    them, from the page cache, and track the real boundaries of the
+    programme. `follow` moves to the file of a new segment.
+    """
+
+    def __init__(self, title: str):
+        super().__init__(daemon=True)
+        self.tracker = ProgrammeTracker(title)
+        self.lock = threading.Lock()
+        self.path = None
+        self.stopping = threading.Event()
+        self.changed = False
+
+    def follow(self, path: Path):
+        with self.lock:
+            self.path = Path(path)
+
+    def stop(self):
+        self.stopping.set()
+
+    def boundaries(self) -> Optional[dict]:
+        """Return the boundaries found, once per change, or None."""
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+            return self.tracker.boundaries()
+
+    def run(self):
+        try:
+            self.watch()
+        except Exception:
+            logging.exception("EIT watch failed")
+
+    def watch(self):
+        path, src, parser = None, None, None
+        try:
+            while not self.stopping.is_set():
+                with self.lock:
+                    wanted = self.path
+                if wanted != path:
+                    if src is not None:
+                        src.close()
+                        src = None
+                    try:
+                        src = open(wanted, "rb")
+                    except (OSError, TypeError):
+                        self.stopping.wait(POLL_INTERVAL)
+                        continue
+                    path, parser = wanted, EitParser()
+                data = src.read(READ_SIZE)
+                if not data:
+                    self.stopping.wait(POLL_INTERVAL)
+                    continue
+                if parser.feed(data):
+                    with self.lock:
+                        if self.tracker.update(parser.present, parser.following, time.time()):
+                            self.changed = True
+        finally:
+            if src is not None:
+                src.close()
+
+
+# ----- boundaries shared by the roles of a programme -----
+def publish_programme(title: str, boundaries: dict, registry: Path = PROGRAMMES_PATH):
+    """Share the boundaries of `title` found by one of its recordings."""
+    try:
+        with locked_json(registry, {}) as programmes:
+            programmes[title] = dict(boundaries, pid=os.getpid())
+    except Exception:
+        logging.exception("Failed to publish programme boundaries in %s", registry)
+
+
+def published_programme(title: str, registry: Path = PROGRAMMES_PATH) -> Optional[dict]:
+    return read_json(registry, {}).get(title)
+
+
+def withdraw_programme(title: str, registry: Path = PROGRAMMES_PATH):
+    try:
+        with locked_json(registry, {}) as programmes:
+            if programmes.get(title, {}).get("pid") == os.getpid():
+                del programmes[title]
+    except Exception:
+        logging.exception("Failed to withdraw programme boundaries from %s", registry)
@@ -0,0 +1,151 @@
+import logging
+import os
+
+from configparser import ConfigParser
+from pathlib import Path
+
+import psutil
+
+from recording_storage import DATA_DIR, locked_json, read_json
+
+SOURCES_PATH = DATA_DIR / "sources.json"
+PROVIDERS_DIR = Path.home() / ".config" / "iptvselect-fr" / "iptv_providers"
+CONFIG_KEYS = ["iptv_provider", "iptv_backup", "iptv_backup_2"]
+
+DEFAULT_MAX_FAILURES = 2
+# Seconds without data before a source is found stalled.
+DEFAULT_SOURCE_STALL_SECONDS = 20
+
+
+def channel_link(provider_file: Path, channel: str) -> str:
+    """Return the m3u link of `channel` in a provider .ini file, or ''."""
+    config = ConfigParser(interpolation=None)
+    try:
+        config.read(provider_file)
+        return config.get("CHANNELS", channel, fallback="").strip()
+    except Exception:
+        logging.exception("Failed to read provider config %s", provider_file)
+        return ""
+
+
+def configured_providers(config_iptv_select: ConfigParser) -> list:
+    """Return the providers of iptv_select_conf.ini, in order of appearance."""
+    providers = []
+    for key in config_iptv_select.keys():
+        if str(key) == "DEFAULT":
+            continue
+        for iptv_function in CONFIG_KEYS:
+            provider = config_iptv_select[str(key)].get(iptv_function, "")
+            if provider and provider not in providers:
+                providers.append(provider)
+    return providers
+
+
+def publish_source(provider: str, relayed: bool = False, path: Path = SOURCES_PATH):
+    """
+    Record the provider this process currently reads its channel from, and
+    whether it reads it through the local relay, whose line is its own.
+    """
+    try:
+        with locked_json(path, {}) as sources:
+            for pid in list(sources):
+                if not psutil.pid_exists(int(pid)):
+                    del sources[pid]
+            sources[str(os.getpid())] = {"provider": provider, "relayed": relayed}
+    except Exception:
+        logging.exception("Failed to publish source in %s", path)
+
+
+def withdraw_source(path: Path = SOURCES_PATH):
+    try:
+        with locked_json(path, {}) as sources:
+            sources.pop(str(os.getpid()), None)
+    except Exception:
+        logging.exception("Failed to withdraw source from %s", path)
+
+
+def published_sources(path: Path = SOURCES_PATH) -> dict:
+    """Return the current source of each running recorder, by pid."""
+    return {
+        int(pid): source for pid, source in read_json(path, {}).items()
+        if psutil.pid_exists(int(pid))
+    }
+
+
+class SourceCandidates:
+    """
+    Ordered list of sources a recording may read its channel from.
+
+    The scheduled link comes first, then the provider's entry of
+    <provider>_original_m3ulinks.ini when it differs, then the same channel
+    on the other configured providers. After `max_failures` failed restarts
+    in a row, or at once when the source stalls, the recording moves on to
+    the next source; the source of each segment is written to the
+    recording manifest.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        channel: str,
+        link: str,
+        config_iptv_select: ConfigParser,
+        max_failures: int = DEFAULT_MAX_FAILURES,
+        providers_dir: Path = PROVIDERS_DIR,
+    ):
+        self.max_failures = max_failures
+        self.failures = 0
+        self.index = 0
+        self.sources = [(provider, "scheduled", link)]
+        if not channel:
+            return
+
+        candidates = [(provider, "original_m3ulinks", providers_dir / f"{provider}_original_m3ulinks.ini")]
+        for other in configured_providers(config_iptv_select):
+            if other != provider:
+                candidates.append((other, "provider", providers_dir / f"{other}.ini"))
+
+        seen = {link}
+        for source_provider, origin, provider_file in candidates:
+            url = channel_link(provider_file, channel)
+            if url and url not in seen:
+                seen.add(url)
+                self.sources.append((source_provider, origin, url))
+
+    @property
+    def provider(self) -> str:
+        return self.sources[self.index][0]
+
+    @property
+    def origin(self) -> str:
+        return self.sources[self.index][1]
+
+    @property
+    def url(self) -> str:
+        return self.sources[self.index][2]
+
+    def success(self):
+        """The current source delivers data."""
+        self.failures = 0
+
+    def failure(self, usable=lambda provider: True, stalled: bool = False) -> bool:
+        """
+        Count a failed (re)start of the current source and return True when
+        the recording switched to the next source accepted by `usable`. A
+        `stalled` source is left without waiting for `max_failures`.
+        """
+        self.failures += 1
+        if self.failures < self.max_failures and not stalled:
+            return False
+        for index in range(self.index + 1, len(self.sources)):
+            if usable(self.sources[index][0]):
+                logging.warning(
+                    "Bascule de la source %s (%s) vers %s (%s) après %d échecs",
+                    self.provider, self.origin,
+                    self.sources[index][0], self.sources[index][1], self.failures,
+                )
+                self.index = index
+                self.failures = 0
+                return True
+        return False
+
@@ -0,0 +1,317 @@
+import logging
+import os
+import time
+
+from pathlib import Path
+from typing import Callable, Optional
+
+from interval_cover import cover_intervals
+from recording_manifest import read_manifest
+from recording_storage import DATA_DIR, locked_json, read_json
+from ts_index import keyframe_after, read_index
+from ts_packets import PTS_CLOCK, PTS_WRAP, TS_PACKET_SIZE
+from ts_probe import probe_ts
+from ts_seek import build_packet_index
+from ts_splice import TsSplicer, pid_map, program_tables, signed_pts
+
+FUSION_STATE_DIR = DATA_DIR / "fusion"
+POLL_INTERVAL = 5
+# Seconds waited after the planned end for recorders that never close.
+GRACE_SECONDS = 1800
+# Closed segments shorter than this are failed starts.
+MIN_SEGMENT_SECONDS = 80
+
+
+def fusion_state_path(safe_title: str) -> Path:
+    return FUSION_STATE_DIR / f"{safe_title}.json"
+
+
+def live_fusion_state(safe_title: str) -> dict:
+    """Return the state of the incremental fusion of a title, empty when none ran."""
+    return read_json(fusion_state_path(safe_title), {})
+
+
+def pid_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except (OSError, TypeError):
+        return False
+    return True
+
+
+def first_time(segment: dict) -> Optional[float]:
+    """Return the first timestamp of a segment in seconds, from its manifest clock or its head."""
+    if segment["pts"] is not None:
+        return segment["pts"] / PTS_CLOCK
+    probed = probe_ts(segment["path"])
+    return probed[0] / 1000 if probed is not None else None
+
+
+def last_time(path: Path) -> Optional[float]:
+    """Return the last video timestamp of a segment in seconds."""
+    probed = probe_ts(path)
+    if probed is None:
+        return None
+    return (probed[0] + probed[1]) / 1000 % (PTS_WRAP / PTS_CLOCK)
+
+
+def next_keyframe(path: Path, seconds: float) -> Optional[tuple]:
+    """
+    Return (byte offset, seconds) of the first keyframe of a segment at or
+    after `seconds`, from its sidecar index while it is being recorded, or
+    from a scan of the file.
+    """
+    index = read_index(path)
+    if index is not None and index["keyframes"]:
+        found = keyframe_after(index, round(seconds * PTS_CLOCK) % PTS_WRAP)
+        return (found[0], found[1] / PTS_CLOCK) if found is not None else None
+    packet_index = build_packet_index(path)
+    if packet_index is None:
+        return None
+    return packet_index.keyframe_after(seconds)
+
+
+class LiveFusion:
+    """
+    Fuse the segments of a recording into the to-watch file while they are
+    being recorded.
+
+    The output follows one segment at a time, appending its new packets at
+    each poll. When that segment closes, the output moves to the next
+    segment of the cover_intervals chain of the segments known by then, as
+    the batch fusion chooses them, from its first keyframe past the end of
+    the previous one. Timestamps and continuity counters are carried across
+    like in a splice. The selection and the position in the output are kept
+    in a state file, so an interrupted fusion resumes where it was.
+    """
+
+    def __init__(self, safe_title: str, roles: list, output: Path, until: float,
+                 correction: Optional[Callable] = None):
+        self.roles = roles  # (manifest path, save)
+        self.output = Path(output)
+        self.until = until
+        self.correction = correction
+        self.state_path = fusion_state_path(safe_title)
+        self.state = {"pid": os.getpid(), "done": False, "output": str(self.output),
+                      "bytes": 0, "counters": {}, "pieces": [], "gaps": []}
+        self.base = None
+        self.mapping = None
+        self.splicer = None
+
+    def segments(self) -> list:
+        found = []
+        for path, save in self.roles:
+            for segment in read_manifest(path):
+                segment["save"] = save
+                segment["key"] = f"{save}:{segment['segment']}"
+                found.append(segment)
+        return found
+
+    def resume(self):
+        """Take over the state of an interrupted fusion of the same output."""
+        state = read_json(self.state_path, {})
+        pieces = state.get("pieces")
+        if not pieces or state.get("done") or state.get("output") != str(self.output):
+            return
+        try:
+            size = self.output.stat().st_size
+        except OSError:
+            return
+        if size < state["bytes"]:
+            return
+        self.base = program_tables(Path(pieces[0]["path"]))
+        if self.base is None:
+            return
+        if len(pieces) > 1:
+            tables = program_tables(Path(pieces[-1]["path"]))
+            self.mapping = pid_map(self.base, tables) if tables is not None else None
+            if self.mapping is None:
+                return
+        state.update(pid=os.getpid())
+        state["counters"] = {int(pid): counter for pid, counter in state["counters"].items()}
+        self.state = state
+        logging.info("Fusion of %s resumed at %d bytes", self.output, state["bytes"])
+
+    def save(self):
+        if self.splicer is not None:
+            self.state.update(bytes=self.splicer.bytes_written, counters=self.splicer.counters)
+        self.state["updated"] = round(time.time(), 3)
+        try:
+            with locked_json(self.state_path, {}) as state:
+                state.clear()
+                state.update(self.state)
+        except Exception:
+            logging.exception("Failed to save the fusion state %s", self.state_path)
+
+    def start(self, segments: list) -> bool:
+        """Start the output with the first segment holding timestamps and tables."""
+        eligible = [segment for segment in segments if first_time(segment) is not None]
+        if not eligible:
+            return False
+        first = min(eligible, key=lambda segment: segment["start"])
+        self.base = program_tables(first["path"])
+        if self.base is None:
+            return False
+        self.mapping = None
+        self.state["pieces"].append({
+            "key": first["key"], "path": str(first["path"]), "start": 0, "position": 0,
+            "delta": 0, "wall_start": first["start"], "first_ts": first_time(first),
+        })
+        logging.info("Fusion en direct de %s démarrée sur %s", self.output.name, first["path"].name)
+        return True
+
+    def follow(self, segments: list, now: float) -> bool:
+        """
+        Append the new packets of the current segment, then move to the next
+        one when it is closed. Return False when the streams cannot be joined.
+        """
+        pieces = self.state["pieces"]
+        while True:
+            piece = pieces[-1]
+            piece["position"] = self.splicer.append(
+                Path(piece["path"]), piece["position"], None, self.mapping, piece["delta"]
+            )
+            current = next((segment for segment in segments if segment["key"] == piece["key"]), None)
+            if current is None or current["end"] is None:
+                return True
+            count = len(pieces)
+            if not self.switch(current, segments, now):
+                return False
+            if len(pieces) == count:
+                return True
+
+    def switch(self, current: dict, segments: list, now: float) -> bool:
+        piece = self.state["pieces"][-1]
+        fused = {p["key"] for p in self.state["pieces"]}
+        candidates = []
+        for segment in segments:
+            end = segment["end"] if segment["end"] is not None else now
+            if segment["key"] in fused or end <= current["end"]:
+                continue
+            if segment["end"] is not None and end - segment["start"] < MIN_SEGMENT_SECONDS:
+                continue
+            if first_time(segment) is None:
+                continue
+            candidates.append(segment)
+        if not candidates:
+            return True
+        # The cover of the batch fusion, over the segments known so far and
+        # from the current one, those being recorded lasting until now.
+        intervals = [(current["start"], current["end"], current["save"])] + [
+            (segment["start"], segment["end"] if segment["end"] is not None else now, segment["save"])
+            for segment in candidates
+        ]
+        chain, _ = cover_intervals(intervals)
+        chosen = candidates[next(i for i in chain if i > 0) - 1]
+
+        tables = program_tables(chosen["path"])
+        mapping = pid_map(self.base, tables) if tables is not None else None
+        if mapping is None:
+            logging.info("Streams of %s cannot follow the fused output", chosen["path"])
+            return False
+        previous_end = last_time(Path(piece["path"]))
+        if previous_end is None:
+            return True
+        wrap = PTS_WRAP / PTS_CLOCK
+        piece_first = piece["first_ts"] % wrap
+        chosen_first = first_time(chosen) % wrap
+        # Clock of the chosen segment to the clock of the current one, either
+        # of them having possibly rolled over.
+        clocks = signed_pts(round((piece_first - chosen_first) * PTS_CLOCK) % PTS_WRAP) / PTS_CLOCK
+        offset = clocks + chosen["start"] - current["start"]
+        if self.correction is not None and chosen["start"] < current["end"]:
+            movie = (current["start"], current["end"] - current["start"], current["end"], current["path"], piece_first)
+            following = (chosen["start"], now - chosen["start"], now, chosen["path"], chosen_first)
+            correction = self.correction(movie, piece_first, following, chosen_first)
+            if correction is not None:
+                logging.info("Décalage de %.3f s mesuré sur l'audio de %s", correction, chosen["path"].name)
+                offset += correction
+        keyframe = next_keyframe(chosen["path"], (previous_end - offset) % wrap)
+        if keyframe is None:
+            # Not recorded yet.
+            return True
+        start, keyframe_time = keyframe
+
+        junction_out = round((keyframe_time + offset) % wrap * PTS_CLOCK) % PTS_WRAP
+        junction_in = round(keyframe_time * PTS_CLOCK) % PTS_WRAP
+        delta = signed_pts((junction_out + piece["delta"] - junction_in) % PTS_WRAP)
+        if chosen["start"] > current["end"]:
+            self.state["gaps"].append([current["end"], chosen["start"]])
+        piece["end"] = current["end"]
+        self.state["pieces"].append({
+            "key": chosen["key"], "path": str(chosen["path"]), "start": start, "position": start,
+            "delta": delta, "wall_start": chosen["start"], "first_ts": chosen_first,
+        })
+        self.mapping = mapping
+        logging.info(
+            "Fusion en direct de %s: %s suivi de %s", self.output.name, current["path"].name, chosen["path"].name
+        )
+        return True
+
+    def finished(self, segments: list, now: float) -> bool:
+        """Return True when the recording is over and no recorder is still writing."""
+        recording = any(segment["end"] is None for segment in segments)
+        over = now >= self.until or any(segment["reason"] == "end" for segment in segments)
+        return over and not recording
+
+    def complete(self, segments: list) -> bool:
+        """Return True when the output holds all of its last segment and every segment is closed."""
+        if any(segment["end"] is None for segment in segments):
+            return False
+        piece = self.state["pieces"][-1]
+        try:
+            size = Path(piece["path"]).stat().st_size
+        except OSError:
+            return False
+        return size - piece["position"] < TS_PACKET_SIZE
+
+    def wait_recorders(self):
+        """Wait until the recording is over, at most the grace time after its planned end."""
+        while time.time() < self.until + GRACE_SECONDS:
+            if self.finished(self.segments(), time.time()):
+                return
+            time.sleep(POLL_INTERVAL)
+
+    def run(self) -> bool:
+        """
+        Fuse until the recorders are done. Return True when the output is
+        complete, False when the batch fusion has to make it.
+        """
+        self.resume()
+        while not self.state["pieces"] and not self.start(self.segments()):
+            if time.time() >= self.until + GRACE_SECONDS:
+                return False
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            with TsSplicer(self.output, self.base, self.state["counters"], self.state["bytes"]) as self.splicer:
+                while True:
+                    now = time.time()
+                    segments = self.segments()
+                    if not self.follow(segments, now):
+                        self.save()
+                        return False
+                    self.splicer.flush()
+                    self.save()
+                    if self.finished(segments, now) or now >= self.until + GRACE_SECONDS:
+                        break
+                    time.sleep(POLL_INTERVAL)
+        except OSError:
+            logging.exception("Live fusion of %s failed", self.output)
+            self.save()
+            return False
+        if not self.complete(segments):
+            logging.info("Live fusion of %s stopped before the end of %s", self.output, self.state["pieces"][-1]["path"])
+            return False
+        self.state["done"] = True
+        self.save()
+        return True
+
+    def movies(self) -> list:
+        """Return the segments fused, as the (start, duration, end, path, first timestamp) movies of fusion."""
+        ends = {segment["key"]: segment["end"] for segment in self.segments()}
+        movies = []
+        for piece in self.state["pieces"]:
+            end = ends.get(piece["key"]) or piece.get("end") or time.time()
+            movies.append((piece["wall_start"], end - piece["wall_start"], end, Path(piece["path"]), piece["first_ts"]))
+        return movies
@@ -7,10 +7,23 @@ import subprocess
 import os
 
 from configparser import ConfigParser
+from datetime import datetime
 from pathlib import Path
 from getpass import getuser
 from typing import List
 
+from audio_align import audio_offset
+from fusion_live import LiveFusion, live_fusion_state, pid_alive
+from interval_cover import cover_intervals
+from priorities import apply_priority
+from recording_manifest import manifest_path, read_manifest, read_programme
+from ts_index import index_duration, read_index
+from ts_packets import PTS_CLOCK, PTS_WRAP
+from ts_probe import probe_ts
+from ts_seek import build_packet_index
+from ts_splice import splice
+from recording_storage import config_bool, config_int, place_file, save_dir
+
 # ---------- Security helpers ----------
 def sanitize_filename(name: str, max_len: int = 200) -> str:
     """
@@ -110,11 +123,23 @@ except Exception:
         SAFE_TIME = 0
         logging.warning("Could not read SAFE_TIME; defaulting to 0")
 
+# Margins for segments whose start is tied to their timestamps (manifest
+# clock), which can be cut to the second.
+EXACT_MIN_TIME = safe_int(config_constants.get("FUSION", "exact_min_time", fallback=2), 2)
+EXACT_SAFE_TIME = safe_int(config_constants.get("FUSION", "exact_safe_time", fallback=1), 1)
+# Alignment of overlapping segments on their audio.
+ALIGN_AUDIO = config_bool(config_constants, "ALIGNMENT", "enabled", True)
+ALIGN_WINDOW = config_int(config_constants, "ALIGNMENT", "window_seconds", 8)
+ALIGN_MAX_LAG = config_int(config_constants, "ALIGNMENT", "max_lag_seconds", 30)
+ALIGN_MIN_SCORE = config_int(config_constants, "ALIGNMENT", "min_score_percent", 50) / 100
+
 parser = argparse.ArgumentParser()
 parser.add_argument("title")
 parser.add_argument("provider_iptv_recorded")
 parser.add_argument("provider_iptv_backup")
 parser.add_argument("provider_iptv_backup_2")
+parser.add_argument("--live", action="store_true", help="fuse the segments while they are recorded")
+parser.add_argument("--until", type=float, default=float("inf"), help="planned end of the recording, epoch")
 args = parser.parse_args()
 
 # Ensure logs dir exists and use sanitized title in log name
@@ -132,229 +157,454 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
-# Base paths (use sanitized title for FS operations)
-base_videos = Path(f"/home/{user}/videos_select")
-base = base_videos / f"{safe_title}-save"
+# The ffmpeg split, the ffprobe fallback and the copies only get what live recordings leave.
+apply_priority(config_constants, "fusion")
+
+# Base paths (use sanitized title for FS operations). Each role may record
+# to its own root; the to-watch folder lives with the original recording.
+base = save_dir(config_constants, safe_title, args.provider_iptv_recorded, "original")
+base_1 = base
+base_2 = save_dir(config_constants, safe_title, args.provider_iptv_backup, "backup")
+base_3 = save_dir(config_constants, safe_title, args.provider_iptv_backup_2, "backup_2")
 
 # Informational lists
 first_movies = []
 providers_list = []
 
-# ---------- Provider 1 ----------
-# Pattern used only for fns of filesystem listing; sanitize the parts that go into filenames
-pattern1 = f"{safe_title}_{args.provider_iptv_recorded}_*_original*"
 
-if not base.is_dir():
-    lst_movies_1 = []
-else:
+def probe_duration(video_path: Path):
+    """
+    Return the duration in seconds of a video, read from its timestamps for
+    MPEG-TS and according to ffprobe otherwise, or None.
+    """
+    probed = probe_ts(video_path)
+    if probed is not None:
+        return probed[1] // 1000
+    cmd = [
+        "ffprobe",
+        "-i", str(video_path),
+        "-v", "quiet",
+        "-show_entries", "format=duration",
+        "-hide_banner",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+    ]
+    process = run_subprocess(cmd)
     try:
-        files = [p for p in base.glob(pattern1) if p.is_file()]
-        files.sort(key=lambda p: p.stat().st_mtime)
-        lst_movies_1 = [p.name for p in files]
+        return int(float(getattr(process, "stdout", "").strip()))
     except Exception:
-        logging.exception("Failed enumerating files for pattern %s in %s", pattern1, base)
-        lst_movies_1 = []
+        logging.warning("ffprobe failed or returned invalid duration for %s: %s", video_path, getattr(process, "stderr", ""))
+        return None
 
-if len(lst_movies_1) == 0:
-    logging.info(
-        "Le fournisseur d'IPTV %s n'a fourni aucune vidéo pour le film %s.",
-        args.provider_iptv_recorded, args.title
+
+def probe_start_time(video_path: Path) -> float:
+    """
+    Return the start timestamp in seconds of a video: its first video PTS
+    for MPEG-TS, the start of its first stream according to ffprobe otherwise.
+    """
+    probed = probe_ts(video_path)
+    if probed is not None:
+        return probed[0] / 1000
+    cmd = [
+        "ffprobe",
+        "-i", str(video_path),
+        "-v", "quiet",
+        "-print_format", "json",
+        "-show_format",
+        "-show_streams",
+        "-hide_banner",
+    ]
+    process = run_subprocess(cmd)
+
+    if getattr(process, "returncode", 1) != 0:
+        logging.warning("ffprobe failed: %s", getattr(process, "stderr", ""))
+        return 0.0
+    try:
+        data = json.loads(getattr(process, "stdout", "") or "{}")
+        return float(data.get("streams", [{}])[0].get("start_time", 0.0))
+    except Exception:
+        logging.warning("Could not parse start_time from ffprobe output for %s", video_path)
+        return 0.0
+
+
+def cut_at_keyframe(video_path: Path, out_file: Path, start: float) -> bool:
+    """
+    Copy `video_path` from its last keyframe at or before the timestamp
+    `start` (seconds) to `out_file`, behind its PAT and PMT. Return False
+    when the file has no keyframe index to cut on.
+    """
+    index = build_packet_index(video_path)
+    keyframe = index.keyframe_before(start) if index else None
+    header = index.header_packets() if keyframe else b""
+    if not header:
+        return False
+    offset, keyframe_time = keyframe
+    try:
+        with open(video_path, "rb") as src, open(out_file, "wb") as dst:
+            dst.write(header)
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, 4 * 2**20)
+    except OSError:
+        logging.exception("Failed to cut %s at offset %d", video_path, offset)
+        return False
+    logging.info("Coupe de %s à l'image clé %.3f (octet %d)", video_path.name, keyframe_time, offset)
+    return True
+
+
+def clock_difference(a: float, b: float) -> float:
+    """Return a - b for two timestamps in seconds, across the 33-bit wrap."""
+    wrap = PTS_WRAP / PTS_CLOCK
+    return (a - b + wrap / 2) % wrap - wrap / 2
+
+
+def switch_correction(movie: tuple, movie_first: float, following: tuple, following_first: float):
+    """
+    Return the seconds to add to the time of `movie` that the wall clocks
+    match with a time of the `following` movie overlapping it, measured by
+    correlating their audio just before the end of `movie`, or None when
+    their audio does not match.
+    """
+    overlap = movie[2] - following[0]
+    probe_time = following_first + max(overlap - EXACT_SAFE_TIME - ALIGN_WINDOW, 0)
+    ref_time = movie_first + following[0] + (probe_time - following_first) - movie[0]
+    return audio_offset(
+        movie[3], ref_time, movie_first, following[3], probe_time,
+        window=ALIGN_WINDOW, max_lag=ALIGN_MAX_LAG, min_score=ALIGN_MIN_SCORE,
     )
-else:
-    starts_1 = []
-    start_file_1 = base / f"start_time_{safe_title}_{args.provider_iptv_recorded}_original.txt"
+
+
+def splice_pieces(movies: list, cuts: list):
+    """
+    Return the byte ranges of `movies` to splice into one file, or None when
+    one of them has no keyframe to cut on. Each movie after the first starts
+    at its last keyframe before its cut point; the one before it ends at its
+    first keyframe after the same instant, found through their wall clocks
+    and the audio correction of the cut.
+    """
+    indexes = [build_packet_index(movie[3]) for movie in movies]
+    if any(index is None or index.first_pts is None for index in indexes):
+        return None
+    first_ts = [cut[1] for cut in cuts]
+    first_ts.insert(0, movies[0][4] if movies[0][4] is not None else probe_start_time(movies[0][3]))
+
+    pieces = [{"path": movies[0][3], "start": 0, "junction_in": None}]
+    for n, (cut, _, correction) in enumerate(cuts):
+        # After a gap the cut is the very start of the movie.
+        keyframe = indexes[n + 1].keyframe_before(cut) or indexes[n + 1].keyframe_after(cut)
+        if keyframe is None:
+            return None
+        offset, keyframe_time = keyframe
+        wall = movies[n + 1][0] + clock_difference(keyframe_time, first_ts[n + 1])
+        end_time = (first_ts[n] + wall - movies[n][0] + correction) % (PTS_WRAP / PTS_CLOCK)
+        end = indexes[n].keyframe_after(end_time)
+        if end is not None:
+            end_offset, end_time = end
+            if end_offset <= pieces[-1]["start"]:
+                return None
+        else:
+            end_offset = None
+        pieces[-1].update(end=end_offset, junction_out=round(end_time * PTS_CLOCK) % PTS_WRAP)
+        pieces.append({
+            "path": movies[n + 1][3], "start": offset,
+            "junction_in": round(keyframe_time * PTS_CLOCK) % PTS_WRAP,
+        })
+    pieces[-1].update(end=None, junction_out=None)
+    return pieces
+
+
+def legacy_movies(base_dir: Path, provider: str, save: str) -> list:
+    """
+    Return the (start, duration, end, path, None) videos of a recording made
+    before manifests existed: its files in order of modification, matched
+    with the lines of its start_time file.
+    """
+    pattern = f"{safe_title}_{provider}_*_{save}*"
+    if not base_dir.is_dir():
+        lst_movies = []
+    else:
+        try:
+            files = [p for p in base_dir.glob(pattern) if p.is_file()]
+            files.sort(key=lambda p: p.stat().st_mtime)
+            lst_movies = [p.name for p in files]
+        except Exception:
+            logging.exception("Failed enumerating files for pattern %s in %s", pattern, base_dir)
+            lst_movies = []
+    if len(lst_movies) == 0:
+        return []
+
+    starts = []
+    start_file = base_dir / f"start_time_{safe_title}_{provider}_{save}.txt"
     try:
-        with start_file_1.open("r", encoding="utf-8") as f:
+        with start_file.open("r", encoding="utf-8") as f:
             for line in f:
-                starts_1.append(line.strip())
+                starts.append(line.strip())
     except FileNotFoundError:
-        logging.info(
-            "Le fichier %s est absent. La fusion des vidéos ne peut pas être réalisée",
-            start_file_1
-        )
+        logging.info("Le fichier %s est absent. La fusion des vidéos ne peut pas être réalisée", start_file)
         exit()
     except Exception:
-        logging.exception("Failed reading start times from %s", start_file_1)
+        logging.exception("Failed reading start times from %s", start_file)
         exit()
 
-    list_movies_1 = []
-    for a, b in zip(lst_movies_1, starts_1):
-        video_path = base / a
-        cmd = [
-            "ffprobe",
-            "-i", str(video_path),
-            "-v", "quiet",
-            "-show_entries", "format=duration",
-            "-hide_banner",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-        ]
-        process = run_subprocess(cmd)
-        stdout = getattr(process, "stdout", "")
-        stderr = getattr(process, "stderr", "")
-        try:
-            video_duration = int(float(stdout.strip()))
-        except Exception:
-            logging.warning("ffprobe failed or returned invalid duration for %s: %s", video_path, stderr)
+    movies = []
+    for a, b in zip(lst_movies, starts):
+        video_path = base_dir / a
+        video_duration = probe_duration(video_path)
+        if video_duration is None:
             continue
-
         try:
             start_time = int(b.strip())
         except Exception:
             logging.warning("Invalid start time %r for file %s, skipping", b, a)
             continue
+        movies.append((start_time, video_duration, start_time + video_duration, video_path, None))
+    return movies
 
-        list_movies_1.append((start_time, video_duration, start_time + video_duration, a))
 
-    # remove short movies (in-place safe iteration)
-    filtered = []
-    for movie in list_movies_1:
-        if movie[1] >= 80:
-            filtered.append(movie)
-    list_movies_1 = filtered
-
-    if len(list_movies_1) > 0:
-        first_movies.append(list_movies_1[0])
-        providers_list.append(list_movies_1)
+def role_movies(base_dir: Path, provider: str, save: str) -> list:
+    """
+    Return the (start, duration, end, path, first timestamp) videos recorded
+    by a role, read from its manifest. The first timestamp, in seconds, is
+    None when the segment has no clock. Segments left open by a crash are
+    measured from their index, or probed when they have none.
+    """
+    segments = read_manifest(manifest_path(base_dir, safe_title, provider, save))
+    if not segments:
+        return legacy_movies(base_dir, provider, save)
+
+    movies = []
+    for segment in segments:
+        if segment["end"] is not None:
+            video_duration = segment["end"] - segment["start"]
+        else:
+            index = read_index(segment["path"])
+            video_duration = index_duration(index) if index else None
+            if video_duration is None:
+                video_duration = probe_duration(segment["path"])
+            if video_duration is None:
+                continue
+        first_ts = segment["pts"] / PTS_CLOCK if segment["pts"] is not None else None
+        movies.append((
+            segment["start"], video_duration, segment["start"] + video_duration, segment["path"], first_ts,
+        ))
+    return movies
 
-# ---------- Provider 2 ----------
-list_movies_2 = []
 
-if args.provider_iptv_backup != "no_backup":
-    pattern2 = f"{safe_title}_{args.provider_iptv_backup}_*_backup*"
-    if not base.is_dir():
-        lst_movies_2 = []
-    else:
-        try:
-            files = [p for p in base.glob(pattern2) if p.is_file()]
-            files.sort(key=lambda p: p.stat().st_mtime)
-            lst_movies_2 = [p.name for p in files]
-        except Exception:
-            logging.exception("Failed enumerating files for pattern %s in %s", pattern2, base)
-            lst_movies_2 = []
+# ---------- Write report ----------
+def write_report(streams_best: list, gaps: list):
+    """Write the report of the fusion of the `streams_best` movies in the to-watch folder."""
+    report_dir = base / f"{safe_title}-to-watch"
+    try:
+        report_dir.mkdir(parents=True, exist_ok=True)
+    except Exception:
+        logging.exception("Failed to ensure report dir exists: %s", report_dir)
 
-    if len(lst_movies_2) == 0:
-        logging.info(
-            "Le fournisseur d'IPTV %s n'a fourni aucune vidéo pour le film %s.",
-            args.provider_iptv_backup, args.title
-        )
-    else:
-        starts_2 = []
-        start_file_2 = base / f"start_time_{safe_title}_{args.provider_iptv_backup}_backup.txt"
-        try:
-            with start_file_2.open("r", encoding="utf-8") as f:
-                for line in f:
-                    starts_2.append(line.strip())
-        except FileNotFoundError:
-            logging.info("Le fichier %s est absent. La fusion des vidéos ne peut pas être réalisée", start_file_2)
-            exit()
-        except Exception:
-            logging.exception("Failed reading start times from %s", start_file_2)
-            exit()
+    report_file = report_dir / f"{safe_title}_report.txt"
+    try:
+        report_file.touch(exist_ok=True)
+    except Exception as exc:
+        logging.exception("Failed to create report file %s: %s", report_file, exc)
 
-        for a, b in zip(lst_movies_2, starts_2):
-            video_path = base / a
-            cmd = [
-                "ffprobe",
-                "-i", str(video_path),
-                "-v", "quiet",
-                "-show_entries", "format=duration",
-                "-hide_banner",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-            ]
-            process = run_subprocess(cmd)
-            try:
-                video_duration = int(float(getattr(process, "stdout", "").strip()))
-            except Exception:
-                logging.warning("ffprobe failed or returned invalid duration for %s: %s", video_path, getattr(process, "stderr", ""))
-                continue
+    try:
+        with report_file.open("w", encoding="utf-8") as ini:
+            if gaps:
+                ini.write("\nAttention! Une discontinuité de l'enregistrement apparait pour cette vidéo.\n")
+                for gap_start, gap_end in gaps:
+                    ini.write(
+                        f"Manque de {datetime.fromtimestamp(gap_start).strftime('%H:%M:%S')} "
+                        f"à {datetime.fromtimestamp(gap_end).strftime('%H:%M:%S')} "
+                        f"({round(gap_end - gap_start)} s).\n"
+                    )
+            else:
+                ini.write("\nL'enregistrement semble être correcte.\n")
+
+            # Packets lost inside the segments kept, from their indexes.
+            for movie in streams_best:
+                index = read_index(movie[3])
+                if index and index["cc_errors"]:
+                    lost = sum(error[2] for error in index["cc_errors"])
+                    ini.write(
+                        f"\n{movie[3].name}: {len(index['cc_errors'])} erreurs de continuité, "
+                        f"{lost} paquets perdus.\n"
+                    )
+
+            # Real boundaries of the programme, found in the EIT while recording.
+            programme = None
+            for base_dir, provider, save in (
+                (base_1, args.provider_iptv_recorded, "original"),
+                (base_2, args.provider_iptv_backup, "backup"),
+                (base_3, args.provider_iptv_backup_2, "backup_2"),
+            ):
+                programme = programme or read_programme(manifest_path(base_dir, safe_title, provider, save))
+            if programme and programme["start"] and streams_best:
+                start_txt = datetime.fromtimestamp(programme["start"]).strftime("%H:%M:%S")
+                end_txt = datetime.fromtimestamp(programme["end"]).strftime("%H:%M:%S") if programme["end"] else "?"
+                offset = max(programme["start"] - streams_best[0][0], 0)
+                ini.write(
+                    f"\nProgramme {programme['name']} diffusé de {start_txt} à {end_txt}"
+                    f"{'' if programme['final'] else ' (fin annoncée)'}, "
+                    f"début à {int(offset // 60)} min {int(offset % 60)} s de l'enregistrement.\n"
+                )
+
+            # Sources used by each role when a recording switched provider.
+            for base_dir, provider, save in (
+                (base_1, args.provider_iptv_recorded, "original"),
+                (base_2, args.provider_iptv_backup, "backup"),
+                (base_3, args.provider_iptv_backup_2, "backup_2"),
+            ):
+                ranges = []
+                for segment in read_manifest(manifest_path(base_dir, safe_title, provider, save)):
+                    source = (segment["provider"], segment["source"])
+                    if ranges and ranges[-1][:2] == source:
+                        ranges[-1][3] = segment["end"]
+                    else:
+                        ranges.append([*source, segment["start"], segment["end"]])
+                if len({(r[0], r[1]) for r in ranges}) < 2:
+                    continue
+                ini.write(f"\nSources de l'enregistrement {save}:\n")
+                for source_provider, origin, start, end in ranges:
+                    start_txt = datetime.fromtimestamp(start).strftime("%H:%M:%S")
+                    end_txt = datetime.fromtimestamp(end).strftime("%H:%M:%S") if end else "?"
+                    ini.write(f"  {start_txt} - {end_txt}: {source_provider} ({origin})\n")
+    except Exception:
+        logging.exception("Failed to write report file %s", report_file)
 
-            try:
-                start_time = int(b.strip())
-            except Exception:
-                logging.warning("Invalid start time %r for file %s, skipping", b, a)
-                continue
 
-            list_movies_2.append((start_time, video_duration, start_time + video_duration, a))
+# ---------- Delete zero-size / duplicate-size files ----------
+def delete_leftovers():
+    """Delete empty segments and copies of the same segment."""
+    # Recordings with a manifest give their segments and sizes directly; the
+    # directories of older ones are scanned.
+    lst_movies = []
+    scanned = set()
+    for base_dir, provider, save in (
+        (base_1, args.provider_iptv_recorded, "original"),
+        (base_2, args.provider_iptv_backup, "backup"),
+        (base_3, args.provider_iptv_backup_2, "backup_2"),
+    ):
+        segments = read_manifest(manifest_path(base_dir, safe_title, provider, save))
+        for segment in segments:
+            size = segment["bytes"]
+            if size is None:
+                try:
+                    size = segment["path"].stat().st_size
+                except OSError:
+                    continue
+            lst_movies.append((size, str(segment["path"])))
+        if segments or base_dir in scanned or not base_dir.is_dir():
+            continue
+        scanned.add(base_dir)
+        try:
+            for f in base_dir.iterdir():
+                if f.is_file():
+                    try:
+                        lst_movies.append((f.stat().st_size, str(f)))
+                    except Exception:
+                        continue
+        except Exception:
+            logging.exception("Failed iterating base dir %s", base_dir)
+    lst_movies = list(dict.fromkeys(lst_movies))
 
-        filtered2 = []
-        for movie in list_movies_2:
-            if movie[1] >= 80:
-                filtered2.append(movie)
-        list_movies_2 = filtered2
+    movies_sorted = sorted(lst_movies, key=lambda x: x[0])
 
-        if len(list_movies_2) > 0:
-            first_movies.append(list_movies_2[0])
-            providers_list.append(list_movies_2)
+    todelete = []
+    sizes = []
+    for size, title in movies_sorted:
+        if size == 0:
+            todelete.append(title)
+        else:
+            sizes.append(size)
+            if sizes.count(size) > 5:
+                todelete.append(title)
 
-# ---------- Provider 3 ----------
-list_movies_3 = []
+    # Resolve the save dirs safely and ensure deletes happen inside them
+    base_dirs = [d.resolve() for d in dict.fromkeys([base_1, base_2, base_3])]
 
-if args.provider_iptv_backup_2 != "no_backup_2":
-    pattern3 = f"{safe_title}_{args.provider_iptv_backup_2}_*_backup_2*"
-    if not base.is_dir():
-        lst_movies_3 = []
-    else:
+    for movie in todelete:
+        p = Path(movie)
         try:
-            files = [p for p in base.glob(pattern3) if p.is_file()]
-            files.sort(key=lambda p: p.stat().st_mtime)
-            lst_movies_3 = [p.name for p in files]
+            target = p.resolve(strict=False)
         except Exception:
-            logging.exception("Failed enumerating files for pattern %s in %s", pattern3, base)
-            lst_movies_3 = []
+            logging.warning("Cannot resolve path %r, skipping", movie)
+            continue
+
+        if not any(is_within_base(base_dir, target) for base_dir in base_dirs):
+            logging.warning("Skipping path outside base dir: %s", target)
+            continue
 
-    if len(lst_movies_3) == 0:
-        logging.info(
-            "Le fournisseur d'IPTV %s n'a fourni aucune vidéo pour le film %s.",
-            args.provider_iptv_backup_2, args.title
-        )
-    else:
-        starts_3 = []
-        start_file_3 = base / f"start_time_{safe_title}_{args.provider_iptv_backup_2}_backup_2.txt"
         try:
-            with start_file_3.open("r", encoding="utf-8") as f:
-                for line in f:
-                    starts_3.append(line.strip())
+            if target.is_symlink() or target.is_file():
+                target.unlink()
+                logging.info("Removed file: %s", target)
+            elif target.is_dir():
+                shutil.rmtree(target)
+                logging.info("Removed directory tree: %s", target)
+            else:
+                logging.warning("Not a file or directory, skipping: %s", target)
         except FileNotFoundError:
-            logging.info("Le fichier %s est absent. La fusion des vidéos ne peut pas être réalisée", start_file_3)
-            exit()
+            logging.warning("File not found (already removed?): %s", target)
+        except PermissionError:
+            logging.warning("Permission denied removing: %s", target)
         except Exception:
-            logging.exception("Failed reading start times from %s", start_file_3)
-            exit()
-
-        for a, b in zip(lst_movies_3, starts_3):
-            video_path = base / a
-            cmd = [
-                "ffprobe",
-                "-i", str(video_path),
-                "-v", "quiet",
-                "-show_entries", "format=duration",
-                "-hide_banner",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-            ]
-            process = run_subprocess(cmd)
-            try:
-                video_duration = int(float(getattr(process, "stdout", "").strip()))
-            except Exception:
-                logging.warning("ffprobe failed or returned invalid duration for %s: %s", video_path, getattr(process, "stderr", ""))
-                continue
+            logging.exception("Failed to remove %s", target)
 
-            try:
-                start_time = int(b.strip())
-            except Exception:
-                logging.warning("Invalid start time %r for file %s, skipping", b, a)
-                continue
 
-            list_movies_3.append((start_time, video_duration, start_time + video_duration, a))
-
-        filtered3 = []
-        for movie in list_movies_3:
-            if movie[1] >= 80:
-                filtered3.append(movie)
-        list_movies_3 = filtered3
+# ---------- Incremental fusion while recording ----------
+to_watch_dir = base / f"{safe_title}-to-watch"
+output_file = to_watch_dir / f"{safe_title}.ts"
+live_state = live_fusion_state(safe_title)
+if args.live:
+    roles = [
+        (manifest_path(base_dir, safe_title, provider, save), save)
+        for base_dir, provider, save in (
+            (base_1, args.provider_iptv_recorded, "original"),
+            (base_2, args.provider_iptv_backup, "backup"),
+            (base_3, args.provider_iptv_backup_2, "backup_2"),
+        )
+        if provider not in ("no_backup", "no_backup_2")
+    ]
+    try:
+        to_watch_dir.mkdir(parents=True, exist_ok=True)
+    except Exception:
+        logging.exception("Failed to create to-watch dir %s", to_watch_dir)
+    live = LiveFusion(
+        safe_title, roles, output_file, args.until,
+        correction=switch_correction if ALIGN_AUDIO else None,
+    )
+    if live.run():
+        logging.info("Vidéo %s fusionnée pendant l'enregistrement", args.title)
+        write_report(live.movies(), live.state["gaps"])
+        delete_leftovers()
+        exit()
+    logging.info("La fusion en direct de la vidéo %s a échoué, elle sera refaite à la fin de l'enregistrement.", args.title)
+    live.wait_recorders()
+    try:
+        output_file.unlink(missing_ok=True)
+    except OSError:
+        logging.exception("Failed to remove the incomplete live output %s", output_file)
+elif live_state.get("done") and live_state.get("output") == str(output_file):
+    logging.info("La vidéo %s a déjà été fusionnée pendant l'enregistrement.", args.title)
+    exit()
+elif pid_alive(live_state.get("pid")) and not live_state.get("done"):
+    # A live fusion that fails does the batch fusion itself.
+    logging.info("La fusion en direct de la vidéo %s est toujours en cours.", args.title)
+    exit()
 
-        if len(list_movies_3) > 0:
-            first_movies.append(list_movies_3[0])
-            providers_list.append(list_movies_3)
+for base_dir, provider, save in (
+    (base_1, args.provider_iptv_recorded, "original"),
+    (base_2, args.provider_iptv_backup, "backup"),
+    (base_3, args.provider_iptv_backup_2, "backup_2"),
+):
+    if provider in ("no_backup", "no_backup_2"):
+        continue
+    # Short videos are failed starts.
+    movies = [movie for movie in role_movies(base_dir, provider, save) if movie[1] >= 80]
+    if len(movies) == 0:
+        logging.info(
+            "Le fournisseur d'IPTV %s n'a fourni aucune vidéo pour le film %s.",
+            provider, args.title
+        )
+        continue
+    first_movies.append(movies[0])
+    providers_list.append(movies)
 
 # ---------- Validate available providers ----------
 if len(first_movies) == 1:
@@ -369,85 +619,90 @@ elif len(first_movies) == 0:
     exit()
 
 # ---------- Make a list of movies ----------
-streams_best = []
 list_movies = []
-for list_movie in providers_list:
+sources = []
+for source, list_movie in enumerate(providers_list):
     for movie in list_movie:
         list_movies.append(movie)
+        sources.append(source)
+
+# Cover the whole recorded time, switching provider as little as possible.
+chosen, gaps = cover_intervals([
+    (movie[0], movie[2], source) for movie, source in zip(list_movies, sources)
+])
+streams_best = [list_movies[i] for i in chosen]
+for gap_start, gap_end in gaps:
+    logging.info(
+        "Aucun fournisseur d'IPTV n'a enregistré le film %s entre %s et %s.",
+        args.title,
+        datetime.fromtimestamp(gap_start).strftime("%H:%M:%S"),
+        datetime.fromtimestamp(gap_end).strftime("%H:%M:%S"),
+    )
 
-max_end = 0
-for movie in list_movies:
-    end = movie[2]
-    if end > max_end:
-        max_end = end
-
-continuum = True
-last_continuous = []
-
-while continuum:
-    if len(streams_best) == 0:
-        start_vals = [movie[0] for movie in list_movies]
-        if not start_vals:
-            break
-        index_min = [i for i, j in enumerate(start_vals) if j == min(start_vals)][0]
-        streams_best.append(list_movies[index_min])
-        list_movies.remove(list_movies[index_min])
-    else:
-        continuous = []
-        for movie in list_movies:
-            if movie[0] < streams_best[-1][2] < movie[2]:
-                continuous.append(movie)
-        if continuous == last_continuous:
-            break
-        if len(continuous) > 0:
-            end_vals = [m[2] for m in continuous]
-            index_max = [i for i, j in enumerate(end_vals) if j == max(end_vals)][0]
-            streams_best.append(continuous[index_max])
-            list_movies.remove(continuous[index_max])
-        else:
-            continuum = False
-        last_continuous = continuous[:]
-
-movies_remaster = [streams_best[0][3]]
-
+# Cut point of each movie after the first: (timestamp, first timestamp,
+# audio correction of the wall clocks).
+first_ts = [movie[4] if movie[4] is not None else probe_start_time(movie[3]) for movie in streams_best]
+cuts = []
 for n in range(len(streams_best) - 1):
     diff_time = streams_best[n][2] - streams_best[n + 1][0]
-    file_path = base / streams_best[n + 1][3]
+    start_time_value = first_ts[n + 1]
 
-    cmd = [
-        "ffprobe",
-        "-i", str(file_path),
-        "-v", "quiet",
-        "-print_format", "json",
-        "-show_format",
-        "-show_streams",
-        "-hide_banner",
-    ]
-    process = run_subprocess(cmd)
-
-    if getattr(process, "returncode", 1) != 0:
-        logging.warning("ffprobe failed: %s", getattr(process, "stderr", ""))
-        start_time_value = 0.0
+    if streams_best[n][4] is not None and streams_best[n + 1][4] is not None:
+        # Both segments are tied to the wall clock by their first timestamp.
+        min_time, safe_time = EXACT_MIN_TIME, EXACT_SAFE_TIME
     else:
-        try:
-            data = json.loads(getattr(process, "stdout", "") or "{}")
-            start_time_value = float(data.get("streams", [{}])[0].get("start_time", 0.0))
-        except Exception:
-            logging.warning("Could not parse start_time from ffprobe output for %s", file_path)
-            start_time_value = 0.0
+        min_time, safe_time = MIN_TIME, SAFE_TIME
 
-    if diff_time > MIN_TIME:
-        start = int(start_time_value) + diff_time - SAFE_TIME
+    # Providers lag each other: the overlap is measured on the audio.
+    correction = None
+    if ALIGN_AUDIO and diff_time > EXACT_MIN_TIME:
+        correction = switch_correction(streams_best[n], first_ts[n], streams_best[n + 1], first_ts[n + 1])
+    if correction is not None:
+        logging.info(
+            "Décalage de %.3f s mesuré sur l'audio entre %s et %s",
+            correction, streams_best[n][3].name, streams_best[n + 1][3].name,
+        )
+        diff_time -= correction
+        min_time, safe_time = EXACT_MIN_TIME, EXACT_SAFE_TIME
+
+    if diff_time > min_time:
+        start = round(start_time_value + diff_time - safe_time, 3)
     else:
-        start = int(start_time_value)
+        start = round(start_time_value, 3)
 
     logging.info("start_time: %s", start)
+    cuts.append((start, start_time_value, correction or 0.0))
 
-    orig_filename = streams_best[n + 1][3]
-    file1 = base / orig_filename
+try:
+    to_watch_dir.mkdir(parents=True, exist_ok=True)
+except Exception:
+    logging.exception("Failed to create to-watch dir %s", to_watch_dir)
 
-    file2_base = Path(orig_filename).stem
-    out_file = base / f"{file2_base}_s.ts"
+# ---------- Splice the movies into one file ----------
+spliced = False
+if len(streams_best) == 1:
+    try:
+        method = place_file(streams_best[0][3], output_file)
+        logging.info("%s -> %s (%s)", streams_best[0][3], output_file, method)
+        spliced = True
+    except OSError:
+        logging.exception("Failed to place %s in %s", streams_best[0][3], output_file)
+else:
+    pieces = splice_pieces(streams_best, cuts)
+    if pieces is not None and splice(pieces, output_file):
+        logging.info("Vidéo %s écrite en un seul fichier de %d morceaux", args.title, len(pieces))
+        spliced = True
+
+# ---------- Otherwise cut the movies and place them in the to-watch dir ----------
+movies_remaster = [streams_best[0][3]] if not spliced else []
+for n, (start, _, _) in enumerate(cuts if not spliced else []):
+    file1 = streams_best[n + 1][3]
+    out_file = file1.with_name(f"{file1.stem}_s.ts")
+
+    # Cut at the keyframe found in the packet index, without remuxing.
+    if cut_at_keyframe(file1, out_file, start):
+        movies_remaster.append(out_file)
+        continue
 
     split_logs = logs_dir / "split_infos.log"
     try:
@@ -478,7 +733,7 @@ for n in range(len(streams_best) - 1):
     except Exception:
         logging.exception("Failed to run ffmpeg split for %s -> %s", file1, out_file)
         # still add something so logic stays consistent
-        movies_remaster.append(str(out_file))
+        movies_remaster.append(out_file)
         continue
 
     if getattr(result, "returncode", 1) != 0:
@@ -488,22 +743,19 @@ for n in range(len(streams_best) - 1):
         except Exception:
             pass
 
-    movies_remaster.append(out_file.name)
+    movies_remaster.append(out_file)
 
-# ---------- Copy remastered movies to to-watch dir ----------
 rank = 1
-to_watch_dir = base / f"{safe_title}-to-watch"
-try:
-    to_watch_dir.mkdir(parents=True, exist_ok=True)
-except Exception:
-    logging.exception("Failed to create to-watch dir %s", to_watch_dir)
-
-for stream in movies_remaster:
-    src = base / stream
-    dest_name = f"{rank}_{Path(stream).name}"
+# The split copies are not needed once in the to-watch folder.
+split_copies = set(movies_remaster[1:])
+for src in movies_remaster:
+    dest_name = f"{rank}_{src.name}"
     dest = to_watch_dir / dest_name
     try:
-        shutil.copy2(src, dest)
+        method = place_file(src, dest, movable=src in split_copies)
+        logging.info("%s -> %s (%s)", src, dest, method)
+        if src in split_copies and method != "rename":
+            src.unlink(missing_ok=True)
     except FileNotFoundError:
         logging.warning("Source file not found: %s", src)
     except PermissionError:
@@ -512,80 +764,5 @@ for stream in movies_remaster:
         logging.exception("Failed to copy %s -> %s: %s", src, dest, exc)
     rank += 1
 
-# ---------- Write report ----------
-report_dir = base / f"{safe_title}-to-watch"
-try:
-    report_dir.mkdir(parents=True, exist_ok=True)
-except Exception:
-    logging.exception("Failed to ensure report dir exists: %s", report_dir)
-
-report_file = report_dir / f"{safe_title}_report.txt"
-try:
-    report_file.touch(exist_ok=True)
-except Exception as exc:
-    logging.exception("Failed to create report file %s: %s", report_file, exc)
-
-try:
-    with report_file.open("w", encoding="utf-8") as ini:
-        if streams_best and streams_best[-1][2] < max_end - 300:
-            ini.write("\nAttention! Une discontinuité de l'enregistrement apparait pour cette vidéo.\n")
-        else:
-            ini.write("\nL'enregistrement semble être correcte.\n")
-except Exception:
-    logging.exception("Failed to write report file %s", report_file)
-
-# ---------- Delete zero-size / duplicate-size files ----------
-lst_movies = []
-if base.is_dir():
-    try:
-        for f in base.iterdir():
-            if f.is_file():
-                try:
-                    lst_movies.append((f.stat().st_size, str(f)))
-                except Exception:
-                    continue
-    except Exception:
-        logging.exception("Failed iterating base dir %s", base)
-
-movies_sorted = sorted(lst_movies, key=lambda x: x[0])
-
-todelete = []
-sizes = []
-for size, title in movies_sorted:
-    if size == 0:
-        todelete.append(title)
-    else:
-        sizes.append(size)
-        if sizes.count(size) > 5:
-            todelete.append(title)
-
-# Resolve base_dir safely and ensure deletes happen inside it
-base_dir = base_videos.resolve()
-
-for movie in todelete:
-    p = Path(movie)
-    try:
-        target = p.resolve(strict=False)
-    except Exception:
-        logging.warning("Cannot resolve path %r, skipping", movie)
-        continue
-
-    if not is_within_base(base_dir, target):
-        logging.warning("Skipping path outside base dir: %s", target)
-        continue
-
-    try:
-        if target.is_symlink() or target.is_file():
-            target.unlink()
-            logging.info("Removed file: %s", target)
-        elif target.is_dir():
-            shutil.rmtree(target)
-            logging.info("Removed directory tree: %s", target)
-        else:
-            logging.warning("Not a file or directory, skipping: %s", target)
-    except FileNotFoundError:
-        logging.warning("File not found (already removed?): %s", target)
-    except PermissionError:
-        logging.warning("Permission denied removing: %s", target)
-    except Exception:
-        logging.exception("Failed to remove %s", target)
+write_report(streams_best, gaps)
+delete_leftovers()
@@ -611,6 +611,15 @@ cron_launch = (
     "bash cron_launch_record.sh\n".format(user=user, minute_2=minute_2, heure=heure)
 )
 
+# Resume recordings interrupted by a reboot or a killed recorder.
+cron_recover = [
+    "{schedule} export TZ='Europe/Paris' USER='{user}' && cd /home/$USER/iptvselect-fr && "
+    ". $HOME/.local/share/iptvselect-fr/.venv/bin/activate && "
+    "python3 recover_recordings.py >> $HOME/.local/share/iptvselect-fr/logs/"
+    "recover_recordings.log 2>&1\n".format(schedule=schedule, user=user)
+    for schedule in ("@reboot", "* * * * *")
+]
+
 cron_auto_update = (
     '{minute_auto_update} {heure_auto_update} * * * /bin/bash -c "$HOME'
     "/iptvselect-fr/auto_update.sh >> $HOME/.local/share"
@@ -623,7 +632,8 @@ if hdmi_screen == "oui" or hdmi_screen == "no_se":
     cron_lines = [curl if "iptvselect-fr/curl_iptvselect.sh" in cron else cron for cron in cron_lines]
 else:
     cron_lines = [cron for cron in cron_lines if "iptvselect-fr/curl_iptvselect.sh" not in cron]
-cron_lines = [cron_launch if "iptvselect-fr &&" in cron else cron for cron in cron_lines]
+cron_lines = [cron_launch if "cron_launch_record.sh" in cron else cron for cron in cron_lines]
+cron_lines = [cron for cron in cron_lines if "recover_recordings.py" not in cron] + cron_recover
 
 if auto_update.lower() == "oui":
     cron_lines = [
@@ -637,7 +647,7 @@ cron_lines_join = "".join(cron_lines)
 
 if (hdmi_screen == "oui" or hdmi_screen == "no_se") and "iptvselect-fr/curl_iptvselect.sh" not in cron_lines_join:
     cron_lines.append(curl)
-if "cd /home/$USER/iptvselect-fr &&" not in cron_lines_join:
+if "bash cron_launch_record.sh" not in cron_lines_join:
     cron_lines.append(cron_launch)
 
 if auto_update.lower() == "oui" and "iptvselect-fr/auto_update" not in cron_lines_join:
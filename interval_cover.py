@@ -0,0 +1,69 @@
+from bisect import bisect_left, bisect_right
+
+
+def cover_intervals(intervals: list) -> tuple:
+    """
+    Choose among (start, end, source) intervals a chain covering as much
+    time as they do together, then with the fewest changes of source, then
+    with the fewest intervals. Consecutive intervals of the chain touch or
+    overlap, except across the gaps no interval covers.
+
+    Return the positions in `intervals` of the chosen ones, in time order,
+    and the (start, end) gaps between them.
+    """
+    order = sorted(range(len(intervals)), key=lambda i: (intervals[i][0], intervals[i][1]))
+    chosen = []
+    gaps = []
+    position = 0
+    while position < len(order):
+        # Sweep one connected run of intervals.
+        first = position
+        reach = intervals[order[first]][1]
+        while position < len(order) and intervals[order[position]][0] <= reach:
+            reach = max(reach, intervals[order[position]][1])
+            position += 1
+        run = order[first:position]
+        if chosen:
+            gaps.append((intervals[chosen[-1]][1], intervals[run[0]][0]))
+        chosen += cover_run(intervals, run)
+    return chosen, gaps
+
+
+def cover_run(intervals: list, run: list) -> list:
+    """
+    Return the chain covering a connected run of intervals from its start to
+    its end with the fewest source changes, then the fewest intervals.
+    """
+    start = intervals[run[0]][0]
+    end = max(intervals[i][1] for i in run)
+    by_end = sorted(run, key=lambda i: intervals[i][1])
+    ends = [intervals[i][1] for i in by_end]
+    # (changes, count) of the best chain ending with each interval.
+    cost = {}
+    previous = {}
+    for i in by_end:
+        i_start, i_end, i_source = intervals[i]
+        if i_start <= start:
+            cost[i], previous[i] = (0, 1), None
+            continue
+        # Chains it can follow end within it, before its own end.
+        best = None
+        for j in by_end[bisect_left(ends, i_start):bisect_left(ends, i_end)]:
+            if j not in cost:
+                continue
+            changes, count = cost[j]
+            candidate = (changes + (intervals[j][2] != i_source), count + 1)
+            if best is None or candidate < best:
+                best, previous[i] = candidate, j
+        if best is not None:
+            cost[i] = best
+
+    last = min(
+        (i for i in by_end[bisect_left(ends, end):bisect_right(ends, end)] if i in cost),
+        key=lambda i: cost[i],
+    )
+    chain = []
+    while last is not None:
+        chain.append(last)
+        last = previous[last]
+    return chain[::-1]
@@ -11,6 +11,12 @@ from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
 from getpass import getuser
 
+from admission import DiskAdmission
+from priorities import apply_priority
+from recording_storage import config_bool, load_constants
+from relay import relay_enabled
+from timeshift import ensure_timeshifts
+
 
 # --- Basic environment setup ---
 user = os.environ.get("USER") or getuser()
@@ -102,8 +108,59 @@ def start_fusion_calcul(start_f):
         return start_f[:-2] + str(int(start_f[-2:]) - 2)
 
 
+def schedule_fusion(video, start, fusion_args):
+    cmd = at_command(start)
+    script = (
+        ". $HOME/.local/share/iptvselect-fr/.venv/bin/activate && "
+        + " ".join(["python3", "fusion_script.py", *fusion_args]) + "\n"
+    )
+
+    try:
+        with open(log_file, "a", encoding="utf-8") as log:
+            at_process = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=log, stderr=log
+            )
+            try:
+                at_process.communicate(input=script.encode(), timeout=30)
+            except subprocess.TimeoutExpired:
+                at_process.kill()
+                logging.warning("Scheduling fusion (at) timed out for %s", video.get("title"))
+            at_process.wait()
+    except Exception as e:
+        logging.exception("Failed to schedule fusion script for %s: %s", video.get("title"), e)
+
+
 config_iptv_select_keys = ["iptv_provider", "iptv_backup", "iptv_backup_2"]
 
+constants = load_constants()
+disk_admission = DiskAdmission(constants)
+ensure_timeshifts(constants)
+# After starting the timeshift daemons, which must keep the capture priority.
+apply_priority(constants, "maintenance")
+
+
+def at_command(start: str) -> list:
+    """
+    Return the at command running a job at `start` (YYYYMMDDHHMM), or right
+    away when that time is already past: the recording then recovers the
+    missed minutes from the timeshift ring of the channel, if there is one.
+    """
+    try:
+        if datetime.strptime(start, "%Y%m%d%H%M") <= datetime.now():
+            return ["at", "now"]
+    except ValueError:
+        pass
+    return ["at", "-t", start]
+
+
+def start_timestamp(start: str) -> float:
+    """Return the epoch of a YYYYMMDDHHMM start, as scheduled with at_command."""
+    now = datetime.now().timestamp()
+    try:
+        return max(datetime.strptime(start, "%Y%m%d%H%M").timestamp(), now)
+    except ValueError:
+        return now
+
 
 class Provider:
     """Define a provider"""
@@ -111,6 +168,7 @@ class Provider:
     def __init__(self, iptv_provider, time_last):
         self.iptv_provider = iptv_provider
         self.time_last = time_last
+        self.channel_last = {}
 
     def max_iptv(self, config_iptv_select):
         """
@@ -232,6 +290,13 @@ for video in data:
         logging.warning("Invalid start date format for video: %s", video.get("start"))
         continue
 
+    try:
+        if video_start_datetime + timedelta(seconds=int(video["duration"])) <= datetime.now():
+            logging.info("Le programme %s est déjà terminé.", video.get("title"))
+            continue
+    except (KeyError, ValueError):
+        pass
+
     provider_iptv_recorded = "no_provider"
     provider_iptv_backup = "no_backup"
     provider_iptv_backup_2 = "no_backup_2"
@@ -276,15 +341,39 @@ for video in data:
                 time_last = providers[provider["iptv_provider"]].time_last.get(str(provider_rank) + provider["iptv_provider"], datetime.now())
             except KeyError:
                 time_last = datetime.now()
-            if time_last < video_start_datetime:
+            # A programme following another on the same channel keeps the
+            # position: both share the relay session, hence a single line.
+            rank_key = str(provider_rank) + provider["iptv_provider"]
+            same_channel_session = (
+                time_last <= video_start_datetime
+                and relay_enabled(constants, provider["iptv_provider"])
+                and providers[provider["iptv_provider"]].channel_last.get(rank_key)
+                == video["channel"].lower()
+            )
+            if time_last < video_start_datetime or same_channel_session:
                 try:
                     m3u8_link = config_iptv_provider["CHANNELS"][video["channel"].lower()]
-                    if isinstance(m3u8_link, str) and m3u8_link.strip() != "":
-                        cmd = ["at", "-t", video_start]
+                    if (
+                        isinstance(m3u8_link, str)
+                        and m3u8_link.strip() != ""
+                        and not disk_admission.admit(
+                            video["title"], "original", provider["iptv_provider"],
+                            video["channel"].lower(), video_start_datetime.timestamp(),
+                            int(video["duration"]), video_start,
+                        )
+                    ):
+                        logging.warning(
+                            "Le fournisseur d'IPTV %s ne sera pas utilisé pour enregistrer le programme %s faute d'espace disque.",
+                            provider["iptv_provider"], video.get("title"),
+                        )
+                        provider_rank += 1
+                        continue
+                    elif isinstance(m3u8_link, str) and m3u8_link.strip() != "":
+                        cmd = at_command(video_start)
                         script = (
                             ". $HOME/.local/share/iptvselect-fr/.venv/bin/activate "
                             "&& python3 record_iptv.py {title} {provider} "
-                            "{recorder} '{m3u8_link}' {duration} {save} >> "
+                            "{recorder} '{m3u8_link}' {duration} {save} --channel {channel} --start {start} >> "
                             "~/.local/share/iptvselect-fr/logs/record_{title}_"
                             "original.log 2>&1\n".format(
                                 title=video["title"],
@@ -292,6 +381,8 @@ for video in data:
                                 recorder=provider.get("provider_recorder", ""),
                                 m3u8_link=m3u8_link,
                                 save="original",
+                                channel=shlex.quote(video["channel"].lower()),
+                                start=video_start,
                                 duration=video.get("duration", ""),
                             )
                         )
@@ -319,6 +410,9 @@ for video in data:
                         ] = video_start_datetime + timedelta(
                             seconds=int(video["duration"])
                         )
+                        providers[provider_iptv_recorded].channel_last[
+                            rank_provider_iptv_recorded
+                        ] = video["channel"].lower()
                     else:
                         logging.info(
                             "La chaîne %s ne comporte pas de lien m3u dans le fichier %s pour réaliser l'enregistrement de ce programme. Le fournisseur d'IPTV %s ne sera donc pas utilisé pour enregistrer la vidéo %s.",
@@ -374,16 +468,28 @@ for video in data:
                         int(video_start[-2:]) - 1
                     )
                 m3u8_link = config_iptv_backup["CHANNELS"][video["channel"].lower()]
-                if isinstance(m3u8_link, str) and m3u8_link.strip() != "":
-                    cmd = [
-                        "at",
-                        "-t",
-                        video_start_backup,
-                    ]
+                if (
+                    isinstance(m3u8_link, str)
+                    and m3u8_link.strip() != ""
+                    and not disk_admission.admit(
+                        video["title"], "backup", provider["iptv_backup"],
+                        video["channel"].lower(), start_timestamp(video_start_backup),
+                        int(video["duration"]), video_start_backup,
+                    )
+                ):
+                    logging.warning(
+                        "La 1ère sauvegarde de la vidéo %s est abandonnée faute d'espace disque.",
+                        video.get("title"),
+                    )
+                    iptv_backup_set = True
+                    if iptv_provider_set is True and provider.get("iptv_backup_2", "") == "":
+                        break
+                elif isinstance(m3u8_link, str) and m3u8_link.strip() != "":
+                    cmd = at_command(video_start_backup)
                     script = (
                         ". $HOME/.local/share/iptvselect-fr/.venv/bin/activate "
                         "&& python3 record_iptv.py {title} {provider} "
-                        "{recorder} '{m3u8_link}' {duration} {save} >> "
+                        "{recorder} '{m3u8_link}' {duration} {save} --channel {channel} --start {start} >> "
                         "~/.local/share/iptvselect-fr/logs/record_{title}_"
                         "backup.log 2>&1\n".format(
                             title=video["title"],
@@ -391,6 +497,8 @@ for video in data:
                             recorder=provider.get("backup_recorder", ""),
                             m3u8_link=m3u8_link,
                             save="backup",
+                            channel=shlex.quote(video["channel"].lower()),
+                            start=video_start_backup,
                             duration=video["duration"],
                         )
                     )
@@ -460,16 +568,30 @@ for video in data:
                         int(video_start[-2:]) - 2
                     )
                 m3u8_link = config_iptv_backup_2["CHANNELS"][video["channel"].lower()]
-                if isinstance(m3u8_link, str) and m3u8_link.strip() != "":
-                    cmd = [
-                        "at",
-                        "-t",
-                        video_start_backup_2,
-                    ]
+                if (
+                    isinstance(m3u8_link, str)
+                    and m3u8_link.strip() != ""
+                    and not disk_admission.admit(
+                        video["title"], "backup_2", provider["iptv_backup_2"],
+                        video["channel"].lower(), start_timestamp(video_start_backup_2),
+                        int(video["duration"]), video_start_backup_2,
+                    )
+                ):
+                    logging.warning(
+                        "La 2ème sauvegarde de la vidéo %s est abandonnée faute d'espace disque.",
+                        video.get("title"),
+                    )
+                    iptv_backup_2_set = True
+                    if iptv_provider_set is True:
+                        break
+                    else:
+                        provider_rank += 1
+                elif isinstance(m3u8_link, str) and m3u8_link.strip() != "":
+                    cmd = at_command(video_start_backup_2)
                     script = (
                         ". $HOME/.local/share/iptvselect-fr/.venv/bin/activate "
                         "&& python3 record_iptv.py {title} {provider} "
-                        "{recorder} '{m3u8_link}' {duration} {save} >> "
+                        "{recorder} '{m3u8_link}' {duration} {save} --channel {channel} --start {start} >> "
                         "~/.local/share/iptvselect-fr/logs/record_{title}_"
                         "backup_2.log 2>&1\n".format(
                             title=video["title"],
@@ -477,6 +599,8 @@ for video in data:
                             recorder=provider.get("backup_2_recorder", ""),
                             m3u8_link=m3u8_link,
                             save="backup_2",
+                            channel=shlex.quote(video["channel"].lower()),
+                            start=video_start_backup_2,
                             duration=video["duration"],
                         )
                     )
@@ -528,33 +652,17 @@ for video in data:
                 start_records_fusion.remove(video["start_fusion"])
             video["start_fusion"] = start_fusion_calcul(video["start_fusion"])
 
-        cmd = [
-            "at",
-            "-t",
-            video["start_fusion"],
-        ]
-        script = " ".join([
-            "python3",
-            "fusion_script.py",
+        fusion_args = [
             video["title"],
             provider_iptv_recorded,
             provider_iptv_backup,
             provider_iptv_backup_2,
-        ]) + "\n"
-
-        try:
-            with open(log_file, "a", encoding="utf-8") as log:
-                at_process = subprocess.Popen(
-                    cmd, stdin=subprocess.PIPE, stdout=log, stderr=log
-                )
-                try:
-                    at_process.communicate(input=script.encode(), timeout=30)
-                except subprocess.TimeoutExpired:
-                    at_process.kill()
-                    logging.warning("Scheduling fusion (at) timed out for %s", video.get("title"))
-                at_process.wait()
-        except Exception as e:
-            logging.exception("Failed to schedule fusion script for %s: %s", video.get("title"), e)
+        ]
+        schedule_fusion(video, video["start_fusion"], fusion_args)
+        if config_bool(constants, "FUSION", "live", True):
+            # Fused while recording; the run at start_fusion only takes over if it failed.
+            until = video_start_datetime.timestamp() + int(video["duration"])
+            schedule_fusion(video, video["start"], ["--live", "--until", str(int(until)), *fusion_args])
 
 src = info_progs_path
 dest = info_progs_last_path
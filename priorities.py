@@ -0,0 +1,119 @@
+import logging
+import os
+
+from configparser import ConfigParser
+from pathlib import Path
+
+import psutil
+
+from recording_storage import config_bool
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+# Defaults of each kind of work: nice value, ionice class and level, and
+# cgroup v2 cpu.weight / io.weight. Live capture wins over everything; an
+# unprivileged user cannot go below nice 0, so captures get the highest
+# best-effort I/O level instead, and fusion and checks only get idle time.
+CLASSES = {
+    "capture": {"nice": 0, "ioclass": "best-effort", "iolevel": 0, "cpu_weight": 1000, "io_weight": 1000},
+    "fusion": {"nice": 19, "ioclass": "idle", "iolevel": 7, "cpu_weight": 10, "io_weight": 10},
+    "check": {"nice": 19, "ioclass": "idle", "iolevel": 7, "cpu_weight": 10, "io_weight": 10},
+    "maintenance": {"nice": 10, "ioclass": "best-effort", "iolevel": 7, "cpu_weight": 50, "io_weight": 50},
+}
+
+IOCLASSES = {
+    "best-effort": psutil.IOPRIO_CLASS_BE,
+    "idle": psutil.IOPRIO_CLASS_IDLE,
+    "none": psutil.IOPRIO_CLASS_NONE,
+}
+
+
+def priority_settings(constants: ConfigParser, kind: str) -> dict:
+    """Return the settings of `kind`, overridden by [PRIORITY] <kind>_<setting>."""
+    settings = dict(CLASSES[kind])
+    for name, default in CLASSES[kind].items():
+        option = f"{kind}_{name}"
+        if not constants.has_option("PRIORITY", option):
+            continue
+        value = constants.get("PRIORITY", option).strip()
+        if isinstance(default, int):
+            try:
+                settings[name] = int(value)
+            except ValueError:
+                logging.warning("Invalid integer for [PRIORITY] %s, using default %s", option, default)
+        else:
+            settings[name] = value
+    return settings
+
+
+def own_cgroup() -> Path:
+    """Return the cgroup v2 directory of this process, or None without cgroup v2."""
+    try:
+        with open("/proc/self/cgroup", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return CGROUP_ROOT / line.strip()[3:].lstrip("/")
+    except OSError:
+        pass
+    return None
+
+
+def join_cgroup(kind: str, settings: dict, pid: int):
+    """
+    Move `pid` into an iptvselect-<kind> cgroup next to the current one and
+    set its weights. This only works where the user's cgroup subtree is
+    delegated (systemd user sessions) with the cpu and io controllers enabled.
+    """
+    current = own_cgroup()
+    if current is None or not (CGROUP_ROOT / "cgroup.controllers").exists():
+        return
+    # A sibling of the current cgroup: processes may only live in leaves.
+    target = current.parent / f"iptvselect-{kind}"
+    try:
+        target.mkdir(exist_ok=True)
+        for controller, name in (("cpu", "cpu_weight"), ("io", "io_weight")):
+            weight_file = target / f"{controller}.weight"
+            if weight_file.exists():
+                weight = min(max(settings[name], 1), 10000)
+                weight_file.write_text(f"{weight}\n" if controller == "cpu" else f"default {weight}\n")
+        (target / "cgroup.procs").write_text(f"{pid}\n")
+    except OSError as e:
+        logging.info("cgroup %s unavailable: %s", target, e)
+        return
+    logging.info("Process %d moved to cgroup %s", pid, target)
+
+
+def apply_priority(constants: ConfigParser, kind: str, pid: int = 0):
+    """
+    Give the process `pid` (this one by default) the CPU and I/O priority of
+    `kind`: capture, fusion, check or maintenance. The children started
+    afterwards inherit it. Failures are logged and otherwise ignored.
+    """
+    settings = priority_settings(constants, kind)
+    pid = pid or os.getpid()
+    try:
+        process = psutil.Process(pid)
+    except psutil.Error as e:
+        logging.warning("Cannot set priority of %d: %s", pid, e)
+        return
+
+    try:
+        if process.nice() != settings["nice"]:
+            process.nice(settings["nice"])
+    except (psutil.Error, OSError) as e:
+        logging.info("Cannot set nice %s for %s: %s", settings["nice"], kind, e)
+
+    ioclass = IOCLASSES.get(settings["ioclass"])
+    if ioclass is None:
+        logging.warning("Unknown ionice class %r for %s", settings["ioclass"], kind)
+    else:
+        try:
+            if ioclass == psutil.IOPRIO_CLASS_BE:
+                process.ionice(ioclass, min(max(settings["iolevel"], 0), 7))
+            else:
+                process.ionice(ioclass)
+        except (psutil.Error, OSError, AttributeError) as e:
+            logging.info("Cannot set ionice %s for %s: %s", settings["ioclass"], kind, e)
+
+    if config_bool(constants, "PRIORITY", "cgroups", False):
+        join_cgroup(kind, settings, pid)
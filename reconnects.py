@@ -0,0 +1,113 @@
+import logging
+import random
+import time
+
+from configparser import ConfigParser
+from pathlib import Path
+
+from recording_storage import DATA_DIR, config_int, locked_json, read_json
+
+RECONNECTS_PATH = DATA_DIR / "reconnects.json"
+
+DEFAULT_RATE_PER_MINUTE = 6
+DEFAULT_BURST = 4
+DEFAULT_BACKOFF_BASE = 10
+DEFAULT_BACKOFF_MAX = 300
+DEFAULT_STREAMLINK_RETRY_STREAMS = 5
+DEFAULT_STREAMLINK_RETRY_MAX = 6
+
+# A connection that lived this long counts as a success.
+HEALTHY_SECONDS = 60
+
+
+class ReconnectLimiter:
+    """
+    Pace the connections all the recorders of the box open to each provider.
+
+    Every provider has a token bucket, shared through a JSON state file:
+    `burst` connections at once, refilled at `rate` per minute. A failed
+    connection also sets an exponential backoff with jitter, during which
+    nobody connects to that provider. Failures reported while a backoff
+    runs belong to the same outage and do not lengthen it, so twelve
+    recorders failing together count once. A success clears the backoff.
+    """
+
+    def __init__(self, constants: ConfigParser, path: Path = RECONNECTS_PATH):
+        self.path = path
+        self.rate = max(config_int(constants, "RECONNECT", "rate_per_minute", DEFAULT_RATE_PER_MINUTE), 1)
+        self.burst = max(config_int(constants, "RECONNECT", "burst", DEFAULT_BURST), 1)
+        self.backoff_base = config_int(constants, "RECONNECT", "backoff_base", DEFAULT_BACKOFF_BASE)
+        self.backoff_max = config_int(constants, "RECONNECT", "backoff_max", DEFAULT_BACKOFF_MAX)
+
+    def entry(self, state: dict, provider: str, now: float) -> dict:
+        entry = state.setdefault(
+            provider, {"tokens": self.burst, "updated": now, "failures": 0, "retry_at": 0}
+        )
+        elapsed = max(now - entry["updated"], 0)
+        entry["tokens"] = min(self.burst, entry["tokens"] + elapsed * self.rate / 60)
+        entry["updated"] = now
+        return entry
+
+    def acquire(self, provider: str) -> float:
+        """
+        Take a connection token for `provider` and return 0, or return the
+        seconds to wait before asking again.
+        """
+        now = time.time()
+        with locked_json(self.path, {}) as state:
+            entry = self.entry(state, provider, now)
+            if now < entry["retry_at"]:
+                return entry["retry_at"] - now
+            if entry["tokens"] < 1:
+                return (1 - entry["tokens"]) * 60 / self.rate
+            entry["tokens"] -= 1
+            return 0
+
+    def wait(self, provider: str, deadline: float) -> bool:
+        """Block until a connection to `provider` is allowed; return False if `deadline` came first."""
+        logged = False
+        while True:
+            delay = self.acquire(provider)
+            if delay <= 0:
+                return True
+            if time.time() + delay >= deadline:
+                return False
+            if not logged:
+                logging.info("Reconnexion à %s différée de %d s", provider, delay)
+                logged = True
+            time.sleep(delay)
+
+    def failure(self, provider: str):
+        """Report a failed connection to `provider`."""
+        now = time.time()
+        with locked_json(self.path, {}) as state:
+            entry = self.entry(state, provider, now)
+            if now < entry["retry_at"]:
+                return
+            entry["failures"] += 1
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (entry["failures"] - 1))
+            entry["retry_at"] = now + random.uniform(delay / 2, delay)
+            if entry["failures"] > 1:
+                logging.warning(
+                    "%d échecs de connexion à %s, nouvel essai dans %d s",
+                    entry["failures"], provider, entry["retry_at"] - now,
+                )
+
+    def success(self, provider: str):
+        """Report that a connection to `provider` works."""
+        if not read_json(self.path, {}).get(provider, {}).get("failures"):
+            return
+        with locked_json(self.path, {}) as state:
+            if provider in state:
+                state[provider]["failures"] = 0
+                state[provider]["retry_at"] = 0
+
+
+def streamlink_retry_args(constants: ConfigParser) -> list:
+    """Return the streamlink options retrying to open a stream."""
+    return [
+        "--retry-streams",
+        str(config_int(constants, "RECONNECT", "streamlink_retry_streams", DEFAULT_STREAMLINK_RETRY_STREAMS)),
+        "--retry-max",
+        str(config_int(constants, "RECONNECT", "streamlink_retry_max", DEFAULT_STREAMLINK_RETRY_MAX)),
+    ]
@@ -6,6 +6,8 @@ import os
 import psutil
 import signal
 import shutil
+import threading
+import sys
 
 from pathlib import Path
 from datetime import datetime
@@ -13,6 +15,79 @@ from configparser import ConfigParser
 from typing import Optional
 from getpass import getuser
 
+from admission import DiskAdmission
+from bandwidth import BandwidthBudget, fetch_variants
+from eit import (
+    DEFAULT_MARGIN_MINUTES,
+    DEFAULT_MAX_EXTEND_MINUTES,
+    DEFAULT_MAX_TRIM_MINUTES,
+    FFMPEG_ARGS as EIT_FFMPEG_ARGS,
+    EitWatcher,
+    publish_programme,
+    published_programme,
+    withdraw_programme,
+)
+from priorities import apply_priority
+from failover import (
+    DEFAULT_MAX_FAILURES,
+    DEFAULT_SOURCE_STALL_SECONDS,
+    SourceCandidates,
+    publish_source,
+    published_sources,
+    withdraw_source,
+)
+from recording_manifest import RecordingManifest, SegmentClock, manifest_path, read_manifest
+from recover_recordings import active_end, register_active, unregister_active
+from relay import consumer_link, ensure_relay, find_relay, relay_enabled, relay_lines
+from standby import (
+    CHECK_INTERVAL,
+    DEFAULT_BUFFER_SECONDS,
+    DEFAULT_RECOVER_SECONDS,
+    DEFAULT_STALL_SECONDS,
+    StandbyRecorder,
+    publish_primary,
+    withdraw_primary,
+)
+from ts_index import SegmentIndexer
+from timeshift import (
+    DEFAULT_LEAD_MINUTES,
+    RingReader,
+    ring_key,
+    ring_paths,
+    running_timeshifts,
+    timeshift_lines,
+)
+from segment_race import (
+    DEFAULT_HOLD,
+    SegmentRace,
+    is_hls,
+    race_covering,
+    race_lines,
+    register_race,
+    unregister_race,
+)
+from recording_storage import (
+    BitrateHistory,
+    config_bool,
+    config_int,
+    load_constants,
+    preallocate,
+    release_preallocation,
+    save_dir,
+)
+from reconnects import ReconnectLimiter, streamlink_retry_args
+from stream_select import StreamSelection, policy_restricts_audio, stream_policy, stream_selection
+from staging import (
+    DEFAULT_CHUNK_KB,
+    DEFAULT_HARD_MAX_MB,
+    DEFAULT_MAX_MB,
+    DEFAULT_MIN_MEM_MB,
+    STAGING_DIR,
+    StagedWriter,
+    recover_staged,
+    staging_possible,
+)
+
 parser = argparse.ArgumentParser()
 parser.add_argument("title")
 parser.add_argument("provider")
@@ -20,6 +95,9 @@ parser.add_argument("recorder")
 parser.add_argument("m3u8_link")
 parser.add_argument("duration")
 parser.add_argument("save")
+parser.add_argument("--channel", default="")
+parser.add_argument("--start", default="", help="scheduled start, YYYYMMDDHHMM")
+parser.add_argument("--resume", action="store_true", help="continue an interrupted recording")
 args = parser.parse_args()
 
 
@@ -217,6 +295,85 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+# ---------- Storage ----------
+constants = load_constants()
+apply_priority(constants, "capture")
+video_dir = save_dir(constants, safe_title, args.provider, args.save)
+bitrates = BitrateHistory(constants)
+preallocation = config_bool(constants, "STORAGE", "preallocate", True)
+
+
+def segment_path(position: int) -> Path:
+    """Return the path of the recorded segment number `position`."""
+    return video_dir / f"{safe_title}_{args.provider}_{position}_{args.save}.ts"
+
+
+def reserve_segment(path: Path, seconds: int):
+    """Preallocate the expected size of `seconds` of recording for `path`."""
+    if not preallocation:
+        return
+    nbytes = bitrates.estimate_bytes(args.provider, args.channel, seconds)
+    preallocate(path, nbytes)
+
+
+# Recorders may write to tmpfs; a StagedWriter per segment copies the data
+# to the storage in large sequential chunks.
+staging = config_bool(constants, "STAGING", "enabled", False)
+staging_dir = Path(constants.get("STAGING", "dir", fallback="").strip() or STAGING_DIR).expanduser()
+staging_max = config_int(constants, "STAGING", "max_mb", DEFAULT_MAX_MB) * 2**20
+staging_hard_max = config_int(constants, "STAGING", "hard_max_mb", DEFAULT_HARD_MAX_MB) * 2**20
+staging_chunk = config_int(constants, "STAGING", "chunk_kb", DEFAULT_CHUNK_KB) * 1024
+staging_min_mem = config_int(constants, "STAGING", "min_mem_mb", DEFAULT_MIN_MEM_MB) * 2**20
+staged_writers = {}
+
+
+segment_clocks = {}
+# Sidecar TS indexes, built from the final files as they grow.
+segment_indexers = {}
+
+
+def start_clock(position: int, path: Path):
+    """Watch for the first bytes and timestamps of segment `position`, and index it."""
+    if position not in segment_clocks:
+        segment_clocks[position] = SegmentClock(manifest, position, path)
+        segment_clocks[position].start()
+    if position not in segment_indexers:
+        segment_indexers[position] = SegmentIndexer(segment_path(position))
+        segment_indexers[position].start()
+
+
+def recorder_path(position: int) -> Path:
+    """Return the file the recorder of segment `position` writes to."""
+    if position in staged_writers:
+        return staged_writers[position].staged
+    return segment_path(position)
+
+
+def open_segment(position: int, seconds: int) -> Path:
+    """Prepare segment `position` and return the path its recorder must write to."""
+    final = segment_path(position)
+    for writer in staged_writers.values():
+        writer.close()
+
+    path = final
+    if staging and staging_possible(staging_dir, staging_max, staging_min_mem):
+        path = staging_dir / final.name
+        writer = StagedWriter(path, final, staging_chunk, staging_max, staging_min_mem, staging_hard_max)
+        writer.start()
+        staged_writers[position] = writer
+    elif staging:
+        logging.info("Mémoire insuffisante pour le staging, écriture directe de %s", final.name)
+
+    # Only ffmpeg and vlc keep the blocks of a file they did not create.
+    if path != final or args.recorder in ("ffmpeg", "vlc"):
+        reserve_segment(final, seconds)
+    if args.save == "original":
+        publish_primary(args.title, path)
+    start_clock(position, path)
+    watch_programme(path)
+    return path
+
+
 # ---------- main variables ----------
 date_now_epoch = datetime.now().timestamp()
 try:
@@ -226,52 +383,80 @@ except Exception:
     duration_int = 0
 end_video = date_now_epoch + duration_int
 
+try:
+    scheduled_start = datetime.strptime(args.start, "%Y%m%d%H%M").timestamp()
+except ValueError:
+    scheduled_start = date_now_epoch
+
+# A job started late (scheduled after the programme began) stops at the
+# scheduled end; the missed part may come from a timeshift ring.
+if date_now_epoch - scheduled_start > 60:
+    end_video = scheduled_start + duration_int
+
+# A resumed recording keeps the end the programme guide moved it to.
+scheduled_end = end_video
+if args.resume:
+    resumed_end = active_end(args.title, args.save)
+    if resumed_end is not None:
+        end_video = resumed_end
+
 record_position = 0
 
 
+def write_start_time(time_movie: float, position: Optional[int] = None):
+    """Record in the manifest that a segment (the current one by default) starts at `time_movie`."""
+    position = record_position if position is None else position
+    manifest.start(
+        position, segment_path(position), time_movie,
+        candidates.provider, candidates.origin, candidates.url,
+    )
+    # Segments not written by a recorder get their timestamps from their head.
+    start_clock(position, recorder_path(position))
+
+
+def end_segment(reason: str, position: Optional[int] = None):
+    """Record in the manifest that a segment (the current one by default) is closed."""
+    position = record_position if position is None else position
+    end = datetime.now().timestamp()
+    nbytes = None
+    # The last write to the file is when its data ends: stalls and exits are
+    # only noticed at the next check. A staged segment may not be fully on
+    # the storage yet, but its tmpfs file keeps its full size.
+    try:
+        stat = recorder_path(position).stat()
+        nbytes = stat.st_size
+        if nbytes:
+            end = min(end, stat.st_mtime)
+    except OSError:
+        pass
+    manifest.end(position, end, reason, nbytes)
+    if position in segment_indexers:
+        segment_indexers[position].close()
+
+
 def start_or_kill():
     """
-    Write time recording beginning in start_time files or kill
+    Record the start of the segment in the manifest or kill the
     recorder command
     """
-    # Build safe file path components for filesystem use
-    safe_title = sanitize_filename(args.title)
-
-    file_path = Path(
-        f"/home/{user}/videos_select/{safe_title}-save/{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-    )
+    file_path = recorder_path(record_position)
 
-    if file_path.exists():
-        ls_video = str(file_path)
-    else:
-        ls_video = None
-
-    expected_path = (
-        "/home/"
-        + user
-        + "/videos_select/{title}-save/{title}_{provider}_{record_position}_{save}.ts".format(
-            title=safe_title,
-            provider=args.provider,
-            record_position=record_position,
-            save=args.save,
-        )
-    )
-
-    if ls_video == expected_path:
-        time_now_epoch = datetime.now().timestamp()
-        time_movie = round(time_now_epoch - 30)
+    # The file may already exist empty when its space was preallocated, so
+    # only a file holding data proves that the recorder started.
+    try:
+        started = file_path.stat().st_size > 0
+    except OSError:
+        started = False
+
+    if started:
+        clock = segment_clocks.get(record_position)
+        if clock is not None and clock.first_byte is not None:
+            time_movie = clock.first_byte
+        else:
+            time_movie = datetime.now().timestamp() - 30
 
         logging.info("Started!!!!")
-
-        start_time_file = Path(
-            f"/home/{user}/videos_select/{safe_title}-save/start_time_{safe_title}_{args.provider}_{args.save}.txt"
-        )
-        try:
-            start_time_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(start_time_file, "a", encoding="utf-8") as file:
-                file.write(str(time_movie) + "\n")
-        except Exception as e:
-            logging.exception("Failed to write start_time file %s: %s", start_time_file, e)
+        write_start_time(time_movie)
     else:
         search_string = f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
 
@@ -308,34 +493,72 @@ def start_or_kill():
     iptv provider is below the maximum allowed:
 """
 
-max_iptv_provider = 0
+# A recording joining a running relay of its channel needs no extra line.
+use_relay = relay_enabled(constants, args.provider) and bool(args.channel)
+shared_relay = find_relay(args.provider, args.channel) if use_relay else None
+
 config_iptv_select_keys = ["iptv_provider", "iptv_backup", "iptv_backup_2"]
 
-for key in config_iptv_select.keys():
-    if str(key) != "DEFAULT":
-        for iptv_function in config_iptv_select_keys:
-            try:
-                if config_iptv_select[str(key)][iptv_function] == args.provider:
-                    max_iptv_provider += 1
-            except Exception:
-                # Missing key/section -- ignore and continue
-                continue
 
-# Build a robust proc_count_provider by checking cmdline via psutil safely
-proc_count_provider = 0
-for proc in psutil.process_iter(["cmdline"]):
-    try:
-        cmdline = proc.info.get("cmdline")
-        if cmdline:
-            joined = " ".join(cmdline)
-            if "record_iptv.py" in joined and args.provider in joined:
-                proc_count_provider += 1
-    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-        continue
-    except Exception:
-        continue
+def max_provider_lines(provider: str) -> int:
+    """Return the number of lines of `provider` configured in iptv_select_conf.ini."""
+    max_iptv_provider = 0
+    for key in config_iptv_select.keys():
+        if str(key) != "DEFAULT":
+            for iptv_function in config_iptv_select_keys:
+                try:
+                    if config_iptv_select[str(key)][iptv_function] == provider:
+                        max_iptv_provider += 1
+                except Exception:
+                    # Missing key/section -- ignore and continue
+                    continue
+    return max_iptv_provider
+
+
+def count_provider_recordings(provider: str) -> int:
+    """Return the number of record_iptv.py processes recording from `provider`."""
+    # Recorders publish their current source, which failover may have moved
+    # away from the provider of their command line.
+    sources = published_sources()
+    proc_count_provider = sum(
+        1 for source in sources.values()
+        if source["provider"] == provider and not source.get("relayed")
+    )
+    # Build a robust proc_count_provider by checking cmdline via psutil safely
+    for proc in psutil.process_iter(["pid", "cmdline"]):
+        try:
+            cmdline = proc.info.get("cmdline")
+            if cmdline and proc.info["pid"] not in sources:
+                joined = " ".join(cmdline)
+                if "record_iptv.py" in joined and provider in joined:
+                    proc_count_provider += 1
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            continue
+        except Exception:
+            continue
+    # Segment races, timeshift rings and relays, even lingering without
+    # consumers, also hold lines of the provider.
+    return proc_count_provider + race_lines(provider) + timeshift_lines(provider) + relay_lines(provider)
+
+
+def has_free_line(provider: str) -> bool:
+    """Return True when another recording may be started on `provider`."""
+    if relay_enabled(constants, provider) and args.channel and find_relay(provider, args.channel):
+        return True
+    return count_provider_recordings(provider) < max_provider_lines(provider)
+
+
+if args.save != "original" and race_covering(args.title, args.provider):
+    logging.info(
+        "La sauvegarde %s de la vidéo %s n'est pas enregistrée: la course de segments"
+        " lit déjà %s.", args.save, args.title, args.provider,
+    )
+    exit()
 
-if int(proc_count_provider) > max_iptv_provider:
+max_iptv_provider = max_provider_lines(args.provider)
+proc_count_provider = count_provider_recordings(args.provider)
+
+if shared_relay is None and int(proc_count_provider) > max_iptv_provider:
     logging.info("max_iptv_provider:" + str(max_iptv_provider))
     logging.info("proc_count_provider:" + str(proc_count_provider))
     logging.info(
@@ -344,9 +567,229 @@ if int(proc_count_provider) > max_iptv_provider:
     )
     exit()
 
+# ---------- Disk admission ----------
+disk_admission = DiskAdmission(constants)
+
+if not disk_admission.confirm(args.title, args.save, args.provider, args.channel, duration_int):
+    if args.save != "original":
+        logging.info(
+            "La sauvegarde %s de la vidéo %s ne sera pas enregistrée faute d'espace disque.",
+            args.save, args.title,
+        )
+        exit()
+    logging.warning(
+        "L'espace disque risque de manquer pour enregistrer la vidéo %s en entier.", args.title
+    )
+
+# ---------- Bandwidth budget ----------
+bandwidth_budget = BandwidthBudget(constants, args.save)
+variants = []
+if bandwidth_budget.enabled and shared_relay:
+    bandwidth_budget.register([], 0)
+elif bandwidth_budget.enabled:
+    variants = fetch_variants(args.m3u8_link)
+    bandwidth_budget.register(
+        [bandwidth for bandwidth, _ in variants],
+        bitrates.estimate(args.provider, args.channel) * 8,
+    )
+
+
+def pick_variant_link(current: str) -> str:
+    """Return the HLS variant of the source allowed by the bandwidth budget."""
+    if not variants:
+        return current
+    chosen = bandwidth_budget.choose()
+    for bandwidth, url in variants:
+        if bandwidth == chosen:
+            return url
+    return current
+
+
+def stop_recorder():
+    """Kill the recorder writing the current segment."""
+    pid_list = find_pids_by_pattern(str(recorder_path(record_position)))
+    if pid_list:
+        kill_pids(pid_list)
+
+
+record_link = pick_variant_link(args.m3u8_link)
+if record_link != args.m3u8_link:
+    logging.info("Variante HLS retenue pour le budget de bande passante: %s", record_link)
+
+# ---------- Local relay ----------
+def relay_link(source_provider: str, url: str, consumer_id: str, since: float) -> Optional[str]:
+    """Return the link of the local relay reading `url` for this recording, or None."""
+    local_link = ensure_relay(source_provider, args.channel, url)
+    if not local_link:
+        logging.warning("Relais local indisponible, connexion directe à la source")
+        return None
+    logging.info("Enregistrement via le relais local %s", local_link)
+    local_link = consumer_link(local_link, consumer_id, since)
+    if args.recorder == "streamlink":
+        local_link = "httpstream://" + local_link
+    return local_link
+
+
+relayed = False
+if use_relay:
+    local_link = relay_link(args.provider, record_link, f"{safe_title}_{args.save}", scheduled_start)
+    relayed = bool(local_link)
+    if local_link:
+        if variants:
+            # The relay keeps the variant chosen now for every consumer.
+            chosen = [bandwidth for bandwidth, url in variants if url == record_link]
+            bandwidth_budget.register([], chosen[0] if chosen else variants[0][0])
+            variants = []
+        record_link = local_link
+publish_source(args.provider, relayed)
+
+# ---------- Reconnections ----------
+reconnects = ReconnectLimiter(constants)
+
+
+def reconnect_allowed() -> bool:
+    """
+    Report that the connection to the current source was lost and return
+    True when the provider accepts a new one now.
+    """
+    reconnects.failure(candidates.provider)
+    return reconnects.acquire(candidates.provider) == 0
+
+
+# ---------- Stream selection ----------
+stream_selections = {}
+
+
+def selection_for(link: str) -> StreamSelection:
+    """Return the streams to record from `link`, probed once per link."""
+    if link not in stream_selections:
+        probe_link = link
+        if probe_link.startswith("httpstream://"):
+            probe_link = probe_link[len("httpstream://"):]
+        if probe_link.startswith("http://127.0.0.1:"):
+            # A relay consumer id must not be used up by the probe.
+            probe_link = probe_link.split("?", 1)[0]
+        stream_selections[link] = stream_selection(constants, args.channel, probe_link)
+    return stream_selections[link]
+
+
+def ffmpeg_input_args(link: str) -> list:
+    """Leading arguments of the ffmpeg recorder of `link`, also matched to find it among the processes."""
+    return ["ffmpeg", "-i", str(link), *selection_for(link).ffmpeg_maps()]
+
+
+# ---------- Source failover ----------
+candidates = SourceCandidates(
+    args.provider,
+    args.channel,
+    args.m3u8_link,
+    config_iptv_select,
+    max_failures=config_int(constants, "FAILOVER", "max_failures", DEFAULT_MAX_FAILURES),
+)
+manifest = RecordingManifest(manifest_path(video_dir, safe_title, args.provider, args.save))
+
+# ---------- Crash recovery ----------
+# Until the end of the recording, recover_recordings.py restarts it with
+# --resume if this process dies.
+register_active(args.title, args.save, sys.argv[1:], end_video, log_filename)
+
+# Where the interrupted recording stopped; the timeshift may fill the gap.
+resumed_at = None
+if args.resume:
+    previous = manifest.resume()
+    for segment in previous:
+        if segment["end"] is None:
+            flushed = recover_staged(staging_dir / segment["path"].name, segment["path"])
+            if flushed:
+                logging.info("%d Mo récupérés du staging de %s", flushed // 2**20, segment["path"].name)
+            release_preallocation(segment["path"])
+            end_segment("crashed", segment["segment"])
+    previous = read_manifest(manifest.path)
+    if previous:
+        record_position = previous[-1]["segment"]
+        resumed_at = max(segment["end"] or segment["start"] for segment in previous)
+    logging.info(
+        "Reprise de l'enregistrement %s après le segment %d pour %d s",
+        args.title, record_position, end_video - date_now_epoch,
+    )
+
+
+# ---------- Programme boundaries ----------
+# The EIT present/following table carried by the recorded stream moves the
+# end of the recording to the real end of the programme, within limits.
+eit_margin = config_int(constants, "EIT", "margin_minutes", DEFAULT_MARGIN_MINUTES) * 60
+latest_end = scheduled_end + config_int(constants, "EIT", "max_extend_minutes", DEFAULT_MAX_EXTEND_MINUTES) * 60
+earliest_end = scheduled_end - config_int(constants, "EIT", "max_trim_minutes", DEFAULT_MAX_TRIM_MINUTES) * 60
+eit_watcher = None
+if config_bool(constants, "EIT", "enabled", False):
+    eit_watcher = EitWatcher(args.title)
+    eit_watcher.start()
+
+
+def watch_programme(path: Path):
+    """Read the EIT of the segment written to `path`."""
+    if eit_watcher is not None:
+        eit_watcher.follow(path)
+
+
+def apply_programme():
+    """Move the end of the recording to the end of the programme found in the EIT."""
+    global end_video
+    if eit_watcher is None:
+        return
+    boundaries = eit_watcher.boundaries()
+    if boundaries is not None:
+        manifest.programme(boundaries["name"], boundaries["start"], boundaries["end"], boundaries["final"])
+        publish_programme(args.title, boundaries)
+    else:
+        # Another role of the programme may have found it.
+        boundaries = published_programme(args.title)
+    if not boundaries or boundaries["end"] is None or boundaries["end"] < scheduled_start:
+        return
+    end = boundaries["end"]
+    if not boundaries["final"]:
+        # Still on air: it lasts at least until now.
+        end = max(end, datetime.now().timestamp())
+    wanted = min(max(end + eit_margin, earliest_end), latest_end)
+    if abs(wanted - end_video) < 60:
+        return
+    logging.info(
+        "Fin de l'enregistrement de %s déplacée de %s à %s d'après l'EIT (%s)",
+        args.title,
+        datetime.fromtimestamp(end_video).strftime("%H:%M:%S"),
+        datetime.fromtimestamp(wanted).strftime("%H:%M:%S"),
+        boundaries["name"],
+    )
+    end_video = wanted
+    register_active(args.title, args.save, sys.argv[1:], end_video, log_filename)
+
+
+def switch_source_link() -> str:
+    """Return the link to record from once switched to the current candidate source."""
+    global variants
+    variants = []
+    if bandwidth_budget.enabled:
+        bandwidth_budget.register([], bitrates.estimate(candidates.provider, args.channel) * 8)
+    if relay_enabled(constants, candidates.provider) and args.channel:
+        local_link = relay_link(
+            candidates.provider,
+            candidates.url,
+            f"{safe_title}_{args.save}_{candidates.index}",
+            datetime.now().timestamp(),
+        )
+        if local_link:
+            publish_source(candidates.provider, relayed=True)
+            return local_link
+    publish_source(candidates.provider)
+    return candidates.url
+
+
 date_now = datetime.now().timestamp()
 
-dir_path = f"/home/{user}/videos_select/{safe_title}-save/{safe_title}-to-watch"
+if args.save == "original":
+    dir_path = video_dir / f"{safe_title}-to-watch"
+else:
+    dir_path = video_dir
 try:
     os.makedirs(dir_path, exist_ok=True)
 except Exception:
@@ -355,71 +798,281 @@ except Exception:
 file_size = 0
 new_file_size = 1
 
-while date_now < end_video:
-    if args.recorder == "ffmpeg":
+# ---------- Timeshift ----------
+# Seconds the ring keeps being copied after the recording started, so that
+# it overlaps the first live segment. Without a live segment, it is copied
+# up to the end of the recording.
+RING_FOLLOW = 90
+
+ring_thread = None
+ring_copy = {"bytes": 0}
+if args.channel and ring_key(args.provider, args.channel) in running_timeshifts():
+    lead_seconds = config_int(constants, "TIMESHIFT", "lead_minutes", DEFAULT_LEAD_MINUTES) * 60
+    ring_reader = RingReader(*ring_paths(args.provider, args.channel))
+    ring_since = resumed_at if resumed_at else scheduled_start - lead_seconds
+    try:
+        ring_start = ring_reader.locate(ring_since)
+    except (OSError, ValueError) as e:
+        logging.warning("Timeshift illisible pour %s: %s", args.channel, e)
+        ring_start = None
+    if ring_start and ring_start[0] < date_now - 30:
+        record_position += 1
+        ring_path = segment_path(record_position)
+        logging.info(
+            "Récupération de %d s passées de %s depuis le timeshift",
+            date_now - ring_start[0], args.channel,
+        )
+        ring_position = record_position
+        write_start_time(ring_start[0])
 
-        # pattern used only for counting processes (not passing to ffmpeg)
-        proc_count = count_procs_by_pattern(safe_for_pattern(f"ffmpeg -i {args.m3u8_link} -map 0:v"))
+        ring_follow_until = datetime.now().timestamp() + RING_FOLLOW
+
+        def ring_until() -> float:
+            # end_video moves with the programme guide.
+            if record_position == ring_position:
+                return end_video
+            return min(ring_follow_until, end_video)
 
-        p = (Path.home()
-             / "videos_select"
-             / f"{safe_title}-save"
-             / f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
+        def copy_ring():
+            try:
+                _, ring_copy["bytes"] = ring_reader.copy_out(ring_since, ring_path, ring_until)
+            except Exception as e:
+                logging.exception("Timeshift copy failed: %s", e)
+            end_segment("timeshift", ring_position)
+
+        ring_thread = threading.Thread(target=copy_ring, daemon=True)
+        ring_thread.start()
+
+# ---------- Segment racing ----------
+def racing_sources() -> list:
+    """
+    Return the (provider, url) HLS sources of the channel to race for the
+    original recording, or [] when it is recorded from a single source.
+    """
+    if args.save != "original" or not config_bool(constants, "RACE", "enabled", False):
+        return []
+    if shared_relay or not is_hls(args.m3u8_link):
+        return []
+    max_sources = config_int(constants, "RACE", "max_sources", 3)
+    sources = [(args.provider, args.m3u8_link)]
+    for provider, _, url in candidates.sources[1:]:
+        if len(sources) >= max_sources:
+            break
+        if provider in [p for p, _ in sources]:
+            continue
+        if has_free_line(provider) and is_hls(url):
+            sources.append((provider, url))
+    return sources if len(sources) > 1 else []
+
+
+race_sources = racing_sources()
+if race_sources:
+    race_providers = [provider for provider, _ in race_sources]
+    logging.info("Course de segments entre les fournisseurs %s", ", ".join(race_providers))
+    register_race(args.title, race_providers)
+    if bandwidth_budget.enabled:
+        bandwidth_budget.register(
+            [], sum(bitrates.estimate(provider, args.channel) * 8 for provider in race_providers)
         )
+    record_position += 1
+    out_path = segment_path(record_position)
+    reserve_segment(out_path, duration_int)
+    publish_primary(args.title, out_path)
+    watch_programme(out_path)
+    race = SegmentRace(
+        race_sources, out_path, end_video, config_int(constants, "RACE", "hold", DEFAULT_HOLD)
+    )
+    try:
+        race.run()
+    except Exception as e:
+        logging.exception("Segment race failed: %s", e)
+    finally:
+        unregister_race()
+    if race.bytes_written:
+        write_start_time(race.start_epoch)
+        end_segment("end" if datetime.now().timestamp() >= end_video else "exited")
+    # Whatever time is left, if the race ended early, is recorded as usual.
+    date_now = datetime.now().timestamp()
 
-        try:
-            new_file_size = p.stat().st_size
-        except FileNotFoundError:
-            new_file_size = 0
-        except PermissionError:
-            new_file_size = 0
+# ---------- Hot standby ----------
+if args.save != "original" and config_bool(constants, "STANDBY", "enabled", False):
+    standby = StandbyRecorder(
+        args.title,
+        args.recorder,
+        config_int(constants, "STANDBY", "buffer_seconds", DEFAULT_BUFFER_SECONDS),
+        config_int(constants, "STANDBY", "stall_seconds", DEFAULT_STALL_SECONDS),
+        streamlink_retry_args(constants),
+    )
+    recover_seconds = config_int(constants, "STANDBY", "recover_seconds", DEFAULT_RECOVER_SECONDS)
+    standby_log = logs_dir / f"infos_{safe_title}_{args.provider}_standby_{args.save}.log"
+    logging.info("Sauvegarde %s en attente, prête à prendre le relais.", args.save)
+    if standby.buffer_seconds > 0:
+        standby.start_pump(record_link, standby_log, selection_for(record_link))
+    healthy_since = None
+
+    while datetime.now().timestamp() < end_video:
+        apply_programme()
+        if race_covering(args.title, args.provider):
+            logging.info("Course de segments en cours sur %s, arrêt de la sauvegarde.", args.provider)
+            break
+        healthy = standby.watch.healthy()
+        pump_dead = standby.pump is None or not standby.pump.alive()
+
+        if standby.writing is None:
+            if standby.buffer_seconds > 0 and pump_dead and standby.restart_due() and reconnect_allowed():
+                if candidates.failure(usable=has_free_line):
+                    record_link = switch_source_link()
+                standby.start_pump(record_link, standby_log, selection_for(record_link))
+            if not healthy:
+                logging.warning(
+                    "L'enregistrement original de %s est interrompu, la sauvegarde %s prend le relais.",
+                    args.title, args.save,
+                )
+                record_position += 1
+                out_path = segment_path(record_position)
+                reserve_segment(out_path, round(end_video - datetime.now().timestamp()))
+                write_start_time(standby.activate(out_path, record_link, standby_log, selection_for(record_link)))
+                watch_programme(out_path)
+                healthy_since = None
+        else:
+            if healthy:
+                healthy_since = healthy_since or datetime.now().timestamp()
+            else:
+                healthy_since = None
+            if healthy_since and datetime.now().timestamp() - healthy_since >= recover_seconds:
+                logging.info(
+                    "L'enregistrement original a repris, la sauvegarde %s se remet en attente.",
+                    args.save,
+                )
+                standby.deactivate()
+                end_segment("standby")
+            elif pump_dead and standby.restart_due() and reconnect_allowed():
+                # Continue in a new segment from a new connection.
+                standby.deactivate()
+                end_reason = "exited"
+                if candidates.failure(usable=has_free_line):
+                    record_link = switch_source_link()
+                    end_reason = "failover"
+                end_segment(end_reason)
+                record_position += 1
+                out_path = segment_path(record_position)
+                reserve_segment(out_path, round(end_video - datetime.now().timestamp()))
+                write_start_time(standby.activate(out_path, record_link, standby_log, selection_for(record_link)))
+                watch_programme(out_path)
+            else:
+                candidates.success()
+                reconnects.success(candidates.provider)
+        time.sleep(CHECK_INTERVAL)
 
+    standby.stop()
+    date_now = end_video
 
-    elif args.recorder == "streamlink":
+# ---------- Recorder watch ----------
+source_stall = config_int(constants, "FAILOVER", "stall_seconds", DEFAULT_SOURCE_STALL_SECONDS)
 
-        proc_count = count_procs_by_pattern(safe_for_pattern(f"{safe_title}_{args.provider}_"
-                                            f"{record_position}_{args.save}.ts "
-                                            f"-f {args.m3u8_link}"))
 
-    elif args.recorder == "vlc":
+def recorder_count() -> int:
+    """Return the number of recorder processes writing the current segment."""
+    if args.recorder == "ffmpeg":
+        # pattern used only for counting processes (not passing to ffmpeg)
+        return count_procs_by_pattern(safe_for_pattern(" ".join(ffmpeg_input_args(record_link))))
+    if args.recorder == "streamlink":
+        return count_procs_by_pattern(safe_for_pattern(f"{safe_title}_{args.provider}_"
+                                      f"{record_position}_{args.save}.ts "
+                                      f"-f {record_link}"))
+    if args.recorder == "vlc":
+        pattern = f"{record_link} --sout file/ts:{recorder_path(record_position)}"
+        return count_procs_by_pattern(safe_for_pattern(pattern))
+    if args.recorder == "mplayer":
+        return count_procs_by_pattern(safe_for_pattern(f"mplayer {record_link} -dumpstream"))
+    return 0
+
+
+def recorder_size() -> int:
+    """Return the bytes written so far by the recorder of the current segment."""
+    try:
+        return recorder_path(record_position).stat().st_size
+    except (FileNotFoundError, PermissionError):
+        return 0
 
-        pattern = (
-            f"{args.m3u8_link} --sout file/ts:/home/{user}/videos_select/"
-            f"{safe_title}-save/{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-        )
 
-        proc_count = count_procs_by_pattern(safe_for_pattern(pattern))
+def watch_recorder(seconds: float) -> str:
+    """
+    Wait up to `seconds`, checking the recorder of the current segment
+    every CHECK_INTERVAL. Return "exited" or "stalled" as soon as it exits
+    or its file, once it holds data, stops growing for source_stall
+    seconds, or "" when it kept recording.
+    """
+    deadline = min(datetime.now().timestamp() + seconds, end_video)
+    size = recorder_size()
+    grown = datetime.now().timestamp()
+    while datetime.now().timestamp() < deadline:
+        time.sleep(CHECK_INTERVAL)
+        if recorder_count() < 1:
+            return "exited"
+        if args.recorder not in ["vlc", "ffmpeg"]:
+            continue
+        current = recorder_size()
+        if current != size:
+            size, grown = current, datetime.now().timestamp()
+        elif size > 0 and datetime.now().timestamp() - grown >= source_stall:
+            return "stalled"
+    return ""
+
 
-        p = (Path.home()
-             / "videos_select"
-             / f"{safe_title}-save"
-             / f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-        )
+# The end given to the running recorder; it stops there by itself.
+recorder_until = end_video
+watched = ""
 
-        try:
-            new_file_size = p.stat().st_size  # size in bytes
-        except (FileNotFoundError, PermissionError):
-            new_file_size = 0
+while date_now < end_video:
+    apply_programme()
 
-    elif args.recorder == "mplayer":
+    # A segment race of this programme reading our provider replaces the backup.
+    if args.save != "original" and race_covering(args.title, args.provider):
+        logging.info("Course de segments en cours sur %s, arrêt de la sauvegarde.", args.provider)
+        stop_recorder()
+        break
+
+    if args.save == "original":
+        publish_primary(args.title, recorder_path(record_position))
 
-        proc_count = count_procs_by_pattern(safe_for_pattern(f"mplayer {args.m3u8_link} -dumpstream"))
+    variant_switch = False
+    if variants and record_position > 0:
+        wanted_link = pick_variant_link(record_link)
+        if wanted_link != record_link:
+            logging.info(
+                "Budget de bande passante: passage de la variante %s à %s", record_link, wanted_link
+            )
+            stop_recorder()
+            record_link = wanted_link
+            variant_switch = True
+
+    # A full tmpfs staging ends the segment; the next ones are written directly.
+    staging_overflow = (
+        record_position in staged_writers and staged_writers[record_position].overflowed.is_set()
+    )
+    if staging_overflow:
+        logging.info("Staging plein, l'enregistrement continue en écriture directe.")
+        staging = False
+        stop_recorder()
+
+    proc_count = recorder_count()
+    if args.recorder in ["vlc", "ffmpeg"]:
+        new_file_size = recorder_size()
 
     date_now = datetime.now().timestamp()
     left_time = round(end_video - date_now)
 
     if left_time <= 0:
         if args.recorder == "ffmpeg":
-            pattern = safe_for_pattern(f"ffmpeg -i {args.m3u8_link} -map 0:v")
+            pattern = safe_for_pattern(" ".join(ffmpeg_input_args(record_link)))
         elif args.recorder == "vlc":
             pattern = safe_for_pattern(
-                f"{args.m3u8_link} --sout file/ts:/home/{user}"
-                f"/videos_select/{safe_title}-save/{safe_title}"
+                f"{record_link} --sout file/ts:{recorder_path(record_position).parent}/{safe_title}"
             )
         elif args.recorder == "mplayer":
             pattern = safe_for_pattern(
-                f"mplayer {args.m3u8_link} -dumpstream "
-                f"-dumpfile /home/{user}/videos_select/{safe_title}-save"
+                f"mplayer {record_link} -dumpstream -dumpfile {recorder_path(record_position).parent}"
             )
         else:
             pattern = None
@@ -432,7 +1085,7 @@ while date_now < end_video:
 
     new_file = False
 
-    if int(proc_count) < 1 or (
+    if variant_switch or staging_overflow or int(proc_count) < 1 or watched == "stalled" or (
         args.recorder in ["vlc", "ffmpeg"] and file_size == new_file_size
     ):
         logging.info("!!!! New file !!!!!!!")
@@ -445,18 +1098,47 @@ while date_now < end_video:
             + str(proc_count)
         )
 
+        # A restart that is not a variant switch or a staging overflow means
+        # the source failed.
+        if variant_switch:
+            end_reason = "variant_switch"
+        elif staging_overflow:
+            end_reason = "staging"
+        elif int(proc_count) < 1:
+            end_reason = "exited"
+        else:
+            end_reason = "stalled"
+        # A recorder reaching the end it was given before the EIT extended
+        # the recording did not fail.
+        switched = variant_switch or staging_overflow
+        planned = not switched and date_now >= recorder_until - 60
+        if planned:
+            end_reason = "end"
+        if record_position > 0 and not switched and not planned:
+            reconnects.failure(candidates.provider)
+            # A source that stalls is not retried.
+            if candidates.failure(usable=has_free_line, stalled=end_reason == "stalled"):
+                stop_recorder()
+                record_link = switch_source_link()
+                end_reason = "failover"
+            elif end_reason == "stalled":
+                stop_recorder()
+        end_segment(end_reason)
+
+        # Every reconnection waits for the provider to accept one.
+        if record_position > 0 and not reconnects.wait(candidates.provider, end_video):
+            logging.info("Fin du programme pendant l'attente de reconnexion à %s", candidates.provider)
+            break
+
         record_position += 1
+        recorder_until = end_video
 
         if args.recorder == "ffmpeg":
 
             left_time_str = str(left_time)
 
             home = Path.home()
-            out_path = (home
-                        / "videos_select"
-                        / f"{safe_title}-save"
-                        / f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-                        )
+            out_path = open_segment(record_position, left_time)
 
             log_dir = home / ".local" / "share" / "iptvselect-fr" / "logs"
             try:
@@ -468,11 +1150,8 @@ while date_now < end_video:
                         )
 
             base_args = [
-                "ffmpeg",
-                "-i", str(args.m3u8_link),
-                "-map", "0:v",
-                "-map", "0:a",
-                "-map", "0:s?",
+                *ffmpeg_input_args(record_link),
+                *(EIT_FFMPEG_ARGS if eit_watcher is not None else []),
                 "-c:v", "copy",
                 "-c:a", "copy",
                 "-c:s", "copy",
@@ -480,7 +1159,7 @@ while date_now < end_video:
                 "-f", "mpegts",
             ]
 
-            if args.provider == "freeboxtv":
+            if candidates.provider == "freeboxtv":
                 extra = ["-fflags", "nobuffer", "-err_detect", "ignore_err"]
             else:
                 extra = [
@@ -490,7 +1169,8 @@ while date_now < end_video:
                     "-reconnect_at_eof",
                 ]
 
-            ffmpeg_cmd = base_args + extra + ["-y", str(out_path)]
+            # Keep the preallocated blocks: write over the file instead of truncating it.
+            ffmpeg_cmd = base_args + extra + ["-truncate", "0", "-y", str(out_path)]
 
             try:
                 with open(log_path, "ab") as log_fh:
@@ -505,15 +1185,10 @@ while date_now < end_video:
                         logging.exception("Failed to launch ffmpeg subprocess: %s", e)
                         record = None
 
-                    # Sleep to allow the process to create the file
-                    time.sleep(30)
+                    # Let the process connect and create the file
+                    watch_recorder(30)
 
-                    p = (
-                        Path.home()
-                        / "videos_select"
-                        / f"{safe_title}-save"
-                        / f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-                    )
+                    p = recorder_path(record_position)
 
                     logging.info("Checking file size for: %s", p)
 
@@ -546,10 +1221,7 @@ while date_now < end_video:
                                / "bin" / "streamlink"
                             )
 
-            output_file = (
-                home / "videos_select" / f"{safe_title}-save" /
-                f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-            )
+            output_file = open_segment(record_position, left_time)
 
             log_dir = home / ".local" / "share" / "iptvselect-fr" / "logs"
             try:
@@ -567,12 +1239,12 @@ while date_now < end_video:
                 "--http-no-ssl-verify",
                 # "--hls-live-restart",
                 "--stream-segment-attempts", "100",
-                "--retry-streams", "1",
-                "--retry-max", "100",
+                *streamlink_retry_args(constants),
                 "--stream-segmented-duration", left_time_str,
+                *selection_for(record_link).streamlink_args(),
                 "-o", str(output_file),
                 "-f",
-                str(args.m3u8_link),
+                str(record_link),
                 "best",
             ]
 
@@ -593,7 +1265,7 @@ while date_now < end_video:
             except Exception as e:
                 logging.exception("Failed to open streamlink log file %s: %s", log_file, e)
 
-            time.sleep(30)
+            watch_recorder(30)
 
             start_or_kill()
 
@@ -622,12 +1294,7 @@ while date_now < end_video:
             left_time_str = str(left_time)
 
             home = Path.home()
-            out_path = (
-                home
-                / "videos_select"
-                / f"{safe_title}-save"
-                / f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-            )
+            out_path = open_segment(record_position, left_time)
 
             log_dir = home / ".local" / "share" / "iptvselect-fr" / "logs"
             try:
@@ -642,7 +1309,9 @@ while date_now < end_video:
                 cvlc_bin,
                 "-v",
                 f"--run-time={left_time_str}",
-                str(args.m3u8_link),
+                "--sout-file-append",
+                *selection_for(record_link).vlc_args(),
+                str(record_link),
                 "--sout",
                 f"file/ts:{str(out_path)}",
             ]
@@ -662,14 +1331,9 @@ while date_now < end_video:
             except Exception as e:
                 logging.exception("Failed to open vlc log file %s: %s", log_path, e)
 
-            time.sleep(30)
+            watch_recorder(30)
 
-            p = (
-                Path.home()
-                / "videos_select"
-                / f"{safe_title}-save"
-                / f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-            )
+            p = recorder_path(record_position)
 
             logging.info("Checking file size for: %s", p)
 
@@ -692,12 +1356,7 @@ while date_now < end_video:
             home = Path.home()
             mplayer_bin = shutil.which("mplayer") or "mplayer"
 
-            out_path = (
-                home
-                / "videos_select"
-                / f"{safe_title}-save"
-                / f"{safe_title}_{args.provider}_{record_position}_{args.save}.ts"
-            )
+            out_path = open_segment(record_position, left_time)
 
             log_dir = home / ".local" / "share" / "iptvselect-fr" / "logs"
             try:
@@ -706,9 +1365,13 @@ while date_now < end_video:
                 pass
             log_path = log_dir / f"infos_{safe_title}_{args.provider}_{record_position}_{args.save}.log"
 
+            policy = stream_policy(constants, args.channel)
+            if policy_restricts_audio(policy) or not policy["subtitles"]:
+                logging.info("mplayer enregistre le flux entier, la sélection des pistes [STREAMS] est ignorée")
+
             cmd = [
                 str(mplayer_bin),
-                str(args.m3u8_link),
+                str(record_link),
                 "-dumpstream",
                 "-dumpfile",
                 str(out_path),
@@ -747,13 +1410,60 @@ while date_now < end_video:
                     except Exception:
                         pass
 
-            time.sleep(30)
+            watch_recorder(30)
 
             start_or_kill()
 
+    else:
+        candidates.success()
+        reconnects.success(candidates.provider)
+
     if new_file is False and args.recorder in ["vlc", "ffmpeg"]:
         logging.info("new_file:" + str(new_file))
         file_size = new_file_size
 
-    # throttle loop
-    time.sleep(40)
+    # throttle loop; exits and stalls end the wait
+    watched = watch_recorder(40)
+
+# ---------- Recording summary ----------
+# Let the recorders flush and exit before trimming the files they wrote.
+time.sleep(5)
+
+if ring_thread is not None:
+    ring_thread.join()
+if eit_watcher is not None:
+    eit_watcher.stop()
+    withdraw_programme(args.title)
+for position in list(manifest.open_segments):
+    end_segment("end", position)
+
+for writer in staged_writers.values():
+    writer.close()
+for writer in staged_writers.values():
+    writer.join()
+for indexer in segment_indexers.values():
+    indexer.close()
+for indexer in segment_indexers.values():
+    indexer.join()
+
+recorded_bytes = 0
+for position in range(1, record_position + 1):
+    p = segment_path(position)
+    release_preallocation(p)
+    try:
+        recorded_bytes += p.stat().st_size
+    except OSError:
+        continue
+
+if args.save == "original":
+    withdraw_primary(args.title)
+disk_admission.release(args.title, args.save)
+bandwidth_budget.unregister()
+unregister_active(args.title, args.save)
+withdraw_source()
+
+if args.channel:
+    bitrates.record(
+        args.provider, args.channel, recorded_bytes - ring_copy["bytes"],
+        datetime.now().timestamp() - date_now_epoch,
+    )
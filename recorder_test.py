@@ -8,6 +8,9 @@ import getpass
 from configparser import ConfigParser
 from pathlib import Path
 
+from recording_storage import load_constants
+from stream_select import stream_selection
+
 user = getpass.getuser()
 
 config_iptv_select = ConfigParser(interpolation=None)
@@ -131,7 +134,7 @@ log_path = logs_dir / f"infos_{recorders[recorder-1]}.log"
 if recorder == 1:
     cmd = [
         "ffmpeg", "-y", "-i", m3u8_link,
-        "-map", "0:v", "-map", "0:a", "-map", "0:s?",
+        *stream_selection(load_constants(), channel, m3u8_link).ffmpeg_maps(),
         "-c:v", "copy", "-c:a", "copy", "-c:s", "copy",
         "-t", str(duration),
         "-f", "mpegts",
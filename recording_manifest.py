@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from pathlib import Path
+from urllib.parse import urlparse
+
+from ts_packets import first_pcr, first_pts
+
+# Bytes read at the head of a segment to find its first PCR and PTS.
+PROBE_BYTES = 2**20
+FIRST_BYTE_POLL = 0.05
+
+# Why a segment stopped being written.
+END_REASONS = (
+    "end",            # the programme is over
+    "exited",         # the recorder process died
+    "stalled",        # the file stopped growing
+    "variant_switch",  # bandwidth budget moved to another HLS variant
+    "failover",       # the recording moved to another source
+    "standby",        # a hot-standby backup went back to waiting
+    "timeshift",      # copy out of a timeshift ring finished
+    "crashed",        # found open when the recording was resumed
+    "staging",        # tmpfs staging full, the recording goes on written directly
+)
+
+
+def manifest_path(video_dir: Path, safe_title: str, provider: str, save: str) -> Path:
+    return Path(video_dir) / f"manifest_{safe_title}_{provider}_{save}.jsonl"
+
+
+def url_host(url: str) -> str:
+    """Return the host of a source URL; the rest may hold credentials."""
+    try:
+        return urlparse(url).hostname or ""
+    except ValueError:
+        return ""
+
+
+class RecordingManifest:
+    """
+    Append-only JSON lines journal of the segments of one recording.
+
+    A "start" event is written when a segment holds its first bytes and an
+    "end" event when it is closed. Each event is a single write on a file
+    opened with O_APPEND, so concurrent readers never see half an entry.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.open_segments = {}
+
+    def append(self, entry: dict):
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.warning("Failed to write manifest %s: %s", self.path, e)
+
+    def start(self, segment: int, path: Path, start: float, provider: str, source: str, url: str):
+        """Record that `segment`, written to `path`, begins at the epoch `start`."""
+        self.open_segments[segment] = Path(path)
+        self.append({
+            "event": "start",
+            "segment": segment,
+            "path": str(path),
+            "start": round(start, 3),
+            "provider": provider,
+            "source": source,
+            "host": url_host(url),
+        })
+
+    def clock(self, segment: int, pts, pcr):
+        """Record the first PTS and PCR (90 kHz) found in `segment`, tied to its start time."""
+        self.append({"event": "clock", "segment": segment, "pts": pts, "pcr": pcr})
+
+    def programme(self, name: str, start, end, final: bool):
+        """Record the real boundaries of the programme, as broadcast in the EIT."""
+        self.append({
+            "event": "programme",
+            "name": name,
+            "start": round(start, 3) if start is not None else None,
+            "end": round(end, 3) if end is not None else None,
+            "final": final,
+        })
+
+    def resume(self) -> list:
+        """
+        Take over the manifest of an interrupted recording: return its
+        segments and consider those never closed as open.
+        """
+        try:
+            with open(self.path, "rb+") as f:
+                # Later entries must not be glued to a line torn by the crash.
+                size = f.seek(0, os.SEEK_END)
+                if size:
+                    f.seek(size - 1)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+        except OSError:
+            pass
+        segments = read_manifest(self.path)
+        for segment in segments:
+            if segment["end"] is None:
+                self.open_segments[segment["segment"]] = segment["path"]
+        return segments
+
+    def end(self, segment: int, end: float, reason: str, nbytes: int = None):
+        """Close `segment`; its size is read from its file unless given."""
+        path = self.open_segments.pop(segment, None)
+        if path is None:
+            return
+        if nbytes is None:
+            try:
+                nbytes = path.stat().st_size
+            except OSError:
+                nbytes = 0
+        self.append({
+            "event": "end",
+            "segment": segment,
+            "end": round(end, 3),
+            "bytes": nbytes,
+            "reason": reason,
+        })
+
+
+def read_manifest(path: Path) -> list:
+    """
+    Return the segments of a manifest, in order, as dicts with the keys
+    segment, path, start, end, bytes, provider, source, host, reason, pts
+    and pcr. `end`, `bytes` and `reason` are None for a segment never
+    closed, `pts` and `pcr` when no timestamp was found in it.
+    """
+    segments = {}
+    clocks = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # A crash may leave the last line incomplete.
+            continue
+        number = entry.get("segment")
+        if entry.get("event") == "start":
+            segments[number] = {
+                "segment": number,
+                "path": Path(entry["path"]),
+                "start": entry["start"],
+                "end": None,
+                "bytes": None,
+                "reason": None,
+                "provider": entry.get("provider", ""),
+                "source": entry.get("source", ""),
+                "host": entry.get("host", ""),
+                "pts": None,
+                "pcr": None,
+            }
+        elif entry.get("event") == "end" and number in segments:
+            segments[number].update(
+                end=entry["end"], bytes=entry["bytes"], reason=entry["reason"]
+            )
+        elif entry.get("event") == "clock":
+            # The clock may be found before the start is confirmed.
+            clocks[number] = entry
+    for number, entry in clocks.items():
+        if number in segments:
+            segments[number].update(pts=entry["pts"], pcr=entry["pcr"])
+    return [segments[number] for number in sorted(segments)]
+
+
+def read_programme(path: Path):
+    """
+    Return the last programme boundaries of a manifest as a dict with the
+    keys name, start, end and final, or None when none were found.
+    """
+    programme = None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("event") == "programme":
+                    programme = entry
+    except OSError:
+        return None
+    if programme is None:
+        return None
+    return {key: programme.get(key) for key in ("name", "start", "end", "final")}
+
+
+class SegmentClock(threading.Thread):
+    """
+    Watch the file a segment is written to: note the wall-clock time of its
+    first bytes, then record in the manifest the first PCR and PTS of its
+    head. That start time and PTS tie the media clock of the segment to
+    the wall clock, so fusion can cut it to the second.
+    """
+
+    def __init__(self, manifest: RecordingManifest, segment: int, path: Path, timeout: float = 120):
+        super().__init__(daemon=True)
+        self.manifest = manifest
+        self.segment = segment
+        self.path = Path(path)
+        self.deadline = time.time() + timeout
+        self.first_byte = None
+
+    def run(self):
+        try:
+            self.watch()
+        except Exception:
+            logging.exception("Clock of segment %s failed", self.path)
+
+    def watch(self):
+        size = 0
+        while time.time() < self.deadline:
+            try:
+                stat = self.path.stat()
+            except OSError:
+                stat = None
+            if stat is not None and stat.st_size > 0:
+                size = stat.st_size
+                # The mtime of the first write beats the polling time.
+                self.first_byte = min(time.time(), stat.st_mtime)
+                break
+            time.sleep(FIRST_BYTE_POLL)
+        else:
+            return
+
+        while size < PROBE_BYTES and time.time() < self.deadline:
+            time.sleep(0.5)
+            try:
+                size = self.path.stat().st_size
+            except OSError:
+                return
+        try:
+            with open(self.path, "rb") as f:
+                head = f.read(PROBE_BYTES)
+        except OSError:
+            return
+        pts, pcr = first_pts(head), first_pcr(head)
+        if pts is not None or pcr is not None:
+            self.manifest.clock(self.segment, pts, pcr)
@@ -0,0 +1,289 @@
+import ctypes
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from configparser import ConfigParser
+from contextlib import contextmanager
+from pathlib import Path
+
+HOME = Path.home()
+CONSTANTS_PATH = HOME / ".config" / "iptvselect-fr" / "constants.ini"
+DATA_DIR = HOME / ".local" / "share" / "iptvselect-fr"
+BITRATES_PATH = DATA_DIR / "bitrates.json"
+DEFAULT_ROOT = HOME / "videos_select"
+
+ROLES = ("original", "backup", "backup_2")
+
+# Used until a channel has been recorded at least once (5 Mbit/s HD stream).
+DEFAULT_BITRATE_KBPS = 5000
+
+# fallocate(2) mode flag: reserve blocks without changing the file size, so
+# recorders that watch st_size to detect stalls keep working.
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+# ioctl(2) sharing the extents of a file with another (reflink).
+FICLONE = 0x40049409
+
+
+def load_constants(path: Path = CONSTANTS_PATH) -> ConfigParser:
+    """Read constants.ini; a missing or broken file yields an empty config."""
+    constants = ConfigParser(interpolation=None)
+    try:
+        constants.read(path)
+    except Exception:
+        logging.exception("Failed to read config: %s", path)
+    return constants
+
+
+def config_int(constants: ConfigParser, section: str, key: str, default: int) -> int:
+    """Return an integer option, falling back to `default` when absent or invalid."""
+    try:
+        return constants.getint(section, key, fallback=default)
+    except ValueError:
+        logging.warning("Invalid integer for [%s] %s, using default %s", section, key, default)
+        return default
+
+
+def config_bool(constants: ConfigParser, section: str, key: str, default: bool) -> bool:
+    """Return a boolean option, falling back to `default` when absent or invalid."""
+    try:
+        return constants.getboolean(section, key, fallback=default)
+    except ValueError:
+        logging.warning("Invalid boolean for [%s] %s, using default %s", section, key, default)
+        return default
+
+
+def output_root(constants: ConfigParser, provider: str, save: str) -> Path:
+    """
+    Return the directory under which recordings of `provider` for the role
+    `save` (original, backup or backup_2) are written.
+
+    A path set for the provider in [STORAGE_PROVIDERS] wins over the role
+    path of [STORAGE]; when neither is set, ~/videos_select is used.
+    """
+    root = ""
+    if constants.has_section("STORAGE_PROVIDERS"):
+        root = constants.get("STORAGE_PROVIDERS", provider, fallback="").strip()
+    if not root and constants.has_section("STORAGE"):
+        root = constants.get("STORAGE", f"{save}_root", fallback="").strip()
+    if not root:
+        return DEFAULT_ROOT
+    return Path(root).expanduser()
+
+
+def save_dir(constants: ConfigParser, safe_title: str, provider: str, save: str) -> Path:
+    """Return the <title>-save directory of a recording."""
+    return output_root(constants, provider, save) / f"{safe_title}-save"
+
+
+def read_json(path: Path, default):
+    """Load a JSON state file, returning `default` when missing or corrupted."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError):
+        logging.warning("State file %s is unreadable, starting from scratch", path)
+        return default
+
+
+@contextmanager
+def locked_json(path: Path, default):
+    """
+    Read-modify-write a JSON state file shared by several processes.
+
+    An exclusive flock on a sibling .lock file serialises the recorders of the
+    box; the new content replaces the old one atomically when the block exits
+    without error.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(path.name + ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = read_json(path, default)
+            yield data
+            fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(data, f, indent=1)
+                os.replace(tmp, path)
+            except Exception:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class BitrateHistory:
+    """Average recorded bitrate (bytes per second) of each channel and provider."""
+
+    # Weight of the newest recording in the moving average.
+    SMOOTHING = 0.3
+    # Recordings shorter than this say little about the channel bitrate.
+    MIN_SECONDS = 60
+
+    def __init__(self, constants: ConfigParser, path: Path = BITRATES_PATH):
+        self.path = path
+        kbps = config_int(constants, "STORAGE", "default_bitrate_kbps", DEFAULT_BITRATE_KBPS)
+        self.default = kbps * 1000 // 8
+
+    @staticmethod
+    def key(provider: str, channel: str) -> str:
+        return f"{provider}|{channel}"
+
+    def estimate(self, provider: str, channel: str) -> int:
+        """
+        Return the expected bitrate of `channel` on `provider`. Without history
+        for that pair, the mean of the other providers carrying the channel is
+        used, then the configured default.
+        """
+        history = read_json(self.path, {})
+        entry = history.get(self.key(provider, channel))
+        if entry:
+            return int(entry["rate"])
+        if channel:
+            rates = [
+                int(value["rate"])
+                for key, value in history.items()
+                if key.split("|", 1)[-1] == channel
+            ]
+            if rates:
+                return sum(rates) // len(rates)
+        return self.default
+
+    def estimate_bytes(self, provider: str, channel: str, seconds: int) -> int:
+        """Return the expected size of `seconds` of `channel` on `provider`."""
+        return self.estimate(provider, channel) * max(int(seconds), 0)
+
+    def record(self, provider: str, channel: str, nbytes: int, seconds: float):
+        """Fold the size and length of a finished recording into the history."""
+        if seconds < self.MIN_SECONDS or nbytes <= 0:
+            return
+        rate = nbytes / seconds
+        try:
+            with locked_json(self.path, {}) as history:
+                key = self.key(provider, channel)
+                entry = history.get(key)
+                if entry:
+                    rate = (1 - self.SMOOTHING) * entry["rate"] + self.SMOOTHING * rate
+                history[key] = {"rate": int(rate), "updated": int(time.time())}
+        except Exception:
+            logging.exception("Failed to update bitrate history %s", self.path)
+
+
+def _libc_fallocate():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _libc_fallocate()
+
+
+def preallocate(path: Path, nbytes: int) -> bool:
+    """
+    Reserve `nbytes` of contiguous disk space for the recording `path`
+    without changing its apparent size.
+
+    Returns False when the space could not be reserved. A full filesystem is
+    logged as an error so that it shows up before the programme starts.
+    """
+    if nbytes <= 0 or _fallocate is None:
+        return False
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+    except OSError as e:
+        logging.warning("Cannot open %s for preallocation: %s", path, e)
+        return False
+    try:
+        if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, int(nbytes)) != 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logging.error(
+                    "Not enough disk space to preallocate %d bytes for %s", nbytes, path
+                )
+            else:
+                logging.info("Preallocation not supported for %s: %s", path, os.strerror(err))
+            return False
+    finally:
+        os.close(fd)
+    logging.info("Preallocated %d bytes for %s", nbytes, path)
+    return True
+
+
+def punch_hole(fd: int, offset: int, length: int) -> bool:
+    """Free the blocks of a byte range of an open file, keeping its size."""
+    if length <= 0 or _fallocate is None:
+        return False
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    return _fallocate(fd, mode, int(offset), int(length)) == 0
+
+
+def release_preallocation(path: Path):
+    """Give back the reserved blocks beyond the end of a finished recording."""
+    try:
+        os.truncate(path, os.path.getsize(path))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning("Failed to release preallocated space of %s: %s", path, e)
+
+
+def clone_file(src: Path, dest: Path) -> bool:
+    """Make `dest` a copy-on-write clone of `src`; False when the filesystem cannot."""
+    try:
+        with open(src, "rb") as s, open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        try:
+            os.unlink(dest)
+        except OSError:
+            pass
+        return False
+    shutil.copystat(src, dest)
+    return True
+
+
+def place_file(src: Path, dest: Path, movable: bool = False) -> str:
+    """
+    Put the content of `src` at `dest` without copying its bytes when
+    possible: a reflink, else a hardlink, else a rename when `src` is
+    `movable` (no longer needed), and a byte copy as the last resort.
+    Return the method used.
+    """
+    src, dest = Path(src), Path(dest)
+    try:
+        dest.unlink()
+    except FileNotFoundError:
+        pass
+    if clone_file(src, dest):
+        return "reflink"
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError:
+        pass
+    if movable:
+        try:
+            os.rename(src, dest)
+            return "rename"
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+    return "copy"
@@ -0,0 +1,122 @@
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+import psutil
+
+from recording_storage import DATA_DIR, locked_json, read_json
+
+# Recordings in progress, written by record_iptv.py when it starts and
+# removed when it finishes: whatever is left belongs to a killed recorder.
+ACTIVE_PATH = DATA_DIR / "active_recordings.json"
+LOGS_DIR = DATA_DIR / "logs"
+RECORD_SCRIPT = Path(__file__).resolve().with_name("record_iptv.py")
+
+# Not worth resuming a recording with less time than this left.
+MIN_REMAINING = 60
+
+
+def active_key(title: str, save: str) -> str:
+    return f"{title}|{save}"
+
+
+def process_alive(entry: dict) -> bool:
+    """Return True when the process of an entry still runs; pids are reused after a reboot."""
+    try:
+        return psutil.Process(entry["pid"]).create_time() == entry["create_time"]
+    except (psutil.Error, KeyError):
+        return False
+
+
+def register_active(title: str, save: str, argv: list, end: float, log_path: Path, path: Path = ACTIVE_PATH):
+    """Persist what is needed to resume the recording of this process until the epoch `end`."""
+    process = psutil.Process()
+    with locked_json(path, {}) as active:
+        active[active_key(title, save)] = {
+            "pid": process.pid,
+            "create_time": process.create_time(),
+            "argv": [arg for arg in argv if arg != "--resume"],
+            "end": end,
+            "log": str(log_path),
+        }
+
+
+def active_end(title: str, save: str, path: Path = ACTIVE_PATH):
+    """Return the end last registered for a recording, or None when it has none."""
+    entry = read_json(path, {}).get(active_key(title, save))
+    return entry["end"] if entry else None
+
+
+def unregister_active(title: str, save: str, path: Path = ACTIVE_PATH):
+    with locked_json(path, {}) as active:
+        entry = active.get(active_key(title, save))
+        if entry and entry["pid"] == os.getpid():
+            del active[active_key(title, save)]
+
+
+def resume(entry: dict) -> int:
+    """Start record_iptv.py again for an interrupted recording and return its pid."""
+    LOGS_DIR.mkdir(parents=True, exist_ok=True)
+    cmd = [sys.executable, str(RECORD_SCRIPT), *entry["argv"], "--resume"]
+    with open(entry["log"], "ab") as log_fh:
+        proc = subprocess.Popen(
+            cmd,
+            cwd=RECORD_SCRIPT.parent,
+            stdin=subprocess.DEVNULL,
+            stdout=log_fh,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            start_new_session=True,
+        )
+    return proc.pid
+
+
+def recover_recordings(path: Path = ACTIVE_PATH) -> int:
+    """
+    Resume, for the time they have left, the recordings whose recorder
+    died. Return how many were resumed.
+    """
+    now = time.time()
+    resumed = 0
+    with locked_json(path, {}) as active:
+        for key, entry in list(active.items()):
+            if process_alive(entry):
+                continue
+            if entry["end"] - now < MIN_REMAINING:
+                logging.info("Enregistrement %s interrompu trop près de sa fin pour être repris", key)
+                del active[key]
+                continue
+            try:
+                pid = resume(entry)
+            except Exception as e:
+                logging.exception("Failed to resume recording %s: %s", key, e)
+                continue
+            logging.info(
+                "Reprise de l'enregistrement %s pour les %d s restantes (pid %d)",
+                key, entry["end"] - now, pid,
+            )
+            # The new process registers itself; until then, keep another
+            # recovery pass from starting it twice.
+            try:
+                entry["pid"] = pid
+                entry["create_time"] = psutil.Process(pid).create_time()
+            except psutil.Error:
+                pass
+            resumed += 1
+    return resumed
+
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+    recover_recordings()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+import argparse
+import collections
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import psutil
+
+from bandwidth import PLAYLIST_TIMEOUT
+from priorities import apply_priority
+from reconnects import HEALTHY_SECONDS, ReconnectLimiter
+from recording_storage import (
+    DATA_DIR,
+    config_bool,
+    config_int,
+    load_constants,
+    locked_json,
+    read_json,
+)
+from stream_select import PROBE_TIMEOUT
+
+RELAYS_PATH = DATA_DIR / "relays.json"
+LOGS_DIR = DATA_DIR / "logs"
+
+CHUNK_SIZE = 188 * 348  # ~64 KiB of whole TS packets
+# Chunks queued for a consumer before it is considered stuck and dropped.
+CONSUMER_QUEUE = 512
+DEFAULT_LINGER = 120
+# A programme following another on the same channel is started by an at job
+# up to a minute late, then reads the HLS variants and probes the audio
+# streams before it connects. The relay has to outlive that handoff and
+# keep its stream in memory.
+HANDOFF_SECONDS = 60 + PLAYLIST_TIMEOUT + PROBE_TIMEOUT
+# Seconds of stream kept in memory for consumers joining slightly late.
+DEFAULT_BACKLOG = HANDOFF_SECONDS
+STARTUP_TIMEOUT = 15
+UPSTREAM_TIMEOUT = 20
+
+
+def relay_key(provider: str, channel: str) -> str:
+    return f"{provider}|{channel}"
+
+
+def relay_enabled(constants: ConfigParser, provider: str) -> bool:
+    """Return True when recordings of `provider` should go through a relay."""
+    if not config_bool(constants, "RELAY", "enabled", False):
+        return False
+    providers = constants.get("RELAY", "providers", fallback="").strip()
+    if not providers:
+        return True
+    return provider in [p.strip() for p in providers.split(",")]
+
+
+def find_relay(provider: str, channel: str, path: Path = RELAYS_PATH):
+    """Return the local URL of the running relay of a channel, or None."""
+    entry = read_json(path, {}).get(relay_key(provider, channel))
+    if entry and psutil.pid_exists(entry["pid"]) and entry.get("port"):
+        return f"http://127.0.0.1:{entry['port']}/stream.ts"
+    return None
+
+
+def relay_lines(provider: str, path: Path = RELAYS_PATH) -> int:
+    """Return the lines of `provider` held by running relays, one per upstream whatever its consumers."""
+    return sum(
+        1 for key, entry in read_json(path, {}).items()
+        if key.split("|", 1)[0] == provider and psutil.pid_exists(entry["pid"])
+    )
+
+
+def consumer_link(local: str, consumer_id: str, since: float) -> str:
+    """
+    Return the relay URL of one recording. `consumer_id` keeps the URL
+    unique per recording; the first connection of that id is served the
+    backlog from the epoch `since`, so that a programme following another on
+    the same channel starts exactly where it should, without reconnecting.
+    """
+    return f"{local}?{urlencode({'id': consumer_id, 'since': int(since)})}"
+
+
+def ensure_relay(provider: str, channel: str, url: str, path: Path = RELAYS_PATH):
+    """
+    Return the local URL of the relay of (`provider`, `channel`), starting
+    one that reads `url` if none is running. Return None if it did not come up.
+    """
+    local = find_relay(provider, channel, path)
+    if local:
+        return local
+
+    LOGS_DIR.mkdir(parents=True, exist_ok=True)
+    log_path = LOGS_DIR / f"relay_{provider}_{channel.replace(' ', '_')}.log"
+    cmd = [sys.executable, str(Path(__file__).resolve()), provider, channel, url]
+    try:
+        with open(log_path, "ab") as log_fh:
+            subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=log_fh,
+                stderr=subprocess.STDOUT,
+                close_fds=True,
+                start_new_session=True,
+            )
+    except Exception as e:
+        logging.exception("Failed to launch relay for %s %s: %s", provider, channel, e)
+        return None
+
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        local = find_relay(provider, channel, path)
+        if local:
+            return local
+        time.sleep(0.5)
+    logging.warning("Relay for %s %s did not start", provider, channel)
+    return None
+
+
+class Relay:
+    """
+    Hold one upstream connection and copy its MPEG-TS bytes to every local
+    consumer connected to the HTTP server.
+
+    HTTP sources sending raw TS are read directly; anything else (HLS,
+    RTSP...) is remuxed to TS by an ffmpeg child process. The relay stops
+    once it has had no consumer for `linger` seconds, which keeps the
+    channel session open between back-to-back programmes. The last
+    `backlog` seconds of stream are kept to serve late joiners.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        linger: int = DEFAULT_LINGER,
+        backlog: int = DEFAULT_BACKLOG,
+        provider: str = "",
+        reconnects=None,
+    ):
+        self.url = url
+        self.provider = provider
+        # Shared ReconnectLimiter pacing the upstream reconnections, if any.
+        self.reconnects = reconnects
+        self.linger = linger
+        self.backlog_seconds = backlog
+        self.backlog = collections.deque()
+        # Consumer ids seen, with the time they disconnected (None while connected).
+        self.served = {}
+        # Queue of each connected consumer -> its id.
+        self.consumers = {}
+        self.lock = threading.Lock()
+        self.last_consumer = time.time()
+        self.stopping = threading.Event()
+        self.upstream_proc = None
+        self.bytes_in = 0
+
+    # ----- consumers -----
+    def subscribe(self, consumer_id: str = "", since: float = 0) -> queue.Queue:
+        """
+        Add a consumer. The first connection of a `consumer_id` asking for
+        data `since` an epoch gets the buffered chunks received from then on;
+        a reconnection gets those received since it went away, and a second
+        simultaneous connection only the live stream.
+        """
+        with self.lock:
+            replay = []
+            if consumer_id in self.served:
+                disconnected = self.served[consumer_id]
+                since = max(since, disconnected) if disconnected is not None else 0
+            if since:
+                replay = [chunk for received, chunk in self.backlog if received >= since]
+            if consumer_id:
+                self.served[consumer_id] = None
+            consumer = queue.Queue(maxsize=CONSUMER_QUEUE + len(replay))
+            for chunk in replay:
+                consumer.put_nowait(chunk)
+            self.consumers[consumer] = consumer_id
+        logging.info(
+            "Consumer %s connected (%d active, %d chunks replayed)",
+            consumer_id, len(self.consumers), len(replay),
+        )
+        return consumer
+
+    def unsubscribe(self, consumer: queue.Queue):
+        with self.lock:
+            consumer_id = self.consumers.pop(consumer, None)
+            now = time.time()
+            self.last_consumer = now
+            if consumer_id and consumer_id not in self.consumers.values():
+                self.served[consumer_id] = now
+            # Past the backlog, a reconnection would get nothing it already had.
+            for gone, disconnected in list(self.served.items()):
+                if disconnected is not None and disconnected < now - self.backlog_seconds:
+                    del self.served[gone]
+        logging.info("Consumer disconnected (%d active)", len(self.consumers))
+
+    def publish(self, chunk: bytes):
+        self.bytes_in += len(chunk)
+        now = time.time()
+        with self.lock:
+            if self.backlog_seconds > 0:
+                self.backlog.append((now, chunk))
+                while self.backlog and self.backlog[0][0] < now - self.backlog_seconds:
+                    self.backlog.popleft()
+            consumers = list(self.consumers)
+        for consumer in consumers:
+            try:
+                consumer.put_nowait(chunk)
+            except queue.Full:
+                logging.warning("Dropping a consumer that stopped reading")
+                self.unsubscribe(consumer)
+
+    def idle(self) -> bool:
+        with self.lock:
+            return not self.consumers and time.time() - self.last_consumer > self.linger
+
+    # ----- upstream -----
+    def open_direct(self):
+        """Open the source over HTTP; return (response, first bytes) or None for non-TS."""
+        request = urllib.request.Request(self.url, headers={"User-Agent": "Mozilla/5.0"})
+        response = urllib.request.urlopen(request, timeout=UPSTREAM_TIMEOUT)
+        first = response.read(CHUNK_SIZE)
+        if first.lstrip().startswith(b"#EXTM3U") or first[:1] != b"\x47":
+            response.close()
+            return None
+        return response, first
+
+    def open_ffmpeg(self):
+        cmd = [
+            "ffmpeg", "-loglevel", "error",
+            "-i", self.url,
+            "-map", "0", "-c", "copy",
+            "-f", "mpegts", "pipe:1",
+        ]
+        self.upstream_proc = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, close_fds=True
+        )
+        return self.upstream_proc.stdout
+
+    def pump_upstream(self):
+        """Read the source until it ends, publishing every chunk."""
+        stream = None
+        first = b""
+        if self.url.startswith(("http://", "https://")):
+            opened = self.open_direct()
+            if opened:
+                stream, first = opened
+        if stream is None:
+            stream = self.open_ffmpeg()
+        logging.info("Upstream connected: %s", self.url)
+        try:
+            if first:
+                self.publish(first)
+            while not self.stopping.is_set():
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.publish(chunk)
+        finally:
+            try:
+                stream.close()
+            except Exception:
+                pass
+            if self.upstream_proc is not None:
+                self.upstream_proc.kill()
+                self.upstream_proc.wait()
+                self.upstream_proc = None
+
+    def run_upstream(self):
+        """Keep the upstream connected, with a short pause between reconnections."""
+        while not self.stopping.is_set() and not self.idle():
+            connected = time.time()
+            try:
+                self.pump_upstream()
+                logging.warning("Upstream ended: %s", self.url)
+            except Exception as e:
+                logging.warning("Upstream error on %s: %s", self.url, e)
+            self.stopping.wait(2)
+            if self.reconnects is None:
+                continue
+            if time.time() - connected >= HEALTHY_SECONDS:
+                self.reconnects.success(self.provider)
+            else:
+                self.reconnects.failure(self.provider)
+            while not self.stopping.is_set() and not self.idle():
+                delay = self.reconnects.acquire(self.provider)
+                if delay <= 0:
+                    break
+                self.stopping.wait(min(delay, 5))
+        self.stopping.set()
+
+    # ----- server -----
+    def make_handler(self):
+        relay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                try:
+                    since = float(query.get("since", ["0"])[0])
+                except ValueError:
+                    since = 0
+                consumer = relay.subscribe(query.get("id", [""])[0], since)
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "video/mp2t")
+                    self.end_headers()
+                    while not relay.stopping.is_set() and consumer in relay.consumers:
+                        try:
+                            chunk = consumer.get(timeout=1)
+                        except queue.Empty:
+                            continue
+                        self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    relay.unsubscribe(consumer)
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        return Handler
+
+    def serve(self, on_ready=None):
+        """Run the relay until it has been idle for `linger` seconds."""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        upstream = threading.Thread(target=self.run_upstream, daemon=True)
+        upstream.start()
+        if on_ready:
+            on_ready(server.server_address[1])
+        try:
+            while not self.stopping.is_set():
+                self.stopping.wait(1)
+                if self.idle():
+                    logging.info("No consumer for %d s, stopping", self.linger)
+                    self.stopping.set()
+        finally:
+            server.shutdown()
+            server.server_close()
+            upstream.join(timeout=5)
+        logging.info("Relay stopped after %d bytes", self.bytes_in)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("provider")
+    parser.add_argument("channel")
+    parser.add_argument("url")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+
+    key = relay_key(args.provider, args.channel)
+    constants = load_constants()
+    apply_priority(constants, "capture")
+    linger = config_int(constants, "RELAY", "linger", DEFAULT_LINGER)
+    backlog = config_int(constants, "RELAY", "backlog", DEFAULT_BACKLOG)
+    if min(linger, backlog) < HANDOFF_SECONDS:
+        logging.warning(
+            "Relay linger %d s and backlog %d s raised to %d s, the handoff between programmes",
+            linger, backlog, HANDOFF_SECONDS,
+        )
+        linger, backlog = max(linger, HANDOFF_SECONDS), max(backlog, HANDOFF_SECONDS)
+    relay = Relay(
+        args.url,
+        linger,
+        backlog,
+        args.provider,
+        ReconnectLimiter(constants),
+    )
+
+    def register(port: int):
+        with locked_json(RELAYS_PATH, {}) as relays:
+            relays[key] = {"pid": os.getpid(), "port": port, "url": args.url}
+        logging.info("Relay %s listening on 127.0.0.1:%d", key, port)
+
+    with locked_json(RELAYS_PATH, {}) as relays:
+        entry = relays.get(key)
+        if entry and entry["pid"] != os.getpid() and psutil.pid_exists(entry["pid"]):
+            logging.info("Relay %s already running (pid %d)", key, entry["pid"])
+            return
+        # Claim the channel before binding, so a concurrent start backs off.
+        relays[key] = {"pid": os.getpid(), "port": None, "url": args.url}
+
+    try:
+        relay.serve(on_ready=register)
+    finally:
+        with locked_json(RELAYS_PATH, {}) as relays:
+            if relays.get(key, {}).get("pid") == os.getpid():
+                del relays[key]
+
+
+if __name__ == "__main__":
+    main()
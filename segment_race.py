@@ -0,0 +1,383 @@
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+from pathlib import Path
+from urllib.parse import urljoin
+
+import psutil
+
+from bandwidth import parse_attributes, parse_master_playlist
+from recording_storage import DATA_DIR, locked_json, read_json
+from ts_packets import PTS_CLOCK, TS_PACKET_SIZE, first_pts, packet_offset, unwrap_pts
+from ts_splice import TsSplicer, parse_program_tables, pid_map
+
+RACES_PATH = DATA_DIR / "races.json"
+
+HTTP_TIMEOUT = 10
+# Segments taken from the end of the first playlist read, as players do.
+LIVE_EDGE = 3
+# Seconds a missing slot is waited for before the next segment is written.
+DEFAULT_HOLD = 20
+# Two segments starting less than this apart (seconds) fill the same slot.
+SLOT_TOLERANCE = 0.5
+# A source whose timestamps are further than this from the race (seconds)
+# does not carry the same stream and is left out.
+MAX_SKEW = 120
+
+
+def http_get(url: str) -> tuple:
+    """Return (body, final URL) of `url`."""
+    request = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
+    with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+        return response.read(), response.geturl()
+
+
+def parse_media_playlist(text: str, base_url: str) -> dict:
+    """
+    Parse an HLS media playlist into its target duration, end flag, the
+    reason it cannot be raced (encrypted or fMP4 segments) and its segments
+    as (media sequence, duration, absolute URL) tuples.
+    """
+    playlist = {"target": 6.0, "ended": False, "unsupported": "", "segments": []}
+    sequence = 0
+    duration = None
+    for raw in text.splitlines():
+        line = raw.strip()
+        if line.startswith("#EXT-X-TARGETDURATION:"):
+            try:
+                playlist["target"] = float(line.split(":", 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            try:
+                sequence = int(line.split(":", 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith("#EXTINF:"):
+            try:
+                duration = float(line.split(":", 1)[1].split(",", 1)[0])
+            except ValueError:
+                duration = playlist["target"]
+        elif line.startswith("#EXT-X-KEY"):
+            if parse_attributes(line).get("METHOD", "NONE").upper() != "NONE":
+                playlist["unsupported"] = "segments chiffrés"
+        elif line.startswith("#EXT-X-MAP"):
+            playlist["unsupported"] = "segments fMP4"
+        elif line == "#EXT-X-ENDLIST":
+            playlist["ended"] = True
+        elif line and not line.startswith("#"):
+            playlist["segments"].append((sequence, duration or playlist["target"], urljoin(base_url, line)))
+            sequence += 1
+            duration = None
+    return playlist
+
+
+def media_playlist_url(url: str) -> str:
+    """Return the media playlist of `url`, taking the best variant of a master playlist."""
+    body, final_url = http_get(url)
+    variants = parse_master_playlist(body.decode("utf-8", errors="replace"), final_url)
+    return variants[-1][1] if variants else final_url
+
+
+def is_hls(url: str) -> bool:
+    """Return True when `url` serves an HLS playlist."""
+    if not url.startswith(("http://", "https://")):
+        return False
+    try:
+        request = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
+        with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+            return response.read(64).lstrip().startswith(b"#EXTM3U")
+    except Exception as e:
+        logging.info("Could not probe %s: %s", url, e)
+        return False
+
+
+# ----- box-wide registry of running races -----
+def register_race(title: str, providers: list, path: Path = RACES_PATH):
+    """Record that this process races `title` over `providers`."""
+    try:
+        with locked_json(path, {}) as races:
+            for pid in list(races):
+                if not psutil.pid_exists(int(pid)):
+                    del races[pid]
+            races[str(os.getpid())] = {"title": title, "providers": providers}
+    except Exception:
+        logging.exception("Failed to register race in %s", path)
+
+
+def unregister_race(path: Path = RACES_PATH):
+    try:
+        with locked_json(path, {}) as races:
+            races.pop(str(os.getpid()), None)
+    except Exception:
+        logging.exception("Failed to unregister race from %s", path)
+
+
+def running_races(path: Path = RACES_PATH) -> list:
+    return [
+        race for pid, race in read_json(path, {}).items()
+        if int(pid) != os.getpid() and psutil.pid_exists(int(pid))
+    ]
+
+
+def race_covering(title: str, provider: str, path: Path = RACES_PATH) -> bool:
+    """Return True when a running race of `title` already reads `provider`."""
+    return any(
+        race["title"] == title and provider in race["providers"]
+        for race in running_races(path)
+    )
+
+
+def race_lines(provider: str, path: Path = RACES_PATH) -> int:
+    """
+    Return the lines of `provider` used by races, apart from the race's own
+    provider, which its record_iptv.py command line already accounts for.
+    """
+    return sum(
+        1 for race in running_races(path)
+        if provider in race["providers"][1:]
+    )
+
+
+class SegmentRace:
+    """
+    Record one programme from the HLS playlists of several providers at once.
+
+    Every source is polled by its own thread and its new segments are
+    downloaded as they appear. Segments are placed on the shared timeline by
+    the PTS of their first video frame; for each slot the first valid
+    segment to arrive is written and the others are dropped. When a slot is
+    still missing after `hold` seconds while a later one is available, the
+    gap is accepted and writing resumes from the later segment.
+
+    The tables of the first source read are those of the output: the
+    streams of the others are moved to its PIDs and their continuity
+    counters carried on, like in a splice. A source whose streams cannot be
+    joined to them is left out.
+    """
+
+    def __init__(self, sources: list, output: Path, end_time: float, hold: int = DEFAULT_HOLD):
+        self.sources = sources
+        self.output = output
+        self.end_time = end_time
+        self.hold = hold
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # start (s) -> (end (s), provider, data, arrival time)
+        self.pending = {}
+        self.cursor = None
+        self.reference = None
+        self.first_write = None
+        self.first_start = None
+        self.origin = None
+        self.bytes_written = 0
+        self.gaps = 0.0
+        self.wins = {provider: 0 for provider, _ in sources}
+        self.alive = 0
+        # Tables of the output, and the PIDs of each source mapped to them.
+        self.base = None
+        self.base_provider = None
+        self.mappings = {}
+
+    # ----- sources -----
+    def valid_segment(self, data: bytes):
+        """Return the first PTS of a downloaded segment, or None if it is unusable."""
+        if len(data) < TS_PACKET_SIZE * 4 or packet_offset(data) != 0:
+            return None
+        return first_pts(data)
+
+    def follow(self, provider: str, url: str):
+        """Poll the playlist of one source and offer its segments until the end."""
+        try:
+            playlist_url = media_playlist_url(url)
+        except Exception as e:
+            logging.warning("Course: source %s injoignable: %s", provider, e)
+            return
+        last_sequence = None
+        failures = 0
+        while not self.stopping.is_set() and time.time() < self.end_time:
+            try:
+                body, final_url = http_get(playlist_url)
+                playlist = parse_media_playlist(body.decode("utf-8", errors="replace"), final_url)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logging.info("Course: playlist de %s illisible (%s)", provider, e)
+                self.stopping.wait(min(2 * failures, 10))
+                continue
+            if playlist["unsupported"]:
+                logging.warning("Course: source %s écartée (%s)", provider, playlist["unsupported"])
+                return
+
+            segments = playlist["segments"]
+            if last_sequence is None:
+                segments = segments[-LIVE_EDGE:]
+            else:
+                segments = [s for s in segments if s[0] > last_sequence]
+            for sequence, duration, segment_url in segments:
+                if self.stopping.is_set():
+                    return
+                last_sequence = sequence
+                try:
+                    data, _ = http_get(segment_url)
+                except Exception as e:
+                    logging.info("Course: segment %d de %s perdu (%s)", sequence, provider, e)
+                    continue
+                pts = self.valid_segment(data)
+                if pts is None:
+                    logging.info("Course: segment %d de %s invalide", sequence, provider)
+                    continue
+                if provider not in self.mappings:
+                    tables = parse_program_tables(data)
+                    if tables is None:
+                        logging.info("Course: pas de tables dans le segment %d de %s", sequence, provider)
+                        continue
+                    if not self.map_streams(provider, tables):
+                        return
+                if not self.offer(provider, pts, duration, data):
+                    logging.warning("Course: la source %s ne diffuse pas le même flux", provider)
+                    return
+            if playlist["ended"]:
+                return
+            self.stopping.wait(max(playlist["target"] / 2, 1))
+
+    def map_streams(self, provider: str, tables: dict) -> bool:
+        """
+        Map the streams of a source, given the tables of one of its
+        segments, to those of the output. Return False when the source
+        cannot be joined to it.
+        """
+        with self.lock:
+            if self.base is None:
+                self.base = tables
+                self.base_provider = provider
+            if provider == self.base_provider:
+                self.mappings[provider] = None
+                return True
+            mapping = pid_map(self.base, tables)
+            if mapping is None:
+                logging.warning(
+                    "Course: source %s écartée, ses flux ne correspondent pas à ceux de %s",
+                    provider, self.base_provider,
+                )
+                return False
+            self.mappings[provider] = mapping
+        return True
+
+    def run_source(self, provider: str, url: str):
+        try:
+            self.follow(provider, url)
+        except Exception:
+            logging.exception("Course: erreur sur la source %s", provider)
+        finally:
+            with self.lock:
+                self.alive -= 1
+
+    # ----- timeline -----
+    def offer(self, provider: str, pts: int, duration: float, data: bytes) -> bool:
+        """
+        Queue a segment for its slot unless the slot is already filled.
+        Return False when the segment is not on the race's timeline.
+        """
+        with self.lock:
+            if self.reference is None:
+                self.reference = pts
+            start = (unwrap_pts(pts, self.reference) - self.reference) / PTS_CLOCK
+            anchor = self.cursor if self.cursor is not None else 0.0
+            if abs(start - anchor) > MAX_SKEW:
+                logging.warning(
+                    "Course: horloge de %s décalée de %.0f s par rapport à la course", provider, start - anchor
+                )
+                return False
+            end = start + duration
+            # A segment cannot be listed before its last frame was broadcast,
+            # so this bounds the wall-clock time of the timeline origin.
+            origin = time.time() - end
+            if self.origin is None or origin < self.origin:
+                self.origin = origin
+            if self.cursor is not None and end <= self.cursor + SLOT_TOLERANCE:
+                return True
+            for other in self.pending:
+                if abs(other - start) < SLOT_TOLERANCE:
+                    return True
+            self.pending[start] = (end, provider, data, time.time())
+        return True
+
+    def next_segment(self):
+        """Pop the segment to write next, or None when it is worth waiting."""
+        with self.lock:
+            if self.cursor is not None:
+                for start in [s for s, v in self.pending.items() if v[0] <= self.cursor + SLOT_TOLERANCE]:
+                    del self.pending[start]
+            if not self.pending:
+                return None
+            start = min(self.pending)
+            end, provider, data, arrival = self.pending[start]
+            if self.cursor is not None and start > self.cursor + SLOT_TOLERANCE:
+                if time.time() - arrival < self.hold and self.alive > 1:
+                    return None
+                self.gaps += start - self.cursor
+                logging.warning(
+                    "Course: trou de %.1f s comblé par aucune source", start - self.cursor
+                )
+            del self.pending[start]
+            if self.first_start is None:
+                self.first_start = start
+            self.cursor = end if self.cursor is None else max(self.cursor, end)
+            self.wins[provider] += 1
+            return provider, data
+
+    @property
+    def start_epoch(self):
+        """Return the estimated broadcast time of the first written frame."""
+        if self.first_start is None or self.origin is None:
+            return self.first_write
+        return self.origin + self.first_start
+
+    # ----- output -----
+    def run(self) -> int:
+        """Race until the end time or until every source stopped; return bytes written."""
+        threads = []
+        with self.lock:
+            self.alive = len(self.sources)
+        for provider, url in self.sources:
+            thread = threading.Thread(target=self.run_source, args=(provider, url), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        mode = "r+b" if self.output.exists() else "wb"
+        with open(self.output, mode) as output:
+            # The output keeps its preallocated blocks; the splicer writes to it.
+            splicer = None
+            while time.time() < self.end_time:
+                segment = self.next_segment()
+                if segment is None:
+                    with self.lock:
+                        done = self.alive == 0 and not self.pending
+                    if done:
+                        logging.warning("Course: plus aucune source active")
+                        break
+                    time.sleep(0.5)
+                    continue
+                provider, data = segment
+                if self.first_write is None:
+                    self.first_write = time.time()
+                if splicer is None:
+                    splicer = TsSplicer(self.output, self.base)
+                    splicer.out = output
+                splicer.append_data(data, self.mappings[provider])
+                splicer.flush()
+                self.bytes_written = splicer.bytes_written
+            self.stopping.set()
+            output.truncate(self.bytes_written)
+
+        for thread in threads:
+            thread.join(timeout=HTTP_TIMEOUT + 1)
+        logging.info(
+            "Course terminée: %d octets écrits, %.1f s de trous, segments gagnés: %s",
+            self.bytes_written, self.gaps, self.wins,
+        )
+        return self.bytes_written
@@ -0,0 +1,223 @@
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+from pathlib import Path
+
+from recording_storage import DATA_DIR, punch_hole
+
+STAGING_DIR = Path("/dev/shm") / "iptvselect-fr"
+# Held by the process flushing to the recordings storage, so that the
+# flushes of concurrent recordings reach it one after the other.
+FLUSH_LOCK_PATH = DATA_DIR / "staging.lock"
+
+DEFAULT_MAX_MB = 256
+DEFAULT_HARD_MAX_MB = 512
+DEFAULT_CHUNK_KB = 4096
+DEFAULT_MIN_MEM_MB = 512
+
+PAGE_SIZE = 4096
+POLL_INTERVAL = 1
+# Seconds without growth of a closed segment before its last bytes are written.
+CLOSE_IDLE = 10
+# A flush slower than this (seconds) is counted as a storage stall.
+SLOW_FLUSH = 1.0
+
+
+def mem_available():
+    """Return MemAvailable of /proc/meminfo in bytes, or None when unknown."""
+    try:
+        with open("/proc/meminfo", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def staging_possible(staging_dir: Path, max_bytes: int, min_mem: int) -> bool:
+    """
+    Return True when a new recording may be staged: the machine keeps
+    `min_mem` bytes available once the ring is full, and tmpfs has room.
+    """
+    available = mem_available()
+    if available is None or available - max_bytes < min_mem:
+        return False
+    try:
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        return shutil.disk_usage(staging_dir).free >= max_bytes
+    except OSError:
+        return False
+
+
+def recover_staged(staged: Path, final: Path) -> int:
+    """
+    Write to `final` the bytes of a segment left in tmpfs by a killed
+    recording, and return how many. The flushed part was punched out of
+    the tmpfs file, so only what lies beyond the end of `final` is copied.
+    """
+    try:
+        src = os.open(staged, os.O_RDONLY)
+    except FileNotFoundError:
+        return 0
+    copied = 0
+    try:
+        dst = os.open(final, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            offset = os.fstat(dst).st_size
+            while True:
+                data = os.pread(src, DEFAULT_CHUNK_KB * 1024, offset)
+                if not data:
+                    break
+                os.pwrite(dst, data, offset)
+                offset += len(data)
+                copied += len(data)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+    try:
+        staged.unlink()
+    except OSError:
+        pass
+    return copied
+
+
+class StagedWriter(threading.Thread):
+    """
+    Copy a recording written by a recorder in tmpfs to its final path in
+    `chunk`-sized sequential writes, aligned on the start of the file.
+
+    Flushed bytes are punched out of the tmpfs file, so it holds at most the
+    data not yet on the storage. When that lag goes over `max_bytes`, every
+    available byte is flushed at each pass. When it still goes over
+    `hard_bytes`, or memory gets tight, `overflowed` is set: the recorder
+    must move to a segment written directly to the storage, while the
+    staged data goes on being flushed. Flushes of all recordings of the box
+    are serialised by a file lock; the time spent waiting on it and on slow
+    writes is reported when the segment is closed.
+    """
+
+    def __init__(self, staged: Path, final: Path, chunk: int, max_bytes: int, min_mem: int,
+                 hard_bytes: int = DEFAULT_HARD_MAX_MB * 2**20):
+        super().__init__(daemon=True)
+        self.staged = staged
+        self.final = final
+        self.chunk = chunk
+        self.max_bytes = max_bytes
+        self.min_mem = min_mem
+        self.hard_bytes = max(hard_bytes, max_bytes)
+        self.closing = threading.Event()
+        self.overflowed = threading.Event()
+        self.flushed = 0
+        self.punched = 0
+        # Backpressure metrics.
+        self.flushes = 0
+        self.max_lag = 0
+        self.lock_wait = 0.0
+        self.write_time = 0.0
+        self.slow_flushes = 0
+        self.pressure = False
+
+    def close(self):
+        """Finish the segment once its recorder stopped writing."""
+        self.closing.set()
+
+    def flush(self, src: int, dst: int, nbytes: int):
+        FLUSH_LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(FLUSH_LOCK_PATH, "a") as lock:
+            waited = time.monotonic()
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            started = time.monotonic()
+            self.lock_wait += started - waited
+            try:
+                end = self.flushed + nbytes
+                while self.flushed < end:
+                    data = os.pread(src, min(end - self.flushed, self.chunk), self.flushed)
+                    if not data:
+                        break
+                    os.pwrite(dst, data, self.flushed)
+                    self.flushed += len(data)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        elapsed = time.monotonic() - started
+        self.write_time += elapsed
+        self.flushes += 1
+        if elapsed > SLOW_FLUSH:
+            self.slow_flushes += 1
+
+        hole_end = self.flushed // PAGE_SIZE * PAGE_SIZE
+        if hole_end > self.punched and punch_hole(src, self.punched, hole_end - self.punched):
+            self.punched = hole_end
+
+    def run(self):
+        try:
+            self.copy()
+        except Exception:
+            logging.exception("Staged copy of %s failed", self.staged)
+
+    def copy(self):
+        while not self.staged.exists():
+            if self.closing.is_set():
+                return
+            time.sleep(POLL_INTERVAL)
+
+        # Opened for writing too, which punching holes requires.
+        src = os.open(self.staged, os.O_RDWR)
+        dst = os.open(self.final, os.O_WRONLY | os.O_CREAT, 0o644)
+        last_growth = time.monotonic()
+        size = 0
+        try:
+            while True:
+                new_size = os.fstat(src).st_size
+                if new_size > size:
+                    size = new_size
+                    last_growth = time.monotonic()
+                lag = size - self.flushed
+                self.max_lag = max(self.max_lag, lag)
+
+                available = mem_available()
+                low_memory = available is not None and available < self.min_mem
+                pressure = lag > self.max_bytes or low_memory
+                if pressure and not self.pressure:
+                    logging.warning(
+                        "Staging de %s saturé (%d Mo en attente), vidage complet",
+                        self.final.name, lag // 2**20,
+                    )
+                self.pressure = pressure
+                if (lag > self.hard_bytes or low_memory) and not self.overflowed.is_set():
+                    logging.warning(
+                        "Staging de %s plein (%d Mo en attente, limite %d Mo), "
+                        "bascule en écriture directe",
+                        self.final.name, lag // 2**20, self.hard_bytes // 2**20,
+                    )
+                    self.overflowed.set()
+
+                finished = self.closing.is_set() and time.monotonic() - last_growth > CLOSE_IDLE
+                if finished or pressure:
+                    nbytes = lag
+                else:
+                    nbytes = lag // self.chunk * self.chunk
+                if nbytes > 0:
+                    self.flush(src, dst, nbytes)
+                if finished:
+                    break
+                time.sleep(POLL_INTERVAL)
+        finally:
+            os.close(src)
+            os.close(dst)
+
+        try:
+            self.staged.unlink()
+        except OSError:
+            pass
+        logging.info(
+            "Staging de %s: %d Mo en %d écritures (%.1f s), retard max %d Mo, "
+            "%.1f s d'attente du verrou, %d écritures lentes",
+            self.final.name, self.flushed // 2**20, self.flushes, self.write_time,
+            self.max_lag // 2**20, self.lock_wait, self.slow_flushes,
+        )
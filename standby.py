@@ -0,0 +1,133 @@
+import logging
+import os
+import time
+
+from pathlib import Path
+
+import psutil
+
+from recording_storage import DATA_DIR, locked_json, read_json
+from stream_pipe import FileSink, Pump, RingBuffer, pipe_command
+
+PRIMARIES_PATH = DATA_DIR / "primaries.json"
+
+DEFAULT_BUFFER_SECONDS = 60
+# Seconds without growth of the primary's file before the standby writes.
+DEFAULT_STALL_SECONDS = 30
+# Seconds the primary must be healthy again before the standby stops writing.
+DEFAULT_RECOVER_SECONDS = 120
+CHECK_INTERVAL = 2
+# Minimum seconds between two connections of the standby recorder.
+RESTART_DELAY = 10
+# Extra time given to the original recorder to write its first bytes.
+STARTUP_GRACE = 60
+
+
+# ----- heartbeat of the primary recording -----
+def publish_primary(title: str, path: Path, registry: Path = PRIMARIES_PATH):
+    """Declare the file the original recording of `title` is writing to."""
+    try:
+        with locked_json(registry, {}) as primaries:
+            primaries[title] = {"pid": os.getpid(), "path": str(path)}
+    except Exception:
+        logging.exception("Failed to publish primary recording in %s", registry)
+
+
+def withdraw_primary(title: str, registry: Path = PRIMARIES_PATH):
+    """Remove the original recording of `title` once it is over."""
+    try:
+        with locked_json(registry, {}) as primaries:
+            if primaries.get(title, {}).get("pid") == os.getpid():
+                del primaries[title]
+    except Exception:
+        logging.exception("Failed to withdraw primary recording from %s", registry)
+
+
+class PrimaryWatch:
+    """
+    Tell whether the original recording of a programme is progressing, by
+    watching the size of the file it declared in the primaries registry.
+    """
+
+    def __init__(self, title: str, stall: int, registry: Path = PRIMARIES_PATH):
+        self.title = title
+        self.stall = stall
+        self.registry = registry
+        self.path = None
+        self.size = -1
+        self.last_growth = time.time() + STARTUP_GRACE
+
+    def healthy(self) -> bool:
+        entry = read_json(self.registry, {}).get(self.title)
+        now = time.time()
+        if entry and psutil.pid_exists(entry["pid"]):
+            if entry["path"] != self.path:
+                self.path, self.size = entry["path"], 0
+            try:
+                size = os.stat(self.path).st_size
+            except OSError:
+                size = 0
+            if size > self.size:
+                self.size = size
+                self.last_growth = now
+        return now - self.last_growth < self.stall
+
+
+class StandbyRecorder:
+    """
+    Backup recording that keeps its connection open but only holds the last
+    `buffer_seconds` of stream in memory. When the original recording
+    stalls, the buffer is written to a new segment file and the stream
+    follows until the caller puts the backup back on standby. With
+    `buffer_seconds` = 0 no connection is kept and the recorder only starts
+    when the original fails.
+    """
+
+    def __init__(self, title: str, recorder: str, buffer_seconds: int, stall: int, retry_args: list = None):
+        self.recorder = recorder
+        self.retry_args = retry_args
+        self.buffer_seconds = buffer_seconds
+        self.watch = PrimaryWatch(title, stall)
+        self.pump = None
+        self.writing = None
+        self.last_start = 0.0
+
+    def restart_due(self) -> bool:
+        return time.time() - self.last_start >= RESTART_DELAY
+
+    def start_pump(self, link: str, log_path: Path, selection=None):
+        self.last_start = time.time()
+        sink = RingBuffer(self.buffer_seconds)
+        try:
+            self.pump = Pump(pipe_command(self.recorder, link, selection, self.retry_args), sink, log_path)
+        except Exception as e:
+            logging.exception("Failed to launch standby recorder: %s", e)
+            self.pump = None
+
+    def activate(self, path: Path, link: str, log_path: Path, selection=None):
+        """Start writing to `path`; return the estimated time of its first byte."""
+        if self.pump is None or not self.pump.alive():
+            self.start_pump(link, log_path, selection)
+        self.writing = FileSink(path)
+        first = self.pump.set_sink(self.writing) if self.pump else None
+        return first or time.time()
+
+    def deactivate(self):
+        """Go back to standby, closing the file being written."""
+        if self.pump is not None:
+            if self.buffer_seconds > 0:
+                self.pump.set_sink(RingBuffer(self.buffer_seconds))
+            else:
+                self.pump.stop()
+                self.pump = None
+        if self.writing is not None:
+            self.writing.close()
+            self.writing = None
+
+    def stop(self):
+        if self.pump is not None:
+            self.pump.stop()
+            self.pump = None
+        if self.writing is not None:
+            self.writing.close()
+            self.writing = None
@@ -0,0 +1,161 @@
+import collections
+import logging
+import shutil
+import subprocess
+import threading
+import time
+
+from pathlib import Path
+
+CHUNK_SIZE = 188 * 348  # ~64 KiB of whole TS packets
+
+STREAMLINK_BIN = (
+    Path.home() / ".local" / "share" / "iptvselect-fr" / ".venv" / "bin" / "streamlink"
+)
+
+
+def pipe_command(recorder: str, link: str, selection=None, retry_args: list = None) -> list:
+    """
+    Return the command of `recorder` writing the MPEG-TS stream of `link`
+    to stdout, restricted to the streams of `selection` (a StreamSelection).
+    `retry_args` replaces the default streamlink options retrying to open
+    the stream.
+    """
+    if recorder == "streamlink":
+        return [
+            str(STREAMLINK_BIN),
+            "--http-no-ssl-verify",
+            "--stream-segment-attempts", "100",
+            *(retry_args or ["--retry-streams", "1", "--retry-max", "100"]),
+            *(selection.streamlink_args() if selection else []),
+            "-O", link, "best",
+        ]
+    if recorder == "vlc":
+        return [
+            shutil.which("cvlc") or "cvlc",
+            link,
+            *(selection.vlc_args() if selection else []),
+            "--sout", "#std{access=file,mux=ts,dst=-}",
+        ]
+    if recorder == "mplayer":
+        return [
+            shutil.which("mplayer") or "mplayer",
+            link, "-really-quiet", "-dumpstream", "-dumpfile", "/dev/stdout",
+        ]
+    return [
+        "ffmpeg", "-loglevel", "error",
+        "-i", link,
+        *(selection.ffmpeg_maps() if selection else ["-map", "0:v", "-map", "0:a", "-map", "0:s?"]),
+        "-c", "copy",
+        "-f", "mpegts", "pipe:1",
+    ]
+
+
+class RingBuffer:
+    """Keep the last `seconds` of chunks received, in memory."""
+
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self.chunks = collections.deque()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def write(self, chunk: bytes):
+        now = time.time()
+        with self.lock:
+            self.chunks.append((now, chunk))
+            self.size += len(chunk)
+            while self.chunks and self.chunks[0][0] < now - self.seconds:
+                self.size -= len(self.chunks.popleft()[1])
+
+    def drain(self) -> tuple:
+        """Empty the buffer; return (reception time of its oldest chunk or None, chunks)."""
+        with self.lock:
+            chunks = list(self.chunks)
+            self.chunks.clear()
+            self.size = 0
+        if not chunks:
+            return None, []
+        return chunks[0][0], [chunk for _, chunk in chunks]
+
+
+class FileSink:
+    """Append chunks to a file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.fh = open(path, "ab")
+        self.bytes = 0
+
+    def write(self, chunk: bytes):
+        self.fh.write(chunk)
+        self.bytes += len(chunk)
+
+    def close(self):
+        self.fh.close()
+
+
+class Pump:
+    """
+    Run a recorder writing to stdout and copy its output to a sink, which
+    may be swapped while it runs (e.g. from a memory buffer to a file).
+    """
+
+    def __init__(self, cmd: list, sink, log_path: Path):
+        self.cmd = cmd
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.last_data = None
+        self.bytes_in = 0
+        self.log_fh = open(log_path, "ab")
+        self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=self.log_fh,
+            close_fds=True,
+        )
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.proc.stdout.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.last_data = time.time()
+                self.bytes_in += len(chunk)
+                with self.lock:
+                    self.sink.write(chunk)
+        except Exception:
+            logging.exception("Reading %s failed", self.cmd[0])
+
+    def set_sink(self, sink):
+        """
+        Send the following chunks to `sink`. When the current sink is a
+        RingBuffer its content is written to `sink` first; return the
+        reception time of the oldest chunk so carried over, or None.
+        """
+        with self.lock:
+            first = None
+            if isinstance(self.sink, RingBuffer):
+                first, chunks = self.sink.drain()
+                for chunk in chunks:
+                    sink.write(chunk)
+            self.sink = sink
+        return first
+
+    def alive(self) -> bool:
+        return self.thread.is_alive()
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.thread.join(timeout=5)
+        self.log_fh.close()
@@ -0,0 +1,163 @@
+import json
+import logging
+import subprocess
+
+from configparser import ConfigParser
+
+from recording_storage import config_bool, config_int
+
+PROBE_TIMEOUT = 30
+PROBE_SIZE = str(5 * 2**20)
+
+# ISO 639-2 bibliographic and terminology codes name the same language;
+# providers use either.
+LANGUAGE_ALIASES = {
+    "fre": "fra", "ger": "deu", "dut": "nld", "chi": "zho", "cze": "ces",
+    "gre": "ell", "per": "fas", "rum": "ron", "slo": "slk", "alb": "sqi",
+    "arm": "hye", "baq": "eus", "geo": "kat", "ice": "isl", "mac": "mkd",
+    "may": "msa", "wel": "cym", "fr": "fra", "en": "eng", "de": "deu",
+    "es": "spa", "it": "ita",
+}
+# Languages French broadcasters give to their audio-description tracks.
+AUDIO_DESCRIPTION_LANGUAGES = {"qad"}
+
+
+def normalize_language(code: str) -> str:
+    code = (code or "").strip().lower()
+    return LANGUAGE_ALIASES.get(code, code)
+
+
+def stream_policy(constants: ConfigParser, channel: str) -> dict:
+    """
+    Return the stream selection of `channel`: the [STREAMS] options,
+    overridden by those of a [STREAMS:<channel>] section.
+    """
+    sections = [f"STREAMS:{channel}", "STREAMS"]
+
+    def section_of(option: str) -> str:
+        return next((s for s in sections if constants.has_option(s, option)), "STREAMS")
+
+    languages = constants.get(section_of("audio_languages"), "audio_languages", fallback="")
+    return {
+        "audio_languages": [normalize_language(code) for code in languages.split(",") if code.strip()],
+        "max_audio": config_int(constants, section_of("max_audio"), "max_audio", 0),
+        "audio_description": config_bool(
+            constants, section_of("audio_description"), "audio_description", True
+        ),
+        "subtitles": config_bool(constants, section_of("subtitles"), "subtitles", True),
+    }
+
+
+def policy_restricts_audio(policy: dict) -> bool:
+    return bool(policy["audio_languages"] or policy["max_audio"] > 0 or not policy["audio_description"])
+
+
+def probe_audio(link: str):
+    """Return the audio streams of `link` as ffprobe describes them, or None when it cannot tell."""
+    cmd = [
+        "ffprobe", "-v", "quiet",
+        "-probesize", PROBE_SIZE, "-analyzeduration", PROBE_SIZE,
+        "-select_streams", "a",
+        "-show_entries", "stream=index,codec_name,channels:stream_tags=language:stream_disposition=visual_impaired",
+        "-of", "json",
+        link,
+    ]
+    try:
+        process = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=PROBE_TIMEOUT
+        )
+        streams = json.loads(process.stdout or "{}").get("streams")
+    except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+        logging.warning("Failed to probe the audio streams of the source: %s", e)
+        return None
+    if process.returncode != 0 or not streams:
+        return None
+    return streams
+
+
+def is_audio_description(stream: dict) -> bool:
+    language = normalize_language(stream.get("tags", {}).get("language", ""))
+    return (
+        stream.get("disposition", {}).get("visual_impaired", 0) == 1
+        or language in AUDIO_DESCRIPTION_LANGUAGES
+    )
+
+
+def select_audio(streams: list, policy: dict) -> list:
+    """
+    Return the positions, among the audio streams, of those to record:
+    the preferred languages first, audio description dropped if asked, at
+    most max_audio of them. A channel with none of the preferred languages
+    keeps its tracks rather than losing its sound.
+    """
+    candidates = list(range(len(streams)))
+    if not policy["audio_description"]:
+        candidates = [i for i in candidates if not is_audio_description(streams[i])] or candidates[:1]
+
+    languages = policy["audio_languages"]
+    if languages:
+        def rank(i):
+            language = normalize_language(streams[i].get("tags", {}).get("language", ""))
+            return languages.index(language) if language in languages else len(languages)
+        preferred = [i for i in candidates if rank(i) < len(languages)]
+        if preferred:
+            candidates = sorted(preferred, key=rank)
+
+    if policy["max_audio"] > 0:
+        candidates = candidates[:policy["max_audio"]]
+    return sorted(candidates)
+
+
+class StreamSelection:
+    """The streams of a source to record, as arguments of each recorder."""
+
+    def __init__(self, policy: dict, audio=None):
+        self.policy = policy
+        # Positions of the audio streams to record; None keeps all of them.
+        self.audio = audio
+
+    def ffmpeg_maps(self) -> list:
+        maps = ["-map", "0:v"]
+        if self.audio is None:
+            maps += ["-map", "0:a"]
+        else:
+            for position in self.audio:
+                maps += ["-map", f"0:a:{position}"]
+        if self.policy["subtitles"]:
+            maps += ["-map", "0:s?"]
+        return maps
+
+    def streamlink_args(self) -> list:
+        """Pick the HLS audio renditions; muxed MPEG-TS tracks cannot be dropped."""
+        languages = self.policy["audio_languages"]
+        if not languages:
+            return []
+        return ["--hls-audio-select", ",".join(languages)]
+
+    def vlc_args(self) -> list:
+        """Without --sout-all VLC keeps one audio track, in the preferred language."""
+        args = []
+        if policy_restricts_audio(self.policy):
+            args.append("--no-sout-all")
+            if self.policy["audio_languages"]:
+                args.append("--audio-language=" + ",".join(self.policy["audio_languages"]))
+        if not self.policy["subtitles"]:
+            args.append("--no-sout-spu")
+        return args
+
+
+def stream_selection(constants: ConfigParser, channel: str, link: str) -> StreamSelection:
+    """Return the streams of `link` to record for `channel`, probing it only when the policy drops some."""
+    policy = stream_policy(constants, channel)
+    if not policy_restricts_audio(policy):
+        return StreamSelection(policy)
+    streams = probe_audio(link)
+    if streams is None:
+        logging.info("Pistes audio de la source inconnues, toutes seront enregistrées")
+        return StreamSelection(policy)
+    audio = select_audio(streams, policy)
+    logging.info(
+        "Pistes audio enregistrées: %s sur %d",
+        ", ".join(streams[i].get("tags", {}).get("language", "?") for i in audio), len(streams),
+    )
+    return StreamSelection(policy, audio)
@@ -0,0 +1,295 @@
+import argparse
+import logging
+import os
+import struct
+import subprocess
+import sys
+import time
+
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Callable
+
+import psutil
+
+from failover import PROVIDERS_DIR, channel_link
+from priorities import apply_priority
+from recording_storage import (
+    DATA_DIR,
+    config_int,
+    load_constants,
+    locked_json,
+    read_json,
+)
+from reconnects import HEALTHY_SECONDS, ReconnectLimiter
+from stream_pipe import CHUNK_SIZE, pipe_command
+from stream_select import stream_selection
+from ts_packets import TS_PACKET_SIZE
+
+TIMESHIFT_DIR = DATA_DIR / "timeshift"
+TIMESHIFTS_PATH = DATA_DIR / "timeshifts.json"
+LOGS_DIR = DATA_DIR / "logs"
+
+DEFAULT_SIZE_MB = 4096
+DEFAULT_LEAD_MINUTES = 10
+
+MAGIC = b"IPTVRING"
+# magic, ring size, bytes written since creation, index capacity, index entries
+HEADER = struct.Struct("<8sQQQQ")
+# reception time, absolute offset of the first packet received at that time
+ENTRY = struct.Struct("<dQ")
+INDEX_CAPACITY = 86400
+INDEX_INTERVAL = 1.0
+# Bytes just ahead of the writer that a reader must not trust any more.
+SAFETY_MARGIN = 16 * 2**20
+
+
+def ring_key(provider: str, channel: str) -> str:
+    return f"{provider}|{channel}"
+
+
+def ring_paths(provider: str, channel: str) -> tuple:
+    """Return the data and index files of the ring of a channel."""
+    name = f"{provider}_{channel}".replace("/", "_").replace(" ", "_")
+    return TIMESHIFT_DIR / f"{name}.ring", TIMESHIFT_DIR / f"{name}.idx"
+
+
+def timeshift_channels(constants: ConfigParser) -> list:
+    """Return the (provider, channel) pairs of [TIMESHIFT] channels."""
+    raw = constants.get("TIMESHIFT", "channels", fallback="")
+    pairs = []
+    for item in raw.split(","):
+        provider, sep, channel = item.strip().partition("|")
+        if sep and provider.strip() and channel.strip():
+            pairs.append((provider.strip(), channel.strip().lower()))
+    return pairs
+
+
+def running_timeshifts(path: Path = TIMESHIFTS_PATH) -> dict:
+    """Return the running ring daemons by key."""
+    return {
+        key: entry for key, entry in read_json(path, {}).items()
+        if psutil.pid_exists(entry["pid"])
+    }
+
+
+def timeshift_lines(provider: str, path: Path = TIMESHIFTS_PATH) -> int:
+    """Return the provider lines held by ring daemons."""
+    return sum(1 for entry in running_timeshifts(path).values() if entry["provider"] == provider)
+
+
+def ensure_timeshifts(constants: ConfigParser):
+    """Start a ring daemon for every configured channel that has none running."""
+    running = running_timeshifts()
+    for provider, channel in timeshift_channels(constants):
+        if ring_key(provider, channel) in running:
+            continue
+        if not channel_link(PROVIDERS_DIR / f"{provider}.ini", channel):
+            logging.warning("Timeshift: chaîne %s absente du fichier %s.ini", channel, provider)
+            continue
+        LOGS_DIR.mkdir(parents=True, exist_ok=True)
+        log_path = LOGS_DIR / f"timeshift_{provider}_{channel.replace(' ', '_')}.log"
+        cmd = [sys.executable, str(Path(__file__).resolve()), provider, channel]
+        try:
+            with open(log_path, "ab") as log_fh:
+                subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=log_fh,
+                    stderr=subprocess.STDOUT,
+                    close_fds=True,
+                    start_new_session=True,
+                )
+            logging.info("Timeshift lancé pour %s sur %s", channel, provider)
+        except Exception as e:
+            logging.exception("Failed to launch timeshift for %s %s: %s", provider, channel, e)
+
+
+class RingWriter:
+    """
+    Write a live stream into a fixed-size, fully preallocated circular file.
+
+    A side index records every second the reception time and the absolute
+    offset (bytes written since creation) of the stream, so that readers
+    can find where a given moment is and whether it was overwritten.
+    """
+
+    def __init__(self, ring_path: Path, index_path: Path, size: int):
+        size -= size % TS_PACKET_SIZE
+        ring_path.parent.mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self.ring = os.open(ring_path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.ring).st_size != size:
+            os.ftruncate(self.ring, 0)
+            os.posix_fallocate(self.ring, 0, size)
+        self.index = os.open(index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.index, HEADER.size + ENTRY.size * INDEX_CAPACITY)
+        self.head = 0
+        self.count = 0
+        self.last_index = 0.0
+        self.write_header()
+
+    def write_header(self):
+        os.pwrite(self.index, HEADER.pack(MAGIC, self.size, self.head, INDEX_CAPACITY, self.count), 0)
+
+    def align(self):
+        """Move to the next packet boundary, e.g. after the source restarted."""
+        self.head += -self.head % TS_PACKET_SIZE
+
+    def write(self, chunk: bytes):
+        now = time.time()
+        if now - self.last_index >= INDEX_INTERVAL:
+            offset = self.head + (-self.head % TS_PACKET_SIZE)
+            slot = HEADER.size + ENTRY.size * (self.count % INDEX_CAPACITY)
+            os.pwrite(self.index, ENTRY.pack(now, offset), slot)
+            self.count += 1
+            self.last_index = now
+
+        view = memoryview(chunk)
+        while view:
+            position = self.head % self.size
+            n = min(len(view), self.size - position)
+            os.pwrite(self.ring, view[:n], position)
+            self.head += n
+            view = view[n:]
+        self.write_header()
+
+    def close(self):
+        os.close(self.ring)
+        os.close(self.index)
+
+
+class RingReader:
+    """Read the past of a channel out of the ring written by its daemon."""
+
+    def __init__(self, ring_path: Path, index_path: Path):
+        self.ring_path = ring_path
+        self.index_path = index_path
+
+    def header(self):
+        with open(self.index_path, "rb") as f:
+            magic, size, head, capacity, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self.index_path} is not a timeshift index")
+        return size, head, capacity, count
+
+    def entries(self) -> list:
+        """Return the (time, offset) index entries whose data is still in the ring."""
+        size, head, capacity, count = self.header()
+        oldest = head - size + SAFETY_MARGIN
+        entries = []
+        with open(self.index_path, "rb") as f:
+            for i in range(max(0, count - capacity), count):
+                f.seek(HEADER.size + ENTRY.size * (i % capacity))
+                when, offset = ENTRY.unpack(f.read(ENTRY.size))
+                if offset >= oldest:
+                    entries.append((when, offset))
+        return entries
+
+    def locate(self, since: float):
+        """Return the (time, offset) where reading from the epoch `since` starts, or None."""
+        entries = self.entries()
+        if not entries:
+            return None
+        before = [entry for entry in entries if entry[0] <= since]
+        return before[-1] if before else entries[0]
+
+    def copy_out(self, since: float, output: Path, until: Callable[[], float]) -> tuple:
+        """
+        Copy the stream from the epoch `since` to `output`, then keep
+        following the ring until the epoch returned by `until`, asked again
+        each time the copy catches up so that a moved end is followed. Return
+        (time of the first byte copied or None, bytes copied).
+        """
+        start = self.locate(since)
+        if start is None:
+            return None, 0
+        first_time, position = start
+        copied = 0
+        with open(self.ring_path, "rb") as ring, open(output, "ab") as out:
+            while True:
+                size, head, _, _ = self.header()
+                if position < head - size + SAFETY_MARGIN:
+                    logging.warning("Timeshift: lecture dépassée par l'écriture, saut en avant")
+                    position = head - size + SAFETY_MARGIN
+                    position += -position % TS_PACKET_SIZE
+                if position >= head:
+                    if time.time() >= until():
+                        break
+                    time.sleep(0.5)
+                    continue
+                n = min(head - position, CHUNK_SIZE * 16, size - position % size)
+                ring.seek(position % size)
+                data = ring.read(n)
+                out.write(data)
+                position += len(data)
+                copied += len(data)
+        return first_time, copied
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("provider")
+    parser.add_argument("channel")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+
+    key = ring_key(args.provider, args.channel)
+    with locked_json(TIMESHIFTS_PATH, {}) as timeshifts:
+        entry = timeshifts.get(key)
+        if entry and entry["pid"] != os.getpid() and psutil.pid_exists(entry["pid"]):
+            logging.info("Timeshift %s already running (pid %d)", key, entry["pid"])
+            return
+        timeshifts[key] = {"pid": os.getpid(), "provider": args.provider, "channel": args.channel}
+
+    constants = load_constants()
+    apply_priority(constants, "capture")
+    size = config_int(constants, "TIMESHIFT", "size_mb", DEFAULT_SIZE_MB) * 2**20
+    ring_path, index_path = ring_paths(args.provider, args.channel)
+    writer = RingWriter(ring_path, index_path, size)
+    logging.info("Timeshift %s: anneau de %d Mo dans %s", key, size // 2**20, ring_path)
+
+    reconnects = ReconnectLimiter(constants)
+    try:
+        while True:
+            url = channel_link(PROVIDERS_DIR / f"{args.provider}.ini", args.channel)
+            if not url:
+                logging.error("Timeshift %s: lien introuvable", key)
+                break
+            connected = time.time()
+            proc = subprocess.Popen(
+                pipe_command("ffmpeg", url, stream_selection(constants, args.channel, url)),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                close_fds=True,
+            )
+            try:
+                while True:
+                    chunk = proc.stdout.read1(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+            finally:
+                proc.kill()
+                proc.wait()
+            logging.warning("Timeshift %s: source interrompue, reconnexion", key)
+            writer.align()
+            if time.time() - connected >= HEALTHY_SECONDS:
+                reconnects.success(args.provider)
+            else:
+                reconnects.failure(args.provider)
+            time.sleep(5)
+            reconnects.wait(args.provider, float("inf"))
+    finally:
+        writer.close()
+        with locked_json(TIMESHIFTS_PATH, {}) as timeshifts:
+            if timeshifts.get(key, {}).get("pid") == os.getpid():
+                del timeshifts[key]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import logging
+import struct
+import threading
+import time
+
+from pathlib import Path
+from typing import Optional
+
+from ts_packets import (
+    PTS_CLOCK,
+    PTS_WRAP,
+    SYNC_BYTE,
+    TS_PACKET_SIZE,
+    is_video_stream,
+    packet_offset,
+    packet_pcr,
+    packet_pid,
+    pes_timestamp,
+)
+
+INDEX_SUFFIX = ".tsidx"
+MAGIC = b"IPTVTSIX"
+# Record kind, byte offset of the packet in the segment, two values:
+#   b"T" timestamp checkpoint: PTS, last PCR base (-1 when none yet)
+#   b"K" keyframe (random access point): PTS, PID
+#   b"C" continuity error: PID, packets lost
+RECORD = struct.Struct("<cQqq")
+NULL_PID = 0x1FFF
+# One timestamp checkpoint per this much media time.
+CHECKPOINT_INTERVAL = PTS_CLOCK
+
+POLL_INTERVAL = 1
+READ_SIZE = TS_PACKET_SIZE * 5572  # ~1 MiB of whole packets
+# Seconds without growth of a closed segment before its index is finished.
+CLOSE_IDLE = 15
+
+
+def index_path(segment: Path) -> Path:
+    """Return the sidecar index of a recorded segment."""
+    segment = Path(segment)
+    return segment.with_name(segment.name + INDEX_SUFFIX)
+
+
+class TsIndexer:
+    """
+    Scan MPEG-TS data fed in arbitrary chunks and return index records:
+    timestamp checkpoints, keyframes and continuity counter errors.
+    """
+
+    def __init__(self):
+        self.offset = 0          # file offset of the next byte fed
+        self.synced = False
+        self.pending = b""
+        self.counters = {}
+        self.video_pid = None
+        self.last_pcr = -1
+        self.last_checkpoint = None
+
+    def feed(self, data: bytes) -> list:
+        buffer = self.pending + data
+        base = self.offset - len(self.pending)  # file offset of buffer[0]
+        self.offset += len(data)
+        view = memoryview(buffer)
+        records = []
+        position = 0
+        while len(buffer) - position >= TS_PACKET_SIZE:
+            if not self.synced:
+                found = packet_offset(view[position:position + TS_PACKET_SIZE * 5])
+                if found < 0:
+                    if len(buffer) - position < TS_PACKET_SIZE * 5:
+                        break
+                    position += TS_PACKET_SIZE
+                    continue
+                position += found
+                self.synced = True
+                continue
+            if buffer[position] != SYNC_BYTE:
+                # Lost sync, e.g. where a restarted recorder appended.
+                self.synced = False
+                continue
+            self.scan(view[position:position + TS_PACKET_SIZE], base + position, records)
+            position += TS_PACKET_SIZE
+        self.pending = bytes(view[position:])
+        return records
+
+    def scan(self, packet, offset: int, records: list):
+        pid = packet_pid(packet)
+        if pid == NULL_PID:
+            return
+        control = (packet[3] >> 4) & 0x03
+        has_adaptation = control & 0x02 and packet[4] > 0
+        discontinuity = has_adaptation and packet[5] & 0x80
+        random_access = has_adaptation and packet[5] & 0x40
+
+        if control & 0x01:
+            counter = packet[3] & 0x0F
+            previous = self.counters.get(pid)
+            # A single repeated packet is allowed.
+            if previous is not None and not discontinuity and counter not in (previous, (previous + 1) % 16):
+                records.append(RECORD.pack(b"C", offset, pid, (counter - previous - 1) % 16))
+            self.counters[pid] = counter
+
+        pcr = packet_pcr(packet)
+        if pcr is not None:
+            self.last_pcr = pcr
+
+        found = pes_timestamp(packet)
+        if found is None:
+            return
+        stream_id, pts = found
+        if is_video_stream(stream_id) and self.video_pid is None:
+            self.video_pid = pid
+        # Checkpoints follow the video, or any stream of a channel without one.
+        if self.video_pid is not None and pid != self.video_pid:
+            return
+        if random_access and self.video_pid is not None:
+            records.append(RECORD.pack(b"K", offset, pts, pid))
+        if self.last_checkpoint is None or abs(pts - self.last_checkpoint) >= CHECKPOINT_INTERVAL:
+            records.append(RECORD.pack(b"T", offset, pts, self.last_pcr))
+            self.last_checkpoint = pts
+
+
+class SegmentIndexer(threading.Thread):
+    """
+    Follow a segment file while its recorder writes it and keep its
+    sidecar index up to date. The bytes are read right after being written,
+    from the page cache, so the segment is never read again from disk.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(daemon=True)
+        self.path = Path(path)
+        self.closing = threading.Event()
+
+    def close(self):
+        """Finish the index once the segment stopped growing."""
+        self.closing.set()
+
+    def run(self):
+        try:
+            self.follow()
+        except Exception:
+            logging.exception("Indexing of %s failed", self.path)
+
+    def follow(self):
+        while not self.path.exists():
+            if self.closing.is_set():
+                return
+            time.sleep(POLL_INTERVAL)
+
+        indexer = TsIndexer()
+        last_growth = time.monotonic()
+        with open(self.path, "rb") as src, open(index_path(self.path), "wb") as out:
+            out.write(MAGIC)
+            while True:
+                data = src.read(READ_SIZE)
+                if data:
+                    last_growth = time.monotonic()
+                    out.write(b"".join(indexer.feed(data)))
+                    continue
+                out.flush()
+                if self.closing.is_set() and time.monotonic() - last_growth > CLOSE_IDLE:
+                    break
+                time.sleep(POLL_INTERVAL)
+
+
+def read_index(path: Path) -> Optional[dict]:
+    """
+    Return the index of a segment as lists of (offset, pts, pcr) checkpoints,
+    (offset, pts) keyframes and (offset, pid, lost) continuity errors, or
+    None when it has no index.
+    """
+    try:
+        with open(index_path(path), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if not data.startswith(MAGIC):
+        return None
+    index = {"checkpoints": [], "keyframes": [], "cc_errors": []}
+    body = memoryview(data)[len(MAGIC):]
+    for start in range(0, len(body) - RECORD.size + 1, RECORD.size):
+        kind, offset, a, b = RECORD.unpack_from(body, start)
+        if kind == b"T":
+            index["checkpoints"].append((offset, a, b))
+        elif kind == b"K":
+            index["keyframes"].append((offset, a))
+        elif kind == b"C":
+            index["cc_errors"].append((offset, a, b))
+    return index
+
+
+def index_duration(index: dict) -> Optional[float]:
+    """Return the media time in seconds between the first and last checkpoints of an index."""
+    checkpoints = index["checkpoints"]
+    if len(checkpoints) < 2:
+        return None
+    first, last = checkpoints[0][1], checkpoints[-1][1]
+    return ((last - first) % PTS_WRAP) / PTS_CLOCK
+
+
+def keyframe_after(index: dict, pts: int) -> Optional[tuple]:
+    """Return the first (offset, pts) keyframe at or after `pts`, or None."""
+    for offset, keyframe_pts in index["keyframes"]:
+        if (keyframe_pts - pts) % PTS_WRAP < PTS_WRAP // 2:
+            return offset, keyframe_pts
+    return None
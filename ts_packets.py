@@ -0,0 +1,187 @@
+from typing import Iterator, Optional
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+
+# MPEG timestamps are 33-bit counters of a 90 kHz clock.
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+
+
+def packet_offset(data: bytes, checks: int = 3) -> int:
+    """
+    Return the offset of the first TS packet of `data`, i.e. the first sync
+    byte followed by `checks` more at 188-byte intervals, or -1.
+    """
+    limit = min(len(data), TS_PACKET_SIZE)
+    for offset in range(limit):
+        if all(
+            offset + i * TS_PACKET_SIZE < len(data)
+            and data[offset + i * TS_PACKET_SIZE] == SYNC_BYTE
+            for i in range(checks + 1)
+        ):
+            return offset
+    return -1
+
+
+def iter_packets(data: bytes, offset: int = 0) -> Iterator[memoryview]:
+    """Yield the whole 188-byte packets of `data` starting at `offset`."""
+    view = memoryview(data)
+    end = len(data) - TS_PACKET_SIZE
+    while offset <= end:
+        yield view[offset:offset + TS_PACKET_SIZE]
+        offset += TS_PACKET_SIZE
+
+
+def packet_pid(packet) -> int:
+    return ((packet[1] & 0x1F) << 8) | packet[2]
+
+
+def payload_offset(packet) -> int:
+    """Return the offset of the payload in `packet`, or -1 when it has none."""
+    control = (packet[3] >> 4) & 0x03
+    if not control & 0x01:
+        return -1
+    if control & 0x02:
+        offset = 5 + packet[4]
+    else:
+        offset = 4
+    return offset if offset < TS_PACKET_SIZE else -1
+
+
+def read_timestamp(raw) -> int:
+    """Decode a 5-byte PTS/DTS field."""
+    return (
+        ((raw[0] >> 1) & 0x07) << 30
+        | raw[1] << 22
+        | (raw[2] >> 1) << 15
+        | raw[3] << 7
+        | raw[4] >> 1
+    )
+
+
+def pes_timestamp(packet) -> Optional[tuple]:
+    """
+    Return (stream_id, PTS) of the PES header starting in `packet`, or None
+    when the packet does not start a PES carrying a PTS.
+    """
+    if packet[0] != SYNC_BYTE or not packet[1] & 0x40:
+        return None
+    offset = payload_offset(packet)
+    if offset < 0 or offset + 14 > TS_PACKET_SIZE:
+        return None
+    if packet[offset] != 0 or packet[offset + 1] != 0 or packet[offset + 2] != 1:
+        return None
+    stream_id = packet[offset + 3]
+    if not packet[offset + 7] & 0x80:
+        return None
+    return stream_id, read_timestamp(packet[offset + 9:offset + 14])
+
+
+def is_video_stream(stream_id: int) -> bool:
+    return 0xE0 <= stream_id <= 0xEF
+
+
+def first_pts(data: bytes, max_packets: int = 20000) -> Optional[int]:
+    """
+    Return the first video PTS of a TS chunk, or the first PTS of any stream
+    when no video PES starts in the first `max_packets` packets.
+    """
+    offset = packet_offset(data)
+    if offset < 0:
+        return None
+    fallback = None
+    for count, packet in enumerate(iter_packets(data, offset)):
+        if count >= max_packets:
+            break
+        found = pes_timestamp(packet)
+        if found is None:
+            continue
+        stream_id, pts = found
+        if is_video_stream(stream_id):
+            return pts
+        if fallback is None:
+            fallback = pts
+    return fallback
+
+
+def packet_pcr(packet) -> Optional[int]:
+    """Return the PCR base (90 kHz) carried by the adaptation field of `packet`, or None."""
+    if packet[0] != SYNC_BYTE or not (packet[3] >> 4) & 0x02:
+        return None
+    if packet[4] < 7 or not packet[5] & 0x10:
+        return None
+    return (
+        packet[6] << 25
+        | packet[7] << 17
+        | packet[8] << 9
+        | packet[9] << 1
+        | packet[10] >> 7
+    )
+
+
+def first_pcr(data: bytes, max_packets: int = 20000) -> Optional[int]:
+    """Return the first PCR base of a TS chunk, or None."""
+    offset = packet_offset(data)
+    if offset < 0:
+        return None
+    for count, packet in enumerate(iter_packets(data, offset)):
+        if count >= max_packets:
+            break
+        pcr = packet_pcr(packet)
+        if pcr is not None:
+            return pcr
+    return None
+
+
+def unwrap_pts(pts: int, reference: int) -> int:
+    """Return `pts` shifted by whole 33-bit wraps to be the closest to `reference`."""
+    shift = round((reference - pts) / PTS_WRAP)
+    return pts + shift * PTS_WRAP
+
+
+class SectionAssembler:
+    """Rebuild the PSI sections carried by the packets of one PID."""
+
+    def __init__(self):
+        self.buffer = None
+        self.counter = None
+
+    def feed(self, packet) -> list:
+        offset = payload_offset(packet)
+        if offset < 0:
+            return []
+        counter = packet[3] & 0x0F
+        if self.counter is not None and counter != (self.counter + 1) % 16:
+            if counter == self.counter:
+                return []
+            # A lost packet breaks the section being rebuilt.
+            self.buffer = None
+        self.counter = counter
+
+        payload = bytes(packet[offset:])
+        sections = []
+        if packet[1] & 0x40:
+            pointer = payload[0]
+            if self.buffer is not None:
+                self.buffer += payload[1:1 + pointer]
+                sections += self.complete()
+            self.buffer = bytearray(payload[1 + pointer:])
+        elif self.buffer is not None:
+            self.buffer += payload
+        sections += self.complete()
+        return sections
+
+    def complete(self) -> list:
+        sections = []
+        while self.buffer is not None and len(self.buffer) >= 3:
+            if self.buffer[0] == 0xFF:
+                # Stuffing until the next section start.
+                self.buffer = None
+                break
+            length = ((self.buffer[1] & 0x0F) << 8 | self.buffer[2]) + 3
+            if len(self.buffer) < length:
+                break
+            sections.append(bytes(self.buffer[:length]))
+            del self.buffer[:length]
+        return sections
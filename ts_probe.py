@@ -0,0 +1,98 @@
+import mmap
+
+from pathlib import Path
+from typing import Optional
+
+from ts_packets import (
+    PTS_CLOCK,
+    PTS_WRAP,
+    TS_PACKET_SIZE,
+    is_video_stream,
+    iter_packets,
+    packet_offset,
+    packet_pid,
+    pes_timestamp,
+)
+
+# Bytes scanned at a time from each end of the file.
+WINDOW = TS_PACKET_SIZE * 5572  # ~1 MiB of whole packets
+# Windows scanned back from the end before giving up on finding a PTS.
+MAX_TAIL_WINDOWS = 16
+
+
+def head_timestamp(view) -> Optional[tuple]:
+    """
+    Return (pid, PTS) of the first video PES of `view`, or of the first PES
+    of any stream when no video one starts there.
+    """
+    offset = packet_offset(view)
+    if offset < 0:
+        return None
+    fallback = None
+    for packet in iter_packets(view, offset):
+        found = pes_timestamp(packet)
+        if found is None:
+            continue
+        if is_video_stream(found[0]):
+            return packet_pid(packet), found[1]
+        if fallback is None:
+            fallback = packet_pid(packet), found[1]
+    return fallback
+
+
+def tail_timestamp(view, pid: int) -> Optional[int]:
+    """Return the last PTS of the stream `pid` in `view`, scanning back from its end."""
+    end = len(view)
+    for _ in range(MAX_TAIL_WINDOWS):
+        if end <= 0:
+            break
+        start = max(end - WINDOW, 0)
+        window = view[start:end]
+        offset = packet_offset(window)
+        last = None
+        if offset >= 0:
+            for packet in iter_packets(window, offset):
+                if packet_pid(packet) != pid:
+                    continue
+                found = pes_timestamp(packet)
+                if found is not None:
+                    last = found[1]
+        if last is not None:
+            return last
+        # Keep the packets cut by the window boundary for the next window.
+        end = start + TS_PACKET_SIZE
+        if start == 0:
+            break
+    return None
+
+
+def probe_ts(path: Path) -> Optional[tuple]:
+    """
+    Return (start_ms, duration_ms) of an MPEG-TS file from the first and last
+    PTS of its video stream, or None when it is not MPEG-TS or carries no
+    timestamps. The file is mapped, so only its head and tail are read.
+    """
+    try:
+        with open(path, "rb") as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file.
+                return None
+    except OSError:
+        return None
+
+    with mapped:
+        view = memoryview(mapped)
+        try:
+            first = head_timestamp(view[:WINDOW])
+            if first is None:
+                return None
+            pid, first_pts = first
+            last_pts = tail_timestamp(view, pid)
+        finally:
+            view.release()
+    if last_pts is None:
+        return None
+    duration = (last_pts - first_pts) % PTS_WRAP
+    return first_pts * 1000 // PTS_CLOCK, duration * 1000 // PTS_CLOCK
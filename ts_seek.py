@@ -0,0 +1,199 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from ts_packets import (
+    PTS_CLOCK,
+    PTS_WRAP,
+    SYNC_BYTE,
+    TS_PACKET_SIZE,
+    packet_offset,
+    payload_offset,
+    unwrap_pts,
+)
+
+# Packets processed at a time, ~200 MB of file.
+CHUNK_PACKETS = 2**20
+PAT_PID = 0x00
+
+
+def unwrap(pts: np.ndarray) -> np.ndarray:
+    """Return 33-bit timestamps in file order made continuous across wraps."""
+    if len(pts) < 2:
+        return pts
+    steps = np.zeros(len(pts), dtype=np.int64)
+    jumps = np.diff(pts)
+    steps[1:] = (jumps < -PTS_WRAP // 2).astype(np.int64) - (jumps > PTS_WRAP // 2)
+    return pts + np.cumsum(steps) * PTS_WRAP
+
+
+def scan_chunk(packets: np.ndarray, base: int, found: dict):
+    """
+    Extract, with array operations, the PID, PUSI, PCR and PES PTS of an
+    (n, 188) block of packets starting at the file offset `base`, and add
+    them to the lists of `found`.
+    """
+    offsets = base + np.arange(len(packets), dtype=np.int64) * TS_PACKET_SIZE
+    pid = (packets[:, 1].astype(np.int32) & 0x1F) << 8 | packets[:, 2]
+    pusi = (packets[:, 1] & 0x40) != 0
+    control = (packets[:, 3] >> 4) & 0x03
+    adaptation = (control & 0x02) != 0
+    adaptation_length = np.where(adaptation, packets[:, 4], 0).astype(np.int32)
+    flags = np.where(adaptation & (adaptation_length > 0), packets[:, 5], 0)
+    random_access = (flags & 0x40) != 0
+
+    rows = np.flatnonzero(((flags & 0x10) != 0) & (adaptation_length >= 7))
+    if len(rows):
+        b = packets[rows, 6:11].astype(np.int64)
+        found["pcr_offsets"].append(offsets[rows])
+        found["pcr"].append(b[:, 0] << 25 | b[:, 1] << 17 | b[:, 2] << 9 | b[:, 3] << 1 | b[:, 4] >> 7)
+
+    start = np.where(adaptation, 5 + adaptation_length, 4)
+    rows = np.flatnonzero(pusi & ((control & 0x01) != 0) & (start + 14 <= TS_PACKET_SIZE))
+    if not len(rows):
+        return
+    columns = start[rows, None] + np.arange(14)
+    head = packets[rows[:, None], columns].astype(np.int64)
+    pes = (head[:, 0] == 0) & (head[:, 1] == 0) & (head[:, 2] == 1) & ((head[:, 7] & 0x80) != 0)
+    rows, head = rows[pes], head[pes]
+    found["pes_offsets"].append(offsets[rows])
+    found["pes_pid"].append(pid[rows])
+    found["stream_id"].append(head[:, 3])
+    found["random_access"].append(random_access[rows])
+    found["pts"].append(
+        ((head[:, 9] >> 1) & 0x07) << 30
+        | head[:, 10] << 22
+        | (head[:, 11] >> 1) << 15
+        | head[:, 12] << 7
+        | head[:, 13] >> 1
+    )
+
+
+class PacketIndex:
+    """
+    Packet index of a whole MPEG-TS file, built with NumPy over a memory
+    map: the file is viewed as an (N, 188) array and the fields of every
+    packet are extracted at once, a chunk at a time. Keyframes are the video
+    PES flagged as random access points; their PTS, made continuous across
+    wraps, are searched by bisection.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        found = {key: [] for key in (
+            "pcr_offsets", "pcr", "pes_offsets", "pes_pid", "stream_id", "random_access", "pts",
+        )}
+        raw = np.memmap(self.path, dtype=np.uint8, mode="r")
+        size = len(raw)
+        position = packet_offset(raw[:TS_PACKET_SIZE * 5])
+        while 0 <= position and size - position >= TS_PACKET_SIZE:
+            count = min((size - position) // TS_PACKET_SIZE, CHUNK_PACKETS)
+            packets = raw[position:position + count * TS_PACKET_SIZE].reshape(count, TS_PACKET_SIZE)
+            lost = np.flatnonzero(packets[:, 0] != SYNC_BYTE)
+            if len(lost):
+                # A restarted recorder may have appended off the packet grid.
+                count = int(lost[0])
+            if count:
+                scan_chunk(packets[:count], position, found)
+            position += count * TS_PACKET_SIZE
+            if len(lost):
+                resync = packet_offset(raw[position:position + TS_PACKET_SIZE * 5])
+                position = position + resync if resync >= 0 else position + TS_PACKET_SIZE
+        del raw
+
+        def joined(key, dtype):
+            return np.concatenate(found[key]) if found[key] else np.zeros(0, dtype=dtype)
+
+        pes_offsets = joined("pes_offsets", np.int64)
+        pes_pid = joined("pes_pid", np.int32)
+        stream_id = joined("stream_id", np.int64)
+        random_access = joined("random_access", bool)
+        pts = joined("pts", np.int64)
+        self.pcr_offsets = joined("pcr_offsets", np.int64)
+        self.pcr = unwrap(joined("pcr", np.int64))
+
+        video = np.flatnonzero((stream_id >= 0xE0) & (stream_id <= 0xEF))
+        self.video_pid = int(pes_pid[video[0]]) if len(video) else None
+        self.first_pts = None
+        self.keyframe_offsets = np.zeros(0, dtype=np.int64)
+        self.keyframe_pts = np.zeros(0, dtype=np.int64)
+        if self.video_pid is None:
+            return
+        rows = np.flatnonzero(pes_pid == self.video_pid)
+        video_pts = unwrap(pts[rows])
+        self.first_pts = int(video_pts[0])
+        keyframes = random_access[rows]
+        self.keyframe_offsets = pes_offsets[rows][keyframes]
+        # Kept non-decreasing for the bisection.
+        self.keyframe_pts = np.maximum.accumulate(video_pts[keyframes]) if keyframes.any() else video_pts[:0]
+
+    def target(self, seconds: float) -> int:
+        """Return a time of the file clock, in seconds, as an unwrapped PTS."""
+        return unwrap_pts(round(seconds * PTS_CLOCK) % PTS_WRAP, self.first_pts)
+
+    def keyframe_after(self, seconds: float) -> Optional[tuple]:
+        """Return (byte offset, seconds) of the first keyframe at or after `seconds`, or None."""
+        if not len(self.keyframe_pts):
+            return None
+        i = int(np.searchsorted(self.keyframe_pts, self.target(seconds), side="left"))
+        if i == len(self.keyframe_pts):
+            return None
+        return int(self.keyframe_offsets[i]), int(self.keyframe_pts[i]) % PTS_WRAP / PTS_CLOCK
+
+    def keyframe_before(self, seconds: float) -> Optional[tuple]:
+        """Return (byte offset, seconds) of the last keyframe at or before `seconds`, or None."""
+        if not len(self.keyframe_pts):
+            return None
+        i = int(np.searchsorted(self.keyframe_pts, self.target(seconds), side="right")) - 1
+        if i < 0:
+            return None
+        return int(self.keyframe_offsets[i]), int(self.keyframe_pts[i]) % PTS_WRAP / PTS_CLOCK
+
+    def header_packets(self) -> bytes:
+        """
+        Return the first PAT packet of the file and the first packet of the
+        PMT it points to, so that a copy cut at a keyframe can be decoded
+        before the next tables come.
+        """
+        pat = pmt = None
+        pmt_pid = None
+        with open(self.path, "rb") as f:
+            data = f.read(TS_PACKET_SIZE * 20000)
+        offset = packet_offset(data)
+        if offset < 0:
+            return b""
+        for start in range(offset, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+            packet = data[start:start + TS_PACKET_SIZE]
+            if packet[0] != SYNC_BYTE or not packet[1] & 0x40:
+                continue
+            pid = (packet[1] & 0x1F) << 8 | packet[2]
+            payload = payload_offset(packet)
+            if payload < 0:
+                continue
+            if pid == PAT_PID and pat is None:
+                section = payload + 1 + packet[payload]
+                if section + 3 > TS_PACKET_SIZE:
+                    # Pointer field past the packet: a damaged table.
+                    continue
+                length = (packet[section + 1] & 0x0F) << 8 | packet[section + 2]
+                end = min(section + 3 + length - 4, TS_PACKET_SIZE - 3)
+                for entry in range(section + 8, end, 4):
+                    # Program number 0 points to the network table.
+                    if packet[entry] << 8 | packet[entry + 1]:
+                        pat, pmt_pid = packet, (packet[entry + 2] & 0x1F) << 8 | packet[entry + 3]
+                        break
+            elif pat is not None and pid == pmt_pid:
+                pmt = packet
+                break
+        if pat is None or pmt is None:
+            return b""
+        return pat + pmt
+
+
+def build_packet_index(path: Path) -> Optional[PacketIndex]:
+    """Return the packet index of a TS file, or None when it cannot be read."""
+    try:
+        return PacketIndex(path)
+    except (OSError, ValueError):
+        return None
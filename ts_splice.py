@@ -0,0 +1,377 @@
+import logging
+import os
+
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from ts_packets import (
+    PTS_WRAP,
+    SYNC_BYTE,
+    TS_PACKET_SIZE,
+    SectionAssembler,
+    iter_packets,
+    packet_offset,
+    packet_pid,
+)
+
+PAT_PID = 0x00
+# Service and event tables, kept from every source.
+SI_PIDS = (0x11, 0x12)
+# Bytes read at the head of a segment to find its PAT and PMT.
+TABLES_PROBE = TS_PACKET_SIZE * 20000
+# Packets rewritten at a time; the tables are repeated at each chunk.
+CHUNK_PACKETS = 5572
+
+# PES stream ids without the optional header carrying timestamps.
+NO_HEADER_STREAMS = [0xBE, 0xBF, 0xF0, 0xF1, 0xF2, 0xF8, 0xFF]
+
+VIDEO_TYPES = {0x01, 0x02, 0x10, 0x1B, 0x24, 0x33, 0x42, 0xEA}
+AUDIO_TYPES = {0x03, 0x04, 0x0F, 0x11, 0x1C, 0x2D, 0x81, 0x87}
+# Descriptors telling what a private data stream (type 0x06) carries.
+AUDIO_DESCRIPTORS = {0x6A, 0x7A, 0x7B, 0x7C}
+SUBTITLE_DESCRIPTORS = {0x59}
+TELETEXT_DESCRIPTORS = {0x56, 0x46}
+
+
+def stream_category(stream_type: int, descriptors: set) -> str:
+    if stream_type in VIDEO_TYPES:
+        return "video"
+    if stream_type in AUDIO_TYPES or descriptors & AUDIO_DESCRIPTORS:
+        return "audio"
+    if descriptors & SUBTITLE_DESCRIPTORS:
+        return "subtitle"
+    if descriptors & TELETEXT_DESCRIPTORS:
+        return "teletext"
+    return "data"
+
+
+def program_tables(path: Path) -> Optional[dict]:
+    """
+    Return the PAT and PMT of the first programme of a TS file: the raw
+    packets carrying them, the PMT and PCR PIDs, and its elementary streams
+    as (category, stream_type, pid) in PMT order. None when not found.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read(TABLES_PROBE)
+    except OSError:
+        return None
+    return parse_program_tables(data)
+
+
+def parse_program_tables(data: bytes) -> Optional[dict]:
+    """Return the tables of the first programme found in `data`, like program_tables."""
+    offset = packet_offset(data)
+    if offset < 0:
+        return None
+
+    assemblers = {PAT_PID: SectionAssembler()}
+    packets = {PAT_PID: [], None: []}
+    pmt_pid = None
+    for packet in iter_packets(data, offset):
+        pid = packet_pid(packet)
+        if pid not in assemblers:
+            continue
+        if packet[1] & 0x40:
+            # Only the packets of one complete table are kept.
+            packets[pid] = []
+        packets[pid].append(bytes(packet))
+        for section in assemblers[pid].feed(packet):
+            if pid == PAT_PID and section[0] == 0x00 and pmt_pid is None:
+                for entry in range(8, len(section) - 4, 4):
+                    if section[entry] << 8 | section[entry + 1]:
+                        pmt_pid = (section[entry + 2] & 0x1F) << 8 | section[entry + 3]
+                        assemblers[pmt_pid] = SectionAssembler()
+                        packets[pmt_pid] = []
+                        pat_packets = packets[PAT_PID]
+                        break
+            elif pid == pmt_pid and section[0] == 0x02:
+                return {
+                    "pat": b"".join(pat_packets),
+                    "pmt": b"".join(packets[pmt_pid]),
+                    "pmt_pid": pmt_pid,
+                    "pcr_pid": (section[8] & 0x1F) << 8 | section[9],
+                    "streams": pmt_streams(section),
+                }
+    return None
+
+
+def pmt_streams(section: bytes) -> list:
+    streams = []
+    position = 12 + ((section[10] & 0x0F) << 8 | section[11])
+    end = len(section) - 4
+    while position + 5 <= end:
+        stream_type = section[position]
+        pid = (section[position + 1] & 0x1F) << 8 | section[position + 2]
+        info_length = (section[position + 3] & 0x0F) << 8 | section[position + 4]
+        descriptors = set()
+        cursor = position + 5
+        while cursor + 2 <= min(position + 5 + info_length, end):
+            descriptors.add(section[cursor])
+            cursor += 2 + section[cursor + 1]
+        streams.append((stream_category(stream_type, descriptors), stream_type, pid))
+        position += 5 + info_length
+    return streams
+
+
+def pid_map(base: dict, other: dict) -> Optional[dict]:
+    """
+    Return the PIDs of `other` mapped to those of `base`, stream by stream in
+    the order of each category, or None when the sources cannot be joined
+    in one stream: a different video codec or a PCR carried elsewhere.
+    """
+    mapping = {PAT_PID: PAT_PID, other["pmt_pid"]: base["pmt_pid"]}
+    for pid in SI_PIDS:
+        mapping[pid] = pid
+    by_category = {}
+    for category, stream_type, pid in base["streams"]:
+        by_category.setdefault(category, []).append((stream_type, pid))
+    used = {}
+    for category, stream_type, pid in other["streams"]:
+        candidates = by_category.get(category, [])
+        position = used.get(category, 0)
+        if position >= len(candidates):
+            continue
+        used[category] = position + 1
+        base_type, base_pid = candidates[position]
+        if category == "video" and base_type != stream_type:
+            return None
+        mapping[pid] = base_pid
+    if other["pcr_pid"] not in mapping:
+        if base["pcr_pid"] in [pid for _, _, pid in base["streams"]]:
+            return None
+        mapping[other["pcr_pid"]] = base["pcr_pid"]
+    if mapping.get(other["pcr_pid"]) != base["pcr_pid"]:
+        return None
+    return mapping
+
+
+def shift_timestamp(packets: np.ndarray, rows: np.ndarray, column: np.ndarray, delta: int):
+    """Add `delta` to the 5-byte PTS/DTS fields at `column` of `rows`, keeping their marker bits."""
+    raw = packets[rows[:, None], column[:, None] + np.arange(5)].astype(np.int64)
+    value = (
+        ((raw[:, 0] >> 1) & 0x07) << 30 | raw[:, 1] << 22 | (raw[:, 2] >> 1) << 15
+        | raw[:, 3] << 7 | raw[:, 4] >> 1
+    )
+    value = (value + delta) % PTS_WRAP
+    raw[:, 0] = (raw[:, 0] & 0xF1) | ((value >> 29) & 0x0E)
+    raw[:, 1] = (value >> 22) & 0xFF
+    raw[:, 2] = ((value >> 14) & 0xFE) | (raw[:, 2] & 0x01)
+    raw[:, 3] = (value >> 7) & 0xFF
+    raw[:, 4] = ((value << 1) & 0xFE) | (raw[:, 4] & 0x01)
+    packets[rows[:, None], column[:, None] + np.arange(5)] = raw.astype(np.uint8)
+
+
+def shift_clocks(packets: np.ndarray, delta: int):
+    """Add `delta` (90 kHz) to the PCR and the PES PTS/DTS of a block of packets."""
+    control = (packets[:, 3] >> 4) & 0x03
+    adaptation = (control & 0x02) != 0
+    length = np.where(adaptation, packets[:, 4], 0).astype(np.int32)
+    flags = np.where(adaptation & (length > 0), packets[:, 5], 0)
+
+    rows = np.flatnonzero(((flags & 0x10) != 0) & (length >= 7))
+    if len(rows):
+        b = packets[rows, 6:11].astype(np.int64)
+        pcr = b[:, 0] << 25 | b[:, 1] << 17 | b[:, 2] << 9 | b[:, 3] << 1 | b[:, 4] >> 7
+        pcr = (pcr + delta) % PTS_WRAP
+        b[:, 0] = pcr >> 25
+        b[:, 1] = (pcr >> 17) & 0xFF
+        b[:, 2] = (pcr >> 9) & 0xFF
+        b[:, 3] = (pcr >> 1) & 0xFF
+        b[:, 4] = ((pcr & 0x01) << 7) | (b[:, 4] & 0x7F)
+        packets[rows, 6:11] = b.astype(np.uint8)
+
+    start = np.where(adaptation, 5 + length, 4)
+    rows = np.flatnonzero(
+        ((packets[:, 1] & 0x40) != 0) & ((control & 0x01) != 0) & (start + 19 <= TS_PACKET_SIZE)
+    )
+    if not len(rows):
+        return
+    start = start[rows]
+    head = packets[rows[:, None], start[:, None] + np.arange(8)]
+    pes = (
+        (head[:, 0] == 0) & (head[:, 1] == 0) & (head[:, 2] == 1)
+        & (head[:, 3] >= 0xBD) & ~np.isin(head[:, 3], NO_HEADER_STREAMS)
+    )
+    has_pts = pes & ((head[:, 7] & 0x80) != 0)
+    shift_timestamp(packets, rows[has_pts], start[has_pts] + 9, delta)
+    has_dts = pes & ((head[:, 7] & 0xC0) == 0xC0)
+    shift_timestamp(packets, rows[has_dts], start[has_dts] + 14, delta)
+
+
+class TsSplicer:
+    """
+    Write byte ranges of several MPEG-TS segments as one continuous stream,
+    in a single sequential pass.
+
+    The first segment gives the PAT and PMT of the output; the streams of
+    the others are moved to its PIDs and their tables replaced by its own,
+    repeated at every chunk. Timestamps of each segment are shifted so that
+    its first packet follows the end of the previous one, and continuity
+    counters are offset so that no PID shows a discontinuity at a junction.
+
+    Given the `counters` and `bytes_written` of an earlier splicer, it goes
+    on writing the same output after them, dropping any later bytes.
+    """
+
+    def __init__(self, output: Path, base: dict, counters: Optional[dict] = None, bytes_written: int = 0):
+        self.output = Path(output)
+        self.base = base
+        self.counters = dict(counters or {})
+        self.out = None
+        self.bytes_written = bytes_written
+
+    def __enter__(self):
+        if self.bytes_written:
+            self.out = open(self.output, "r+b")
+            self.out.truncate(self.bytes_written)
+            self.out.seek(self.bytes_written)
+        else:
+            self.out = open(self.output, "wb")
+        return self
+
+    def __exit__(self, *exc):
+        self.out.close()
+
+    def tables(self) -> bytes:
+        """Return the base PAT and PMT packets with continuity counters following the output."""
+        packets = np.frombuffer(self.base["pat"] + self.base["pmt"], dtype=np.uint8).reshape(-1, TS_PACKET_SIZE).copy()
+        for packet in packets:
+            pid = packet_pid(packet.tobytes())
+            counter = (self.counters.get(pid, -1) + 1) & 0x0F
+            packet[3] = (packet[3] & 0xF0) | counter
+            self.counters[pid] = counter
+        return packets.tobytes()
+
+    def flush(self):
+        self.out.flush()
+
+    def pid_table(self, mapping: Optional[dict]) -> np.ndarray:
+        """Return the output PID of each PID, -1 for the dropped ones."""
+        lut = np.full(8192, -1, dtype=np.int32)
+        if mapping is None:
+            lut[:] = np.arange(8192)
+        else:
+            for src, dst in mapping.items():
+                lut[src] = dst
+            # Its own tables are replaced by the base ones.
+            lut[[src for src, dst in mapping.items() if dst in (PAT_PID, self.base["pmt_pid"])]] = -1
+        return lut
+
+    def append_data(self, data: bytes, mapping: Optional[dict], delta: int = 0):
+        """Write the whole packets of `data`, which starts on a packet, like append."""
+        count = len(data) // TS_PACKET_SIZE
+        packets = np.frombuffer(data, dtype=np.uint8, count=count * TS_PACKET_SIZE).reshape(count, TS_PACKET_SIZE)
+        packets = packets[packets[:, 0] == SYNC_BYTE]
+        self.write(packets, self.pid_table(mapping), {}, delta, mapping is not None)
+
+    def append(self, path: Path, start: int, end: Optional[int], mapping: Optional[dict], delta: int) -> int:
+        """
+        Write the bytes [start, end) of `path` (to its end when `end` is
+        None). `mapping` moves its PIDs to the output ones (None keeps them
+        and its tables); `delta` is added to its timestamps. Return the
+        offset where the next bytes of `path` start, past its last whole
+        packet.
+        """
+        lut = self.pid_table(mapping)
+        offsets = {}
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            end = os.fstat(fd).st_size if end is None else end
+            position = start
+            while end - position >= TS_PACKET_SIZE:
+                count = min((end - position) // TS_PACKET_SIZE, CHUNK_PACKETS)
+                data = os.pread(fd, count * TS_PACKET_SIZE, position)
+                count = len(data) // TS_PACKET_SIZE
+                if not count:
+                    break
+                packets = np.frombuffer(data, dtype=np.uint8, count=count * TS_PACKET_SIZE).reshape(count, TS_PACKET_SIZE)
+                lost = np.flatnonzero(packets[:, 0] != SYNC_BYTE)
+                good = int(lost[0]) if len(lost) else count
+                self.write(packets[:good], lut, offsets, delta, mapping is not None)
+                position += good * TS_PACKET_SIZE
+                if len(lost):
+                    resync = packet_offset(os.pread(fd, TS_PACKET_SIZE * 5, position))
+                    position += resync if resync > 0 else TS_PACKET_SIZE
+        finally:
+            os.close(fd)
+        return position
+
+    def write(self, packets: np.ndarray, lut: np.ndarray, offsets: dict, delta: int, tables: bool):
+        pid = (packets[:, 1].astype(np.int32) & 0x1F) << 8 | packets[:, 2]
+        target = lut[pid]
+        keep = target >= 0
+        packets = packets[keep]
+        target = target[keep]
+        if len(packets):
+            packets[:, 1] = (packets[:, 1] & 0xE0) | (target >> 8)
+            packets[:, 2] = target & 0xFF
+            if delta:
+                shift_clocks(packets, delta)
+
+            # Offset the counters of each PID so that it continues the output.
+            counter = packets[:, 3] & 0x0F
+            has_payload = (packets[:, 3] & 0x10) != 0
+            pids, first = np.unique(target, return_index=True)
+            shift = np.zeros(8192, dtype=np.int32)
+            for out_pid, row in zip(pids.tolist(), first.tolist()):
+                if out_pid not in offsets:
+                    previous = self.counters.get(out_pid)
+                    if previous is None:
+                        offsets[out_pid] = 0
+                    else:
+                        wanted = (previous + 1) & 0x0F if has_payload[row] else previous
+                        offsets[out_pid] = (wanted - int(counter[row])) & 0x0F
+                shift[out_pid] = offsets[out_pid]
+            packets[:, 3] = (packets[:, 3] & 0xF0) | ((counter + shift[target]) & 0x0F)
+            last = len(target) - 1 - np.unique(target[::-1], return_index=True)[1]
+            for out_pid, row in zip(pids.tolist(), last.tolist()):
+                self.counters[out_pid] = int(packets[row, 3] & 0x0F)
+
+        chunk = (self.tables() if tables else b"") + packets.tobytes()
+        self.out.write(chunk)
+        self.bytes_written += len(chunk)
+
+
+def signed_pts(value: int) -> int:
+    """Return a 33-bit timestamp difference as the closest signed value."""
+    return (value + PTS_WRAP // 2) % PTS_WRAP - PTS_WRAP // 2
+
+
+def splice(pieces: list, output: Path) -> bool:
+    """
+    Write the pieces, dicts with the keys path, start and end (byte
+    offsets, end None for the end of the file), junction_out (PTS of the
+    end of the piece, in its own clock) and junction_in (PTS of its first
+    keyframe), as one file. Return False, leaving no output, when their
+    streams cannot be joined.
+    """
+    tables = [program_tables(piece["path"]) for piece in pieces]
+    if any(table is None for table in tables):
+        return False
+    base = tables[0]
+    mappings = [None] + [pid_map(base, table) for table in tables[1:]]
+    if any(mapping is None for mapping in mappings[1:]):
+        logging.info("Streams of the segments differ, they cannot be spliced")
+        return False
+
+    delta = 0
+    try:
+        with TsSplicer(output, base) as splicer:
+            for n, (piece, mapping) in enumerate(zip(pieces, mappings)):
+                if n > 0:
+                    # The first keyframe of the piece follows the end of the previous one.
+                    delta = (pieces[n - 1]["junction_out"] + delta - piece["junction_in"]) % PTS_WRAP
+                    delta = signed_pts(delta)
+                splicer.append(piece["path"], piece["start"], piece["end"], mapping, delta)
+    except OSError:
+        logging.exception("Failed to splice segments into %s", output)
+        try:
+            output.unlink()
+        except OSError:
+            pass
+        return False
+    return True